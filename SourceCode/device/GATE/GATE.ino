@@ -47,6 +47,13 @@ const unsigned long POSITION_WAIT_TIME = 3000;  // 3 giây đợi xe vào vị t
 
 // Manual Gate Queue
 volatile bool manualGateRequested = false;
+String manualCmdId = "";  // cmd_id của lệnh manual đang chờ task xử lý
+
+// Command ID của lệnh đang xử lý, gửi kèm status để server ghép lệnh <-> phản hồi
+String currentCmdId = "";
+// Lệnh đã thực thi gần nhất: server gửi lại lệnh chưa được ack thì chỉ gửi lại ack, không mở cổng lần nữa
+String lastCmdId = "";
+String lastAckMessage = "";
 SemaphoreHandle_t gateMutex;
 
 // Debounce
@@ -132,7 +139,14 @@ void manualGateTask(void* parameter) {
         setRGB_Blue();
         
         // Gửi log về server
-        String message = "{\"source\":\"manual\",\"direction\":\"manual\",\"override\":true}";
+        String message = "{\"source\":\"manual\",\"direction\":\"manual\",\"override\":true";
+        bool isAck = manualCmdId.length() > 0;
+        if (isAck) {
+          message += ",\"cmd_id\":\"" + manualCmdId + "\"";
+          manualCmdId = "";
+        }
+        message += "}";
+        if (isAck) lastAckMessage = message;
         if (mqtt.connected()) {
           mqtt.publish(TOPIC_GATE_STATUS, message.c_str());
           Serial.println("[MQTT] Manual override logged to server");
@@ -449,15 +463,31 @@ void handleGateCommand(String message) {
   Serial.print("  waitingForOCR state: ");
   Serial.println(waitingForOCR ? "TRUE" : "FALSE");
   
+  String cmdId = extractCmdId(message);
+  
+  // Lệnh lặp lại (server retry) - chỉ gửi lại ack, không điều khiển servo
+  if (cmdId.length() > 0 && cmdId == lastCmdId) {
+    Serial.println("[MQTT] Duplicate command " + cmdId + ", re-sending ack only");
+    if (lastAckMessage.length() > 0 && mqtt.connected()) {
+      mqtt.publish(TOPIC_GATE_STATUS, lastAckMessage.c_str());
+    }
+    return;
+  }
+  lastCmdId = cmdId;
+  lastAckMessage = "";
+  
   // Kiểm tra lệnh manual - check nhiều format
   if ((message.indexOf("\"manual\": true") > 0) ||   // có dấu cách
       (message.indexOf("\"manual\":true") > 0) ||     // không dấu cách
       (message.indexOf("\"source\":\"manual\"") > 0)) {
     Serial.println("[MQTT] Manual override command detected");
+    manualCmdId = cmdId;
     manualGateRequested = true;  // Set flag cho task xử lý
     return;
   }
   
+  currentCmdId = cmdId;
+  
   if (message.indexOf("\"open\"") > 0) {
     Serial.println("[SYSTEM] Opening gate");
 
@@ -510,6 +540,7 @@ void openGate() {
   } else {
     Serial.println("[GATE] already open, resetting timer");
     gateOpenTime = millis();  // Reset timer
+    publishGateStatus("open");  // Xác nhận lệnh (server có thể gửi lại lệnh chưa được xác nhận)
   }
 }
 
@@ -535,8 +566,25 @@ void closeGate() {
   }
 }
 
+String extractCmdId(String message) {
+  // Lấy giá trị "cmd_id" từ JSON lệnh (không cần thư viện JSON)
+  int key = message.indexOf("\"cmd_id\"");
+  if (key < 0) return "";
+  int start = message.indexOf('"', message.indexOf(':', key) + 1);
+  int end = message.indexOf('"', start + 1);
+  if (start < 0 || end < 0) return "";
+  return message.substring(start + 1, end);
+}
+
 void publishGateStatus(String status) {
-  String message = "{\"status\":\"" + status + "\",\"direction\":\"" + currentDirection + "\"}";
+  String message = "{\"status\":\"" + status + "\",\"direction\":\"" + currentDirection + "\"";
+  bool isAck = currentCmdId.length() > 0;
+  if (isAck) {
+    message += ",\"cmd_id\":\"" + currentCmdId + "\"";
+    currentCmdId = "";  // Chỉ status đầu tiên sau lệnh là phản hồi của lệnh
+  }
+  message += "}";
+  if (isAck) lastAckMessage = message;
   mqtt.publish(TOPIC_GATE_STATUS, message.c_str());
   
   Serial.print("[STATUS] ");
@@ -2,6 +2,7 @@ from fastapi import FastAPI, WebSocket, Depends
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse
+import asyncio
 import os
 import time
 
@@ -11,15 +12,23 @@ from models import init_db
 # Import services
 from services.websocket_service import websocket_service
 from services.mosquitto_service import mosquitto_service
-from services.slot_update_service import SlotUpdateService, slot_update_service as _slot_service
+from services.slot_update_service import slot_update_service as _slot_service
 from services.gate_service import gate_service
+from services.ocr_service import ocr_service
+from services.ocr_job_service import ocr_job_service
+from services.image_preprocess import image_preprocessor
+from services.retention_service import retention_service
+from services.thumbnail_service import thumbnail_service
+from services.plate_index import plate_index
+from services.parking_session_service import parking_session_service
+from services.plate_list_service import plate_list_service
 from services import ota_service
 
 # Import routes
-from routes import dashboard, slots, vehicles, upload
+from routes import dashboard, slots, vehicles, upload, sessions, plate_lists
 
-# Import MQTT handler
-from services.mqtt_handler import MQTTHandler
+# Import MQTT handler (kết nối dùng chung cho mọi service)
+from services.mqtt_handler import mqtt_manager
 
 # FastAPI App
 app = FastAPI(
@@ -39,15 +48,10 @@ os.makedirs(settings.ARCHIVE_DIR, exist_ok=True)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# Global State
-mqtt_handler = None
-
 # Startup & Shutdown Events
 @app.on_event("startup")
 async def startup_event():
     # Khởi tạo khi server start
-    global mqtt_handler, _slot_service
-    
     print("=" * 50)
     print("Starting IoT Parking System Server")
     print("=" * 50)
@@ -59,20 +63,55 @@ async def startup_event():
     except Exception as e:
         print(f"[DATABASE] ERROR Database error: {e}")
     
+    # Nạp index biển số từ vehicle_logs cho tra cứu gần đúng
+    try:
+        await asyncio.to_thread(plate_index.load_from_db)
+    except Exception as e:
+        print(f"[PLATE INDEX] ERROR {e}")
+    
+    # Dựng lại danh sách xe đang trong bãi từ parking_sessions
+    try:
+        await asyncio.to_thread(parking_session_service.load_from_db)
+    except Exception as e:
+        print(f"[SESSION] ERROR {e}")
+    
+    # Biên dịch allow/deny list vào bộ nhớ cho quyết định mở cổng
+    try:
+        await asyncio.to_thread(plate_list_service.load_from_db)
+    except Exception as e:
+        print(f"[PLATE LIST] ERROR {e}")
+    
+    # Load OCR backend (model local được load một lần tại đây)
+    if await asyncio.to_thread(ocr_service.backend.warmup):
+        print(f"[OCR] SUCCESS OCR backend ready: {ocr_service.backend.name}")
+    else:
+        print(f"[OCR] WARNING OCR backend not ready: {ocr_service.backend.name}")
+    
     # Khởi động WebSocket broadcast worker
     websocket_service.start_worker()
     
+    # Khởi động OCR job worker pool (upload mode async)
+    ocr_job_service.start()
+    
+    # Khởi động janitor dọn ảnh theo tuổi/dung lượng
+    retention_service.start()
+    
     # Khởi tạo slot update service với websocket callback
-    _slot_service = SlotUpdateService(websocket_callback=websocket_service.queue_broadcast)
+    _slot_service.websocket_callback = websocket_service.queue_broadcast
+    websocket_service.add_sync_provider("slots", _slot_service.sync)
+    _slot_service.start()
     
     # Khởi tạo MQTT Handler
     print(f"[MQTT] Attempting to connect to: {settings.MQTT_BROKER}:{settings.MQTT_PORT}")
     
     is_local_broker = settings.MQTT_BROKER in ["localhost", "127.0.0.1", "0.0.0.0"]
     
-    mqtt_handler = MQTTHandler(on_slot_update=_slot_service.handle_slot_update)
+    # Các service đăng ký handler trước khi kết nối (được subscribe lại mỗi lần reconnect)
+    mqtt_manager.add_handler(settings.MQTT_TOPIC_SLOTS, _slot_service.handle_slot_update)
+    gate_service.attach(mqtt_manager)
+    ota_service.attach(mqtt_manager)
     
-    if mqtt_handler.connect():
+    if mqtt_manager.connect():
         print("[MQTT] SUCCESS MQTT Handler connected")
     else:
         print("[MQTT] ERROR MQTT Handler failed")
@@ -86,25 +125,20 @@ async def startup_event():
                 
                 # Thử kết nối lại sau khi khởi động broker
                 time.sleep(2)
-                if mqtt_handler.connect():
+                if mqtt_manager.connect():
                     print("[MQTT] SUCCESS MQTT Handler connected")
                 else:
                     print("[MQTT] ERROR MQTT Handler still failed")
+                    mqtt_manager.connect_async()
             else:
                 print("[MQTT] ERRO Could not start Mosquitto")
+                mqtt_manager.connect_async()
         else:
-            print("[MQTT] CRITICAL ERROR Continuing without MQTT...")
+            print("[MQTT] CRITICAL ERROR Broker unreachable, continuing while retrying in background...")
+            mqtt_manager.connect_async()
     
-    # Cấu hình Gate Service với MQTT handler
-    gate_service.mqtt_handler = mqtt_handler
     print("[GATE] SUCCESS Gate service configured")
     
-    # Khởi tạo OTA Service
-    if ota_service.init_mqtt():
-        print("[OTA] SUCCESS OTA service initialized")
-    else:
-        print("[OTA] WARNING Running without OTA MQTT")
-    
     print("=" * 50)
     print(f"Server running at http://{settings.SERVER_HOST}:{settings.SERVER_PORT}")
     print(f"OTA Dashboard: http://{settings.SERVER_HOST}:{settings.SERVER_PORT}/ota (Super Admin only)")
@@ -115,18 +149,26 @@ async def startup_event():
 async def shutdown_event():
     
     # Cleanup khi server stop
-    if mqtt_handler:
-        mqtt_handler.disconnect()
+    mqtt_manager.disconnect()
     
-    # Dừng OTA service
-    ota_service.shutdown_mqtt()
+    # Ghi nốt trạng thái slot còn trong bộ nhớ xuống DB
+    await asyncio.to_thread(_slot_service.stop)
     
     # Dừng Mosquitto nếu được khởi động bởi server
     mosquitto_service.stop()
     
+    # Dừng OCR job workers và janitor
+    await ocr_job_service.stop()
+    await retention_service.stop()
+    
     # Dừng WebSocket worker
     await websocket_service.stop_worker()
     
+    # Đóng connection pool của OCR client
+    await ocr_service.aclose()
+    image_preprocessor.shutdown()
+    thumbnail_service.shutdown()
+    
     print("[SERVER] Server shutdown complete")
 
 # Include Routers
@@ -134,6 +176,8 @@ app.include_router(dashboard.router)
 app.include_router(slots.router)
 app.include_router(vehicles.router)
 app.include_router(upload.router)
+app.include_router(sessions.router)
+app.include_router(plate_lists.router)
 app.include_router(ota_service.router)  # OTA Update Service
 
 # Root Endpoint - Redirect to public dashboard
@@ -173,11 +217,18 @@ async def api_info():
 async def websocket_endpoint(websocket: WebSocket):
     
     # WebSocket endpoint cho realtime updates
-    await websocket_service.connect(websocket)
+    # ?channels=slots,vehicles: channel ban đầu (mặc định slots), ?compress=1: nhận message lớn dạng nhị phân nén zlib
+    channels = [c for c in websocket.query_params.get("channels", "").split(",") if c]
+    await websocket_service.connect(
+        websocket,
+        compress=websocket.query_params.get("compress") == "1",
+        channels=channels or None
+    )
     
     try:
         while True:
-            await websocket.receive_text()
+            # Client gửi subscribe/unsubscribe
+            websocket_service.handle_message(websocket, await websocket.receive_text())
     except:
         pass
     finally:
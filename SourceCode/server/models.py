@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, create_engine
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
@@ -22,13 +22,41 @@ class VehicleLog(Base):
     __tablename__ = "vehicle_logs"
     
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    license_plate = Column(String(20), index=True)
+    license_plate = Column(String(20), index=True)  # Dạng canonical (tra cứu, ghép lượt)
+    raw_plate = Column(String(32))  # Chuỗi OCR gốc trước khi chuẩn hóa
     image_path = Column(String(255))
     ocr_result = Column(String(1000))
     confidence = Column(String(10))
     timestamp = Column(DateTime, default=datetime.utcnow)
     action = Column(String(10))  # "entry" hoặc "exit"
 
+class ParkingSession(Base):
+    # Model cho lượt gửi xe (ghép log entry với log exit)
+    __tablename__ = "parking_sessions"
+    
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    license_plate = Column(String(20), index=True, nullable=False)
+    entry_log_id = Column(Integer)
+    exit_log_id = Column(Integer)
+    entry_time = Column(DateTime, nullable=False)
+    exit_time = Column(DateTime)
+    duration_seconds = Column(Integer)
+    status = Column(String(10), index=True, default="open")  # "open", "closed" hoặc "orphaned"
+    fee = Column(Integer)  # VND, tính khi xe ra
+    tariff_version = Column(String(20))
+
+class PlateListEntry(Base):
+    # Model cho danh sách biển số cho phép (cư dân, thuê bao) / cấm
+    __tablename__ = "plate_lists"
+    
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    license_plate = Column(String(20), index=True, nullable=False)  # Dạng canonical
+    list_type = Column(String(10), nullable=False)  # "allow" hoặc "deny"
+    note = Column(String(255))
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
 class Admin(Base):
     # Model cho admin users
     __tablename__ = "admins"
@@ -76,9 +104,25 @@ engine = create_engine(
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def _add_missing_columns():
+
+    # create_all không thêm cột mới vào bảng đã có: bổ sung các cột nullable còn thiếu
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=engine.dialect)
+                with engine.begin() as connection:
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                print(f"[DATABASE] Added column {table.name}.{column.name}")
+
 def init_db():
     # Khởi tạo database
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
     
     # Tạo super admin mặc định nếu chưa có
     db = SessionLocal()
@@ -2,5 +2,7 @@ from . import dashboard
 from . import slots
 from . import vehicles
 from . import upload
+from . import sessions
+from . import plate_lists
 
-__all__ = ['dashboard', 'slots', 'vehicles', 'upload']
+__all__ = ['dashboard', 'slots', 'vehicles', 'upload', 'sessions', 'plate_lists']
@@ -222,7 +222,8 @@ async def manual_gate_open(request: Request, session_id: Optional[str] = Cookie(
         from services.gate_service import gate_service
         
         # Trigger manual gate open
-        success = gate_service.trigger_manual_gate()
+        cmd_id = await gate_service.trigger_manual_gate()
+        success = cmd_id is not None
         
         # Log admin action
         log_admin_action(
@@ -238,7 +239,8 @@ async def manual_gate_open(request: Request, session_id: Optional[str] = Cookie(
             return JSONResponse(
                 content={
                     "success": True,
-                    "message": "Gate opened manually"
+                    "message": "Gate opened manually",
+                    "cmd_id": cmd_id
                 }
             )
         else:
@@ -258,6 +260,101 @@ async def manual_gate_open(request: Request, session_id: Optional[str] = Cookie(
             status_code=500
         )
 
+@router.get("/api/admin/storage")
+async def storage_status(session_id: Optional[str] = Cookie(None)):
+    """Retention janitor progress, image storage and thumbnail cache usage (admin only)"""
+    if not verify_session(session_id):
+        return JSONResponse(
+            content={"success": False, "error": "Unauthorized"},
+            status_code=401
+        )
+    
+    from services.retention_service import retention_service
+    from services.thumbnail_service import thumbnail_service
+    
+    return JSONResponse(
+        content={
+            "success": True,
+            "retention": retention_service.stats(),
+            "thumbnails": thumbnail_service.stats()
+        }
+    )
+
+@router.get("/api/admin/mqtt")
+async def mqtt_status(session_id: Optional[str] = Cookie(None)):
+    """Shared MQTT connection, subscription and publish stats (admin only)"""
+    if not verify_session(session_id):
+        return JSONResponse(
+            content={"success": False, "error": "Unauthorized"},
+            status_code=401
+        )
+    
+    from services.mqtt_handler import mqtt_manager
+    
+    return JSONResponse(content={"success": True, "mqtt": mqtt_manager.stats()})
+
+@router.get("/api/admin/websocket")
+async def websocket_status(session_id: Optional[str] = Cookie(None)):
+    """WebSocket broadcast queue depth, dwell time and client stats (admin only)"""
+    if not verify_session(session_id):
+        return JSONResponse(
+            content={"success": False, "error": "Unauthorized"},
+            status_code=401
+        )
+    
+    from services.websocket_service import websocket_service
+    
+    return JSONResponse(content={"success": True, "websocket": websocket_service.stats()})
+
+@router.get("/api/admin/slots")
+async def slot_sensor_status(session_id: Optional[str] = Cookie(None)):
+    """Slot sensor filter stats: raw vs committed rate, flapping slots, anomalies (admin only)"""
+    if not verify_session(session_id):
+        return JSONResponse(
+            content={"success": False, "error": "Unauthorized"},
+            status_code=401
+        )
+    
+    from services.slot_update_service import slot_update_service
+    
+    return JSONResponse(content={"success": True, "slots": slot_update_service.stats()})
+
+@router.get("/api/admin/gate/commands")
+async def gate_commands(session_id: Optional[str] = Cookie(None)):
+    """Pending/failed gate commands and command-to-actuation latency (admin only)"""
+    if not verify_session(session_id):
+        return JSONResponse(
+            content={"success": False, "error": "Unauthorized"},
+            status_code=401
+        )
+    
+    from services.gate_service import gate_service
+    
+    return JSONResponse(
+        content={
+            "success": True,
+            **gate_service.commands()
+        }
+    )
+
+@router.get("/api/admin/gate/history")
+async def gate_history(limit: int = 50, session_id: Optional[str] = Cookie(None)):
+    """Recent gate commands incl. suppressed/coalesced/external ones (admin only)"""
+    if not verify_session(session_id):
+        return JSONResponse(
+            content={"success": False, "error": "Unauthorized"},
+            status_code=401
+        )
+    
+    from services.gate_service import gate_service
+    
+    return JSONResponse(
+        content={
+            "success": True,
+            "history": gate_service.history(limit)
+        }
+    )
+
 # Backward compatibility - redirect old /dashboard to public
 @router.get("/dashboard", response_class=HTMLResponse)
 async def dashboard_redirect():
@@ -0,0 +1,153 @@
+from fastapi import APIRouter, Depends, Request, Form, Cookie
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import Session
+from typing import Optional
+from models import get_db, PlateListEntry
+from session_manager import verify_session
+from services.plate_index import normalize_plate, format_plate
+from services.plate_list_service import plate_list_service, LIST_TYPES
+from routes.dashboard import log_admin_action
+
+router = APIRouter(prefix="/api/admin")
+
+def _unauthorized():
+    return JSONResponse(
+        content={"success": False, "error": "Unauthorized"},
+        status_code=401
+    )
+
+@router.get("/plate-lists")
+async def get_plate_lists(
+    list_type: Optional[str] = None,
+    session_id: Optional[str] = Cookie(None),
+    db: Session = Depends(get_db)
+):
+    """List allow/deny plate entries (admin only)"""
+    if not verify_session(session_id):
+        return _unauthorized()
+    
+    try:
+        query = db.query(PlateListEntry).filter(PlateListEntry.is_active == True)
+        if list_type:
+            query = query.filter(PlateListEntry.list_type == list_type)
+        entries = query.order_by(PlateListEntry.updated_at.desc()).all()
+        return {
+            "success": True,
+            "count": len(entries),
+            "entries": [
+                {
+                    "id": e.id,
+                    "license_plate": e.license_plate,
+                    "display": format_plate(e.license_plate),
+                    "list_type": e.list_type,
+                    "note": e.note,
+                    "updated_at": e.updated_at.isoformat() if e.updated_at else None
+                }
+                for e in entries
+            ],
+            "stats": plate_list_service.stats()
+        }
+    except Exception as e:
+        return JSONResponse(
+            content={"success": False, "error": str(e)},
+            status_code=500
+        )
+
+@router.post("/plate-lists")
+async def add_plate_list_entry(
+    request: Request,
+    plate: str = Form(...),
+    list_type: str = Form(...),
+    note: str = Form(None),
+    session_id: Optional[str] = Cookie(None),
+    db: Session = Depends(get_db)
+):
+    """Add a plate to the allow or deny list (admin only)"""
+    if not verify_session(session_id):
+        return _unauthorized()
+    
+    canonical = normalize_plate(plate)
+    if list_type not in LIST_TYPES or len(canonical) < 7:
+        return JSONResponse(
+            content={"success": False, "error": f"Invalid plate or list_type (must be {LIST_TYPES})"},
+            status_code=400
+        )
+    
+    try:
+        # Một biển số chỉ thuộc một danh sách: gỡ khỏi danh sách còn lại
+        entries = db.query(PlateListEntry).filter(PlateListEntry.license_plate == canonical).all()
+        entry = None
+        for existing in entries:
+            if existing.list_type == list_type:
+                entry = existing
+            elif existing.is_active:
+                existing.is_active = False
+        
+        if entry:
+            entry.is_active = True
+            entry.note = note
+        else:
+            entry = PlateListEntry(license_plate=canonical, list_type=list_type, note=note, is_active=True)
+            db.add(entry)
+        db.commit()
+        
+        plate_list_service.reload()
+        log_admin_action(
+            db=db,
+            session_id=session_id,
+            action_type=f"plate_list_{list_type}",
+            action_detail=f"Added {canonical} to {list_type} list",
+            request=request
+        )
+        
+        return JSONResponse(content={"success": True, "id": entry.id, "license_plate": canonical, "list_type": list_type})
+    except Exception as e:
+        db.rollback()
+        return JSONResponse(
+            content={"success": False, "error": str(e)},
+            status_code=500
+        )
+
+@router.post("/plate-lists/remove")
+async def remove_plate_list_entry(
+    request: Request,
+    plate: str = Form(...),
+    session_id: Optional[str] = Cookie(None),
+    db: Session = Depends(get_db)
+):
+    """Remove a plate from the allow/deny lists (admin only)"""
+    if not verify_session(session_id):
+        return _unauthorized()
+    
+    canonical = normalize_plate(plate)
+    try:
+        # Chỉ đánh dấu inactive để reload tăng dần nhận được thay đổi
+        entries = db.query(PlateListEntry).filter(
+            PlateListEntry.license_plate == canonical,
+            PlateListEntry.is_active == True
+        ).all()
+        if not entries:
+            return JSONResponse(
+                content={"success": False, "error": "Plate not found in any list"},
+                status_code=404
+            )
+        for entry in entries:
+            entry.is_active = False
+        db.commit()
+        
+        plate_list_service.reload()
+        log_admin_action(
+            db=db,
+            session_id=session_id,
+            action_type="plate_list_remove",
+            action_detail=f"Removed {canonical} from plate lists",
+            request=request
+        )
+        
+        return JSONResponse(content={"success": True, "license_plate": canonical})
+    except Exception as e:
+        db.rollback()
+        return JSONResponse(
+            content={"success": False, "error": str(e)},
+            status_code=500
+        )
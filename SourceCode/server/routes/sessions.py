@@ -0,0 +1,107 @@
+from fastapi import APIRouter, Depends, Request, Form, Cookie
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import Session
+from typing import Optional
+import asyncio
+from models import get_db, ParkingSession
+from session_manager import verify_session
+from routes.dashboard import log_admin_action
+from services.tariff_service import tariff_service
+from services.parking_session_service import parking_session_service, session_to_dict
+from services.plate_index import normalize_plate
+
+router = APIRouter(prefix="/api")
+
+@router.get("/sessions/current")
+async def get_current_sessions():
+    # Danh sách xe đang trong bãi (từ bộ nhớ, không quét DB)
+    sessions = parking_session_service.current()
+    return {
+        "success": True,
+        "count": len(sessions),
+        "sessions": sessions
+    }
+
+@router.get("/sessions")
+async def get_sessions(plate: Optional[str] = None, limit: int = 50, db: Session = Depends(get_db)):
+    # Lịch sử lượt gửi xe, lọc theo biển số nếu có
+    try:
+        query = db.query(ParkingSession)
+        if plate:
+            query = query.filter(ParkingSession.license_plate == normalize_plate(plate))
+        sessions = query.order_by(ParkingSession.entry_time.desc()).limit(limit).all()
+        return {
+            "success": True,
+            "count": len(sessions),
+            "sessions": [session_to_dict(s) for s in sessions]
+        }
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": str(e)}
+        )
+
+@router.get("/sessions/stats")
+async def get_session_stats():
+    return {"success": True, "stats": parking_session_service.stats(), "tariff": tariff_service.stats()}
+
+@router.get("/sessions/{session_id}")
+async def get_session(session_id: int, db: Session = Depends(get_db)):
+    # Chi tiết một lượt gửi xe kèm thời lượng
+    try:
+        session = db.query(ParkingSession).filter(ParkingSession.id == session_id).first()
+        if not session:
+            return JSONResponse(status_code=404, content={"success": False, "error": "Session not found"})
+        return {"success": True, "session": session_to_dict(session)}
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": str(e)}
+        )
+
+@router.get("/admin/settlement")
+async def get_settlement(date: str, session_id: Optional[str] = Cookie(None)):
+    # Quyết toán doanh thu một ngày (admin only)
+    if not verify_session(session_id):
+        return JSONResponse(status_code=401, content={"success": False, "error": "Unauthorized"})
+    
+    try:
+        report = await asyncio.to_thread(tariff_service.settle, date)
+        return {"success": True, "settlement": report}
+    except ValueError:
+        return JSONResponse(status_code=400, content={"success": False, "error": "date must be YYYY-MM-DD"})
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": str(e)}
+        )
+
+@router.post("/admin/tariff/reprice")
+async def reprice_sessions(
+    request: Request,
+    date_from: str = Form(...),
+    date_to: str = Form(...),
+    session_id: Optional[str] = Cookie(None),
+    db: Session = Depends(get_db)
+):
+    # Tính lại phí theo biểu phí hiện tại (admin only)
+    if not verify_session(session_id):
+        return JSONResponse(status_code=401, content={"success": False, "error": "Unauthorized"})
+    
+    try:
+        result = await asyncio.to_thread(tariff_service.reprice, date_from, date_to)
+        log_admin_action(
+            db=db,
+            session_id=session_id,
+            action_type="tariff_reprice",
+            action_detail=f"Repriced {result['sessions']} sessions {date_from}..{date_to} (version {result['tariff_version']})",
+            request=request
+        )
+        return {"success": True, "result": result}
+    except ValueError:
+        return JSONResponse(status_code=400, content={"success": False, "error": "dates must be YYYY-MM-DD"})
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": str(e)}
+        )
@@ -1,29 +1,44 @@
 from fastapi import APIRouter, Depends
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
-from datetime import datetime
 from models import get_db, ParkingSlot
-from services import websocket_service
+from services.slot_update_service import slot_update_service
 
 router = APIRouter(prefix="/api")
 
+def _slot_to_dict(slot: ParkingSlot, live=None):
+    is_occupied = live["occupied"] if live else slot.is_occupied
+    last_updated = live["updated"] if live and live.get("updated") else slot.last_updated
+    return {
+        "id": slot.id,
+        "slot_number": slot.slot_number,
+        "is_occupied": is_occupied,
+        "last_updated": last_updated.isoformat() if last_updated else None
+    }
+
 @router.get("/slots")
 async def get_slots(db: Session = Depends(get_db)):
     # API lấy danh sách slots
     try:
         slots = db.query(ParkingSlot).all()
+        
+        # Trạng thái trong bộ nhớ mới hơn DB tối đa một chu kỳ flush
+        live = slot_update_service.snapshot()
+        items = [_slot_to_dict(s, live.pop(s.slot_number, None)) for s in slots]
+        
+        # Slot mới chỉ có trong bộ nhớ (chưa được flush xuống DB)
+        for slot_number, state in sorted(live.items()):
+            items.append({
+                "id": None,
+                "slot_number": slot_number,
+                "is_occupied": state["occupied"],
+                "last_updated": state["updated"].isoformat() if state.get("updated") else None
+            })
+        
         return {
             "success": True,
-            "count": len(slots),
-            "slots": [
-                {
-                    "id": s.id,
-                    "slot_number": s.slot_number,
-                    "is_occupied": s.is_occupied,
-                    "last_updated": s.last_updated.isoformat() if s.last_updated else None
-                }
-                for s in slots
-            ]
+            "count": len(items),
+            "slots": items
         }
     except Exception as e:
         return JSONResponse(
@@ -38,31 +53,13 @@ async def update_slot(
     db: Session = Depends(get_db)
 ):
     # API cập nhật trạng thái slot (không sử dụng vì đang dùng MQTT)
+    # Đi qua cùng đường write-behind với MQTT: cập nhật bộ nhớ + broadcast, DB được ghi ở lần flush kế tiếp
+    # Cập nhật thủ công không qua filter cảm biến (áp dụng ngay)
     try:
-        slot = db.query(ParkingSlot).filter(ParkingSlot.slot_number == slot_number).first()
-        
-        if slot:
-            slot.is_occupied = is_occupied
-            slot.last_updated = datetime.utcnow()
-        else:
-            slot = ParkingSlot(
-                slot_number=slot_number,
-                is_occupied=is_occupied
-            )
-            db.add(slot)
-        
-        db.commit()
+        slot_update_service.set_manual(slot_number, is_occupied)
         
         print(f"[SLOT] Updated: {slot_number} -> {'OCCUPIED' if is_occupied else 'FREE'}")
         
-        # Broadcast WebSocket
-        await websocket_service.broadcast({
-            'type': 'slot_update',
-            'slot': slot_number,
-            'occupied': is_occupied,
-            'timestamp': datetime.utcnow().isoformat()
-        })
-        
         return {
             "success": True,
             "message": f"Slot {slot_number} updated"
@@ -2,14 +2,17 @@ from fastapi import APIRouter, File, UploadFile, Form, Depends
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from datetime import datetime
-import os
-import json
-import shutil
+from typing import List, Optional
+import asyncio
 
 from config import settings
-from models import get_db, VehicleLog
+from models import get_db
 from services.ocr_service import ocr_service
-from services import websocket_service, gate_service
+from services.ocr_job_service import ocr_job_service
+from services.plate_pipeline import process_plate_image
+from services.image_preprocess import image_preprocessor
+from services.frame_quality import frame_quality_checker
+from services import gate_service
 
 router = APIRouter(prefix="/api")
 
@@ -24,34 +27,75 @@ async def test_upload():
         "timestamp": datetime.now().isoformat()
     }
 
+@router.get("/ocr/stats")
+async def ocr_stats():
+
+    # Thống kê OCR (cache hit/miss, hàng đợi job, tiền xử lý ảnh, quality gate)
+    return {
+        "success": True,
+        "ocr": ocr_service.stats(),
+        "jobs": ocr_job_service.stats(),
+        "preprocess": image_preprocessor.stats(),
+        "quality": frame_quality_checker.stats()
+    }
+
+@router.get("/ocr-jobs/{job_id}")
+async def get_ocr_job(job_id: str):
+    
+    # Trạng thái một OCR job (chế độ upload async)
+    job = ocr_job_service.get(job_id)
+    if not job:
+        return JSONResponse(
+            status_code=404,
+            content={"success": False, "error": "Job not found"}
+        )
+    
+    return {
+        "success": True,
+        "job": job
+    }
+
 @router.post("/upload-image")
 async def upload_image(
-    file: UploadFile = File(...), 
+    file: Optional[UploadFile] = File(None), 
+    frames: Optional[List[UploadFile]] = File(None),
     direction: str = Form("in"),
+    mode: str = Form(None),
     db: Session = Depends(get_db)
 ):
     
     # ESP32 gửi POST request với multipart/form-data
+    # Burst: nhiều part "frames" cho cùng một lượt xe (có thể kèm "file")
+    uploads = ([file] if file else []) + list(frames or [])
+    uploads = uploads[:getattr(settings, "UPLOAD_MAX_BURST", 5)]
+    
     print(f"\n{'='*50}")
     print(f"[UPLOAD] NEW REQUEST RECEIVED")
-    print(f"[UPLOAD] Filename: {file.filename}")
-    print(f"[UPLOAD] Content-Type: {file.content_type}")
+    print(f"[UPLOAD] Frames: {len(uploads)}")
+    for upload in uploads:
+        print(f"[UPLOAD] Filename: {upload.filename}")
+        print(f"[UPLOAD] Content-Type: {upload.content_type}")
     print(f"[UPLOAD] Direction: {direction}")
     
     try:
-        # Đọc nội dung ảnh
-        image_bytes = await file.read()
-        image_size = len(image_bytes)
-        print(f"[UPLOAD] Image read successfully")
-        print(f"[UPLOAD] Size: {image_size} bytes ({image_size/1024:.2f} KB)")
-        
-        # Check magic bytes (JPEG starts with FF D8 FF)
-        if image_size > 3:
-            header = image_bytes[:3].hex()
-            print(f"[UPLOAD] Magic bytes: {header} (should be 'ffd8ff' for JPEG)")
+        # Đọc nội dung ảnh, bỏ các frame quá nhỏ
+        burst = []
+        for upload in uploads:
+            image_bytes = await upload.read()
+            image_size = len(image_bytes)
+            print(f"[UPLOAD] Image read successfully")
+            print(f"[UPLOAD] Size: {image_size} bytes ({image_size/1024:.2f} KB)")
+            
+            # Check magic bytes (JPEG starts with FF D8 FF)
+            if image_size > 3:
+                header = image_bytes[:3].hex()
+                print(f"[UPLOAD] Magic bytes: {header} (should be 'ffd8ff' for JPEG)")
+            
+            if image_size >= 1000:
+                burst.append(image_bytes)
         
         # Kiểm tra kích thước
-        if image_size < 1000:
+        if not burst:
             print("[UPLOAD] Image too small")
             return JSONResponse(
                 status_code=400,
@@ -63,141 +107,67 @@ async def upload_image(
                 }
             )
         
-        # Lưu ảnh vào TEMP
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        temp_filename = f"temp_{timestamp}.jpg"
-        temp_path = os.path.join(settings.TEMP_DIR, temp_filename)
-        
-        print(f"[UPLOAD] Saving to: {temp_path}")
+        # Kiểm tra chất lượng frame trước khi tốn OCR
+        checks = await asyncio.gather(*(frame_quality_checker.check_async(frame) for frame in burst))
+        usable = [frame for frame, check in zip(burst, checks) if check["ok"]]
         
-        with open(temp_path, 'wb') as f:
-            bytes_written = f.write(image_bytes)
-        
-        # Verify file was written
-        if os.path.exists(temp_path):
-            actual_size = os.path.getsize(temp_path)
-            print(f"[UPLOAD] File saved successfully")
-            print(f"[UPLOAD] Expected: {image_size} bytes, Written: {bytes_written} bytes, Disk: {actual_size} bytes")
-            
-            if actual_size != image_size:
-                print(f"[UPLOAD] WARNING: Size mismatch!")
-        else:
-            print(f"[UPLOAD] ERROR: File not found after write!")
-            raise Exception("Failed to save temp file")
-        
-        # Gọi OCR API
-        print("[OCR] Processing...")
-        result = ocr_service.recognize_plate(image_bytes)
-        
-        if result:
-            plate = result.get('plate', 'UNKNOWN')
-            confidence = result.get('confidence', 0)
-            
-            print(f"[OCR] Success Plate: {plate} (confidence: {confidence:.2f})")
+        if not usable:
+            reason = checks[0]["reason"]
+            print(f"[QUALITY] Frame rejected: {reason} {checks[0]['metrics']}")
             
-            # Lưu vào ARCHIVE nếu đạt ngưỡng
-            if plate != 'UNKNOWN' and confidence > 0.5:
-                archive_filename = f"{plate}_{timestamp}.jpg"
-                archive_path = os.path.join(settings.ARCHIVE_DIR, archive_filename)
-                
-                shutil.move(temp_path, archive_path)
-                print(f"[ARCHIVE] Moved to archive: {archive_path}")
-                
-                final_path = archive_path
-            else:
-                # Low confidence - xóa ảnh temp
-                print("[ARCHIVE] Low confidence")
-                try:
-                    # os.remove(temp_path)
-                    # print("[CLEANUP] Temp file deleted")
-                    archive_filename = f"{timestamp}.jpg"
-                    archive_path = os.path.join(settings.TEMP_DIR, archive_filename)
-                
-                    shutil.move(temp_path, archive_path)
-                    print(f"[TEMP] Moved to temp: {archive_path}")
-
-                except Exception as e:
-                    print(f"[CLEANUP] Cannot delete temp: {e}")
-                
-                final_path = None
-            
-            # Lưu vào database khi thành công
-            if final_path:
-                try:
-                    # Xác định action dựa vào direction
-                    action = "entry" if direction == "in" else "exit"
-                    
-                    log = VehicleLog(
-                        license_plate=plate,
-                        image_path=final_path,
-                        ocr_result=json.dumps(result),
-                        confidence=str(confidence),
-                        action=action
-                    )
-                    db.add(log)
-                    db.commit()
-                    db.refresh(log)
-                    print(f"[DATABASE] SUCCESS Saved (ID: {log.id}, Action: {action})")
-                except Exception as db_error:
-                    print(f"[DATABASE] Error: {db_error}")
-            else:
-                print("[DATABASE] Skipped - low confidence")
-            
-            # Broadcast WebSocket
-            await websocket_service.broadcast({
-                'type': 'new_vehicle',
-                'plate': plate,
-                'confidence': confidence,
-                'timestamp': datetime.now().isoformat()
-            })
-            
-            # Điều khiển GATE qua MQTT
+            # CAM không đọc response: reject ngay để GATE không phải chờ OCR_TIMEOUT, IR trigger lại camera
             if gate_service:
-                gate_result = gate_service.process_ocr_result(plate, confidence)
-                gate_action = gate_result.get('action', 'none')
-            else:
-                gate_action = "none"
-                print("[GATE] ERROR Gate service not available")
+                await gate_service.send_reject_command(f"bad_frame: {reason}", direction)
             
             print(f"{'='*50}\n")
-            
-            # Trả response cho ESP32-CAM
             return JSONResponse(
                 status_code=200,
                 content={
-                    "success": True,
-                    "plate": plate,
-                    "confidence": confidence,
-                    "message": f"Biển số: {plate}",
-                    "action": gate_action,
-                    "saved_path": final_path
+                    "success": False,
+                    "error": "LOW_QUALITY_FRAME",
+                    "reason": reason,
+                    "metrics": checks[0]["metrics"],
+                    "message": "Ảnh không đủ chất lượng",
+                    "action": "reject"
                 }
             )
-        else:
-            print("[OCR] Failed")
-            
-            # Xóa temp file
-            try:
-                os.remove(temp_path)
-                print("[CLEANUP] Temp file deleted (OCR failed)")
-            except Exception as e:
-                print(f"[CLEANUP] Cannot delete temp: {e}")
+        burst = usable
+        
+        # Chế độ async: trả job id ngay, worker xử lý OCR và điều khiển GATE qua MQTT
+        upload_mode = mode or getattr(settings, "UPLOAD_MODE", "sync")
+        if upload_mode == "async":
+            job = ocr_job_service.submit(burst, direction)
             
-            # Gửi lệnh reject cho GATE
-            if gate_service:
-                gate_service.send_reject_command("OCR failed")
+            if not job:
+                print(f"{'='*50}\n")
+                return JSONResponse(
+                    status_code=503,
+                    content={
+                        "success": False,
+                        "error": "QUEUE_FULL",
+                        "message": "Hàng đợi OCR đầy",
+                        "action": "retry"
+                    }
+                )
             
             print(f"{'='*50}\n")
-            
             return JSONResponse(
-                status_code=200,
+                status_code=202,
                 content={
-                    "success": False,
-                    "error": "OCR_FAILED",
-                    "message": "Không đọc được biển số",
-                    "action": "reject"
+                    "success": True,
+                    "job_id": job["job_id"],
+                    "status": job["status"],
+                    "status_url": f"/api/ocr-jobs/{job['job_id']}",
+                    "action": "queued"
                 }
             )
+        
+        status_code, content = await process_plate_image(burst, direction, db)
+        
+        print(f"{'='*50}\n")
+        
+        # Trả response cho ESP32-CAM
+        return JSONResponse(status_code=status_code, content=content)
     
     except Exception as e:
         print(f"[ERROR] {str(e)}")
@@ -205,7 +175,7 @@ async def upload_image(
         
         # Gửi lệnh reject cho GATE
         if gate_service:
-            gate_service.send_reject_command(f"Error: {str(e)}")
+            await gate_service.send_reject_command(f"Error: {str(e)}", direction)
         
         return JSONResponse(
             status_code=500,
@@ -1,7 +1,12 @@
-from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, Request, Cookie
+from fastapi.responses import JSONResponse, FileResponse, Response
 from sqlalchemy.orm import Session
+from typing import Optional
+import json
 from models import get_db, VehicleLog
+from session_manager import verify_session
+from services.plate_index import plate_index, normalize_plate, format_plate
+from services.thumbnail_service import thumbnail_service, plate_crop_box, THUMBNAIL_SIZES, THUMBNAIL_KINDS
 
 router = APIRouter(prefix="/api")
 
@@ -17,6 +22,7 @@ async def get_vehicles(limit: int = 50, db: Session = Depends(get_db)):
                 {
                     "id": v.id,
                     "license_plate": v.license_plate,
+                    "raw_plate": v.raw_plate,
                     "confidence": v.confidence,
                     "action": v.action,
                     "timestamp": v.timestamp.isoformat() if v.timestamp else None
@@ -29,3 +35,79 @@ async def get_vehicles(limit: int = 50, db: Session = Depends(get_db)):
             status_code=500,
             content={"success": False, "error": str(e)}
         )
+
+@router.get("/vehicles/search")
+async def search_vehicles(plate: str, limit: int = 5, db: Session = Depends(get_db)):
+    # Tìm xe theo biển số, chấp nhận lỗi OCR (dấu, O/0, B/8, thiếu/thừa 1 ký tự)
+    try:
+        normalized = normalize_plate(plate)
+        candidates = []
+        for candidate, cost in plate_index.nearest(normalized, limit=limit):
+            last = db.query(VehicleLog).filter(
+                VehicleLog.license_plate == candidate
+            ).order_by(VehicleLog.timestamp.desc()).first()
+            candidates.append({
+                "plate": candidate,
+                "display": format_plate(candidate),
+                "cost": cost,
+                "last_seen": last.timestamp.isoformat() if last and last.timestamp else None,
+                "last_action": last.action if last else None
+            })
+        
+        return {
+            "success": True,
+            "query": plate,
+            "normalized": normalized,
+            "display": format_plate(normalized),
+            "candidates": candidates
+        }
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": str(e)}
+        )
+
+@router.get("/vehicles/{log_id}/thumbnail")
+async def get_vehicle_thumbnail(
+    log_id: int,
+    request: Request,
+    kind: str = "plate",
+    size: str = "small",
+    session_id: Optional[str] = Cookie(None),
+    db: Session = Depends(get_db)
+):
+    # Thumbnail ảnh biển số / ảnh xe (admin only, ảnh có biển số)
+    if not verify_session(session_id):
+        return JSONResponse(status_code=401, content={"success": False, "error": "Unauthorized"})
+    
+    if kind not in THUMBNAIL_KINDS or size not in THUMBNAIL_SIZES:
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "error": f"kind must be {THUMBNAIL_KINDS}, size must be {tuple(THUMBNAIL_SIZES)}"}
+        )
+    
+    # Thumbnail bất biến theo (log_id, kind, size): trả 304 mà không cần đọc DB
+    etag = thumbnail_service.etag(log_id, kind, size)
+    cache_headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+    
+    try:
+        log = db.query(VehicleLog).filter(VehicleLog.id == log_id).first()
+        if not log or not log.image_path:
+            return JSONResponse(status_code=404, content={"success": False, "error": "Image not found"})
+        
+        crop_box = None
+        if kind == "plate" and log.ocr_result:
+            crop_box = plate_crop_box(json.loads(log.ocr_result))
+        
+        path = await thumbnail_service.get_thumbnail(log.id, log.image_path, kind, size, crop_box)
+        if not path:
+            return JSONResponse(status_code=404, content={"success": False, "error": "Image not found"})
+        
+        return FileResponse(path=path, media_type="image/jpeg", headers=cache_headers)
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": str(e)}
+        )
@@ -2,8 +2,10 @@ from .websocket_service import websocket_service
 from .gate_service import GateService, gate_service
 from .mosquitto_service import mosquitto_service
 from .slot_update_service import slot_update_service, SlotUpdateService
-from .mqtt_handler import MQTTHandler
+from .mqtt_handler import MQTTHandler, mqtt_manager
 from .ocr_service import ocr_service
+from .ocr_job_service import ocr_job_service
+from .plate_index import plate_index
 
 __all__ = [
     'websocket_service',
@@ -13,5 +15,8 @@ __all__ = [
     'slot_update_service',
     'SlotUpdateService',
     'MQTTHandler',
-    'ocr_service'
+    'mqtt_manager',
+    'ocr_service',
+    'ocr_job_service',
+    'plate_index'
 ]
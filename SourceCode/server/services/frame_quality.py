@@ -0,0 +1,119 @@
+import asyncio
+import io
+import threading
+from typing import Dict, Any, Optional
+
+import numpy as np
+from PIL import Image
+
+from config import settings
+
+JPEG_SOI = b"\xff\xd8\xff"
+JPEG_EOI = b"\xff\xd9"
+
+class FrameQualityChecker:
+    """
+    Kiểm tra nhanh chất lượng frame trước OCR:
+    JPEG bị cắt cụt, mờ (variance của Laplacian), quá tối/quá sáng, contrast thấp
+
+    CAM được chỉnh tối có chủ ý (brightness -2, ae_level -2, aec 150, gainceiling 0) để biển số phản quang
+    không bị cháy sáng, nên nền ảnh ban đêm gần đen. Ngưỡng mặc định chỉ loại frame chắc chắn không đọc được;
+    Laplacian variance tỷ lệ với bình phương độ sáng nên ngưỡng độ nét cũng thấp tương ứng
+    """
+    def __init__(
+        self,
+        min_sharpness: float = 15.0,
+        min_brightness: float = 12.0,
+        max_brightness: float = 220.0,
+        min_contrast: float = 8.0,
+        max_clipped_ratio: float = 0.4,
+        max_dark_ratio: float = 0.9,
+        analysis_width: int = 320,
+        enabled: bool = True
+    ):
+        self.min_sharpness = min_sharpness
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.min_contrast = min_contrast
+        self.max_clipped_ratio = max_clipped_ratio
+        self.max_dark_ratio = max_dark_ratio
+        self.analysis_width = analysis_width
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self.passed = 0
+        self.rejected: Dict[str, int] = {}
+
+    def check(self, image_bytes: bytes) -> Dict[str, Any]:
+        """
+        Returns: {"ok": bool, "reason": None | "truncated" | "corrupt" | "blurry" | "too_dark"
+                  | "overexposed" | "low_contrast", "metrics": {...}}
+        """
+        # JPEG phải bắt đầu bằng SOI và kết thúc bằng EOI
+        if not image_bytes.startswith(JPEG_SOI) or JPEG_EOI not in image_bytes[-16:]:
+            return self._result(False, "truncated", {})
+
+        try:
+            img = Image.open(io.BytesIO(image_bytes))
+            img.draft('L', (self.analysis_width, self.analysis_width))
+            gray = np.asarray(img.convert('L'), dtype=np.float32)
+        except Exception:
+            return self._result(False, "corrupt", {})
+
+        # Laplacian 4-lân cận bằng slicing (không cần OpenCV)
+        laplacian = (
+            gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+            - 4.0 * gray[1:-1, 1:-1]
+        )
+        histogram = np.bincount(gray.astype(np.uint8).ravel(), minlength=256)
+        total = histogram.sum()
+
+        metrics = {
+            "sharpness": round(float(laplacian.var()), 2),
+            "brightness": round(float(gray.mean()), 2),
+            "contrast": round(float(gray.std()), 2),
+            "dark_ratio": round(float(histogram[:16].sum() / total), 3),
+            "bright_ratio": round(float(histogram[240:].sum() / total), 3)
+        }
+
+        if metrics["brightness"] < self.min_brightness or metrics["dark_ratio"] > self.max_dark_ratio:
+            return self._result(False, "too_dark", metrics)
+        if metrics["brightness"] > self.max_brightness or metrics["bright_ratio"] > self.max_clipped_ratio:
+            return self._result(False, "overexposed", metrics)
+        if metrics["contrast"] < self.min_contrast:
+            return self._result(False, "low_contrast", metrics)
+        if metrics["sharpness"] < self.min_sharpness:
+            return self._result(False, "blurry", metrics)
+
+        return self._result(True, None, metrics)
+
+    async def check_async(self, image_bytes: bytes) -> Dict[str, Any]:
+        if not self.enabled:
+            return {"ok": True, "reason": None, "metrics": {}}
+        return await asyncio.to_thread(self.check, image_bytes)
+
+    def _result(self, ok: bool, reason: Optional[str], metrics: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            if ok:
+                self.passed += 1
+            else:
+                self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return {"ok": ok, "reason": reason, "metrics": metrics}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "passed": self.passed,
+                "rejected": dict(self.rejected)
+            }
+
+# Singleton instance
+frame_quality_checker = FrameQualityChecker(
+    min_sharpness=getattr(settings, "QUALITY_MIN_SHARPNESS", 15.0),
+    min_brightness=getattr(settings, "QUALITY_MIN_BRIGHTNESS", 12.0),
+    max_brightness=getattr(settings, "QUALITY_MAX_BRIGHTNESS", 220.0),
+    min_contrast=getattr(settings, "QUALITY_MIN_CONTRAST", 8.0),
+    max_dark_ratio=getattr(settings, "QUALITY_MAX_DARK_RATIO", 0.9),
+    enabled=getattr(settings, "QUALITY_CHECK_ENABLED", True)
+)
@@ -1,17 +1,273 @@
-from typing import Dict, Any
+from typing import Dict, Any, Tuple, Optional, List
+from collections import OrderedDict, deque
 from datetime import datetime
+import asyncio
+import threading
+import time
+import uuid
+
+from config import settings
+from .plate_list_service import plate_list_service
+from .websocket_service import websocket_service
+
+GATE_CONTROL_TOPIC = "iot/parking/gate/control"
+GATE_STATUS_TOPIC = "iot/parking/gate/status"
+
+# Status mà GATE.ino gửi khi đã thực hiện lệnh
+EXPECTED_STATUS = {
+    "open": ("open",),
+    "reject": ("rejected",),
+    "manual": ("override",)
+}
 
 class GateService:
-    def __init__(self, mqtt_handler=None):
+    def __init__(
+        self,
+        mqtt_handler=None,
+        list_mode: str = "open",
+        allow_list_threshold: float = 0.3,
+        ack_timeout: float = 3.0,
+        max_retries: int = 2,
+        open_duration: float = 5.0,
+        open_window: float = 10.0,
+        reject_window: float = 3.0,
+        history_size: int = 200
+    ):
         self.mqtt_handler = mqtt_handler
+        # "open": mọi xe đủ confidence được vào; "allow_only": chỉ xe trong allow list
+        self.list_mode = list_mode
+        self.allow_list_threshold = allow_list_threshold
+        
+        # Theo dõi lệnh: cmd_id gửi kèm lệnh, GATE trả lại trong status
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        # Thời gian GATE giữ cổng mở (GATE_OPEN_DURATION trong firmware): quá thời gian này không gửi lại lệnh mở
+        self.open_duration = open_duration
+        self._lock = threading.Lock()
+        self._pending: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._failed = deque(maxlen=100)
+        self._recent = deque(maxlen=100)
+        self._latencies_ms = deque(maxlen=500)
+        self.acked = 0
+        self.retried = 0
+        self.failed = 0
+        self.uncorrelated_status = 0
+        self.last_status: Optional[Dict[str, Any]] = None
+        
+        # Debounce theo cổng (direction): bỏ lệnh open trùng biển số, gộp chuỗi reject liên tiếp
+        self.open_window = open_window
+        self.reject_window = reject_window
+        self._last_open: Dict[str, Tuple[str, float, Optional[str]]] = {}  # gate -> (plate, time, cmd_id)
+        self._last_reject: Dict[str, Tuple[float, Optional[str]]] = {}    # gate -> (time, cmd_id)
+        self._history = deque(maxlen=history_size)
+        self.suppressed_opens = 0
+        self.coalesced_rejects = 0
+        self.external_commands = 0
     
-    def send_open_command(self, plate: str, confidence: float) -> bool:
+    def attach(self, mqtt_handler):
         
-        # Gửi lệnh mở cổng qua MQTT
+        # Gắn MQTT handler, nhận status từ GATE và lệnh từ thiết bị khác (MONITOR) trên topic control
+        self.mqtt_handler = mqtt_handler
+        if mqtt_handler:
+            mqtt_handler.add_handler(GATE_STATUS_TOPIC, self.handle_status)
+            mqtt_handler.add_handler(GATE_CONTROL_TOPIC, self.handle_external_command)
+    
+    # Debounce
+    
+    def _record(self, gate: str, action: str, outcome: str, plate: Optional[str] = None, cmd_id: Optional[str] = None, **details):
+        entry = {
+            "time": datetime.now().isoformat(),
+            "gate": gate,
+            "action": action,
+            "outcome": outcome,
+            "plate": plate,
+            "cmd_id": cmd_id
+        }
+        entry.update(details)
+        with self._lock:
+            self._history.append(entry)
+        websocket_service.queue_broadcast(dict(entry, type='gate_status', event='decision'))
+    
+    def _duplicate_open(self, gate: str, plate: str) -> Optional[Tuple[str, float, Optional[str]]]:
+        last = self._last_open.get(gate)
+        if last and last[0] == plate and time.monotonic() - last[1] < self.open_window:
+            return last
+        return None
+    
+    def _coalesced_reject(self, gate: str) -> Optional[Tuple[float, Optional[str]]]:
+        last = self._last_reject.get(gate)
+        if last and time.monotonic() - last[0] < self.reject_window:
+            return last
+        return None
+    
+    def handle_external_command(self, data: Dict[str, Any]):
+        
+        # Lệnh do thiết bị khác publish lên topic control (vd. MONITOR mở cổng thủ công); lệnh của server có cmd_id
+        if data.get("cmd_id"):
+            return
+        self.external_commands += 1
+        self._record(data.get("direction") or "manual", data.get("action", "unknown"), "external", source=data.get("source"))
+    
+    def history(self, limit: int = 50) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._history)[-limit:][::-1]
+    
+    # Command tracking
+    
+    async def send_command(self, action: str, message: Dict[str, Any]) -> Optional[str]:
+        """
+        Gửi lệnh có cmd_id tới GATE và theo dõi phản hồi trên topic status (retry với backoff nếu không có phản hồi)
+        
+        Returns: cmd_id nếu broker đã nhận lệnh, None nếu publish thất bại
+        """
         if not self.mqtt_handler:
             print("[GATE] ERROR MQTT handler not available")
-            return False
+            return None
+        
+        cmd_id = uuid.uuid4().hex[:12]
+        message["cmd_id"] = cmd_id
+        command = {
+            "cmd_id": cmd_id,
+            "action": action,
+            "plate": message.get("plate"),
+            "expected": EXPECTED_STATUS[action],
+            "created_at": datetime.now().isoformat(),
+            "attempts": 1,
+            "state": "pending",
+            "sent_at": time.monotonic(),
+            "ack": asyncio.get_running_loop().create_future()
+        }
+        with self._lock:
+            self._pending[cmd_id] = command
+        
+        if not await self.mqtt_handler.publish_async(GATE_CONTROL_TOPIC, message):
+            self._finish(command, "failed", error="publish_failed")
+            return None
+        
+        asyncio.create_task(self._await_ack(command, message))
+        return cmd_id
+    
+    async def _await_ack(self, command: Dict[str, Any], message: Dict[str, Any]):
+        
+        # Chờ phản hồi, gửi lại lệnh với timeout tăng dần (3s, 6s, 12s...)
+        for attempt in range(self.max_retries + 1):
+            try:
+                status = await asyncio.wait_for(asyncio.shield(command["ack"]), self.ack_timeout * 2 ** attempt)
+            except asyncio.TimeoutError:
+                if attempt == self.max_retries or command["state"] != "pending":
+                    break
+                if command["action"] in ("open", "manual") and time.monotonic() - command["sent_at"] >= self.open_duration:
+                    # Cổng có thể đã mở rồi tự đóng: gửi lại sẽ mở lại barrier sau khi xe đã qua
+                    print(f"[GATE] No ack for {command['action']} {command['cmd_id']} within gate open duration, not retrying")
+                    break
+                command["attempts"] += 1
+                self.retried += 1
+                print(f"[GATE] No ack for {command['action']} {command['cmd_id']}, retry {attempt + 1}/{self.max_retries}")
+                await self.mqtt_handler.publish_async(GATE_CONTROL_TOPIC, message)
+                continue
+            
+            latency_ms = (time.monotonic() - command["sent_at"]) * 1000
+            self._latencies_ms.append(latency_ms)
+            self.acked += 1
+            self._finish(command, "acked", status=status, latency_ms=round(latency_ms, 1))
+            print(f"[GATE] SUCCESS {command['action']} {command['cmd_id']} acknowledged ({status}) in {latency_ms:.0f}ms")
+            return
+        
+        self._finish(command, "failed", error="no_ack")
+        print(f"[GATE] ERROR {command['action']} {command['cmd_id']} not acknowledged after {command['attempts']} attempt(s)")
+    
+    def _finish(self, command: Dict[str, Any], state: str, **details):
+        with self._lock:
+            self._pending.pop(command["cmd_id"], None)
+            command["state"] = state
+            command.update(details)
+            if state == "failed":
+                self.failed += 1
+                self._failed.append(command)
+            else:
+                self._recent.append(command)
+    
+    def handle_status(self, data: Dict[str, Any]):
+        """
+        Callback từ MQTT thread cho iot/parking/gate/status
+        Ghép theo cmd_id; firmware cũ không gửi cmd_id -> ghép lệnh pending cũ nhất chờ đúng status này
+        """
+        status = data.get("status") or ("override" if data.get("override") else None)
+        self.last_status = dict(data, received_at=datetime.now().isoformat())
+        websocket_service.queue_broadcast(dict(self.last_status, type='gate_status', event='device'))
+        
+        with self._lock:
+            command = self._pending.get(data.get("cmd_id")) if data.get("cmd_id") else None
+            if command is None:
+                command = next(
+                    (c for c in self._pending.values() if status in c["expected"] and not c["ack"].done()),
+                    None
+                )
+        
+        if command is None:
+            if status in ("open", "rejected", "override"):
+                self.uncorrelated_status += 1
+            return
+        
+        future = command["ack"]
+        future.get_loop().call_soon_threadsafe(self._resolve, future, status)
+    
+    @staticmethod
+    def _resolve(future: asyncio.Future, status: str):
+        if not future.done():
+            future.set_result(status)
+    
+    @staticmethod
+    def _public(command: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in command.items() if key not in ("ack", "expected", "sent_at")}
+    
+    def commands(self) -> Dict[str, Any]:
         
+        # Lệnh đang chờ, lệnh thất bại, lệnh gần đây và phân bố độ trễ lệnh -> cổng
+        latencies = sorted(self._latencies_ms)
+        percentile = lambda p: round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 1)
+        now = time.monotonic()
+        with self._lock:
+            pending: List[Dict[str, Any]] = [
+                dict(self._public(c), waiting_ms=round((now - c["sent_at"]) * 1000)) for c in self._pending.values()
+            ]
+            failed = [self._public(c) for c in reversed(self._failed)]
+            recent = [self._public(c) for c in reversed(self._recent)]
+        return {
+            "pending": pending,
+            "failed": failed,
+            "recent": recent,
+            "stats": {
+                "acked": self.acked,
+                "retried": self.retried,
+                "failed": self.failed,
+                "uncorrelated_status": self.uncorrelated_status,
+                "suppressed_opens": self.suppressed_opens,
+                "coalesced_rejects": self.coalesced_rejects,
+                "external_commands": self.external_commands,
+                "latency_ms": {
+                    "p50": percentile(0.5),
+                    "p90": percentile(0.9),
+                    "p99": percentile(0.99),
+                    "max": round(latencies[-1], 1)
+                } if latencies else None
+            },
+            "last_status": self.last_status
+        }
+    
+    # Commands
+    
+    async def send_open_command(self, plate: str, confidence: float, direction: str = "in") -> Optional[str]:
+        
+        # Bỏ qua lệnh open trùng: cùng cổng, cùng biển số trong open_window (nhiều upload cho cùng một xe)
+        duplicate = self._duplicate_open(direction, plate)
+        if duplicate:
+            self.suppressed_opens += 1
+            self._record(direction, "open", "suppressed", plate, duplicate[2])
+            print(f"[GATE] Duplicate OPEN suppressed - Plate: {plate} ({direction})")
+            return duplicate[2]
+        
+        # Gửi lệnh mở cổng qua MQTT
         message = {
             "action": "open",
             "plate": plate,
@@ -19,36 +275,98 @@ class GateService:
             "timestamp": datetime.now().isoformat()
         }
         
-        success = self.mqtt_handler.publish("iot/parking/gate/control", message)
+        # Đánh dấu trước khi publish để chặn upload đồng thời; publish lỗi thì bỏ đánh dấu để camera gửi lại được
+        pending = (plate, time.monotonic(), None)
+        self._last_open[direction] = pending
+        cmd_id = await self.send_command("open", message)
+        self._record(direction, "open", "sent" if cmd_id else "failed", plate, cmd_id)
         
-        if success:
-            print(f"[GATE] SUCCESS OPEN command sent - Plate: {plate} (confidence: {confidence:.2f})")
+        if cmd_id:
+            self._last_open[direction] = (plate, pending[1], cmd_id)
+            self._last_reject.pop(direction, None)
+            print(f"[GATE] SUCCESS OPEN command sent - Plate: {plate} (confidence: {confidence:.2f}, cmd: {cmd_id})")
         else:
+            if self._last_open.get(direction) is pending:
+                self._last_open.pop(direction, None)
             print(f"[GATE] Failed to send OPEN command")
         
-        return success
+        return cmd_id
     
-    def send_reject_command(self, reason: str = "OCR failed") -> bool:
+    async def send_reject_command(self, reason: str = "OCR failed", direction: str = "in") -> Optional[str]:
         
-        # Gửi lệnh từ chối (giữ cổng đóng) qua MQTT
-        if not self.mqtt_handler:
-            print("[GATE] ERROR MQTT handler not available")
-            return False
+        # Gộp chuỗi reject liên tiếp cho cùng cổng trong reject_window thành một lệnh
+        previous = self._coalesced_reject(direction)
+        if previous:
+            self.coalesced_rejects += 1
+            self._record(direction, "reject", "coalesced", cmd_id=previous[1], reason=reason)
+            return previous[1]
         
+        # Gửi lệnh từ chối (giữ cổng đóng) qua MQTT
         message = {
             "action": "reject",
             "reason": reason,
             "timestamp": datetime.now().isoformat()
         }
         
-        success = self.mqtt_handler.publish("iot/parking/gate/control", message)
+        pending = (time.monotonic(), None)
+        self._last_reject[direction] = pending
+        cmd_id = await self.send_command("reject", message)
+        self._record(direction, "reject", "sent" if cmd_id else "failed", cmd_id=cmd_id, reason=reason)
         
-        if success:
-            print(f"[GATE] REJECT command sent - Reason: {reason}")
+        if cmd_id:
+            self._last_reject[direction] = (pending[0], cmd_id)
+            print(f"[GATE] REJECT command sent - Reason: {reason} (cmd: {cmd_id})")
         else:
+            if self._last_reject.get(direction) is pending:
+                self._last_reject.pop(direction, None)
             print(f"[GATE] Failed to send REJECT command")
         
-        return success
+        return cmd_id
+    
+    def evaluate(self, plate: str, confidence: float, threshold: float = 0.5, confirm: bool = True) -> Tuple[bool, str]:
+        """
+        Quyết định mở cổng theo danh sách biển số (trong bộ nhớ) và confidence
+        
+        Args:
+            confirm: False - không xác nhận Bloom dương tính với DB (gọi được trên event loop, vd. chọn frame)
+        
+        Returns: (có mở cổng không, rule đã khớp)
+            rule: "deny_list", "allow_list", "confidence", "no_plate", "low_confidence", "not_in_allow_list"
+        """
+        if not plate or plate == "UNKNOWN":
+            return False, "no_plate"
+        return self._decide(plate_list_service.check(plate, confirm), confidence, threshold)
+    
+    async def evaluate_async(self, plate: str, confidence: float, threshold: float = 0.5) -> Tuple[bool, str]:
+        
+        # Như evaluate(), truy vấn DB xác nhận (nếu có) chạy ngoài event loop
+        if not plate or plate == "UNKNOWN":
+            return False, "no_plate"
+        return self._decide(await plate_list_service.check_async(plate), confidence, threshold)
+    
+    @staticmethod
+    def accepted(rule: str) -> bool:
+        
+        # Biển số đọc được với confidence đạt ngưỡng áp dụng cho nó (kể cả xe bị cấm)
+        return rule not in ("no_plate", "low_confidence")
+    
+    def _decide(self, listed: Optional[str], confidence: float, threshold: float) -> Tuple[bool, str]:
+        if listed == "deny":
+            return False, "deny_list"
+        
+        # Xe trong allow list được chấp nhận với ngưỡng confidence thấp hơn
+        if listed == "allow":
+            if confidence >= min(threshold, self.allow_list_threshold):
+                return True, "allow_list"
+            return False, "low_confidence"
+        
+        if confidence < threshold:
+            return False, "low_confidence"
+        
+        if self.list_mode == "allow_only":
+            return False, "not_in_allow_list"
+        
+        return True, "confidence"
     
     def should_open_gate(self, plate: str, confidence: float, threshold: float = 0.5) -> bool:
         """
@@ -61,48 +379,62 @@ class GateService:
         
         Returns: True nếu nên mở cổng
         """
-        if not plate or plate == "UNKNOWN":
-            return False
-        
-        if confidence < threshold:
-            return False
-              
-        return True
+        return self.evaluate(plate, confidence, threshold)[0]
     
-    def process_ocr_result(self, plate: str, confidence: float) -> Dict[str, Any]:
+    async def process_ocr_result(
+        self,
+        plate: str,
+        confidence: float,
+        direction: str = "in",
+        decision: Optional[Tuple[bool, str]] = None
+    ) -> Dict[str, Any]:
         """
         Xử lý kết quả OCR và gửi lệnh điều khiển cổng
-        Returns: Dict chứa action và status
+        
+        Args:
+            decision: Kết quả evaluate đã tính trước (tránh tra danh sách lần hai)
+        
+        Returns: Dict chứa action, status và rule đã khớp
         """
-        should_open = self.should_open_gate(plate, confidence)
+        should_open, rule = decision or await self.evaluate_async(plate, confidence)
         
         if should_open:
-            success = self.send_open_command(plate, confidence)
+            suppressed = self._duplicate_open(direction, plate) is not None
+            cmd_id = await self.send_open_command(plate, confidence, direction)
             return {
                 "action": "open",
-                "success": success,
+                "success": cmd_id is not None,
+                "cmd_id": cmd_id,
+                "suppressed": suppressed,
+                "rule": rule,
                 "plate": plate,
                 "confidence": confidence
             }
         else:
-            reason = "Low confidence" if plate else "No plate detected"
-            success = self.send_reject_command(reason)
+            reasons = {
+                "no_plate": "No plate detected",
+                "low_confidence": "Low confidence",
+                "deny_list": "Plate is banned",
+                "not_in_allow_list": "Plate not in allow list"
+            }
+            reason = reasons.get(rule, rule)
+            suppressed = self._coalesced_reject(direction) is not None
+            cmd_id = await self.send_reject_command(reason, direction)
             return {
                 "action": "reject",
-                "success": success,
+                "success": cmd_id is not None,
+                "cmd_id": cmd_id,
+                "suppressed": suppressed,
+                "rule": rule,
                 "reason": reason,
                 "confidence": confidence
             }
     
-    def trigger_manual_gate(self) -> bool:
+    async def trigger_manual_gate(self) -> Optional[str]:
         """
         Mở cổng thủ công từ admin dashboard
-        Returns: True nếu thành công
+        Returns: cmd_id nếu thành công
         """
-        if not self.mqtt_handler:
-            print("[GATE] ERROR MQTT handler not available")
-            return False
-        
         message = {
             "action": "open",
             "plate": "MANUAL",
@@ -111,14 +443,24 @@ class GateService:
             "timestamp": datetime.now().isoformat()
         }
         
-        success = self.mqtt_handler.publish("iot/parking/gate/control", message)
+        cmd_id = await self.send_command("manual", message)
+        self._record("manual", "open", "sent" if cmd_id else "failed", "MANUAL", cmd_id)
         
-        if success:
-            print(f"[GATE] SUCCESS Manual gate open command sent")
+        if cmd_id:
+            print(f"[GATE] SUCCESS Manual gate open command sent (cmd: {cmd_id})")
         else:
             print(f"[GATE] Failed to send manual gate command")
         
-        return success
+        return cmd_id
 
 # Singleton instance
-gate_service = GateService()
+gate_service = GateService(
+    list_mode=getattr(settings, "PLATE_LIST_MODE", "open"),
+    allow_list_threshold=getattr(settings, "ALLOW_LIST_MIN_CONFIDENCE", 0.3),
+    ack_timeout=getattr(settings, "GATE_ACK_TIMEOUT", 3.0),
+    max_retries=getattr(settings, "GATE_MAX_RETRIES", 2),
+    open_duration=getattr(settings, "GATE_OPEN_DURATION", 5.0),
+    open_window=getattr(settings, "GATE_OPEN_DEBOUNCE_SECONDS", 10.0),
+    reject_window=getattr(settings, "GATE_REJECT_COALESCE_SECONDS", 3.0),
+    history_size=getattr(settings, "GATE_HISTORY_SIZE", 200)
+)
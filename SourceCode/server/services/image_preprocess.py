@@ -0,0 +1,172 @@
+import asyncio
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from config import settings
+
+# Cấu hình mặc định cho từng camera
+# roi: (x0, y0, x1, y1) theo tỉ lệ khung hình, vùng chứa biển số
+DEFAULT_CAMERA_PROFILES: Dict[str, Dict[str, Any]] = {
+    "CAM_IN": {
+        "roi": (0.0, 0.2, 1.0, 1.0),
+        "max_width": 800,
+        "normalize_contrast": True,
+        "jpeg_quality": 85
+    },
+    "CAM_OUT": {
+        "roi": (0.0, 0.2, 1.0, 1.0),
+        "max_width": 800,
+        "normalize_contrast": True,
+        "jpeg_quality": 85
+    }
+}
+
+DIRECTION_CAMERAS = {"in": "CAM_IN", "out": "CAM_OUT"}
+
+class ImagePreprocessor:
+    """
+    Tiền xử lý ảnh trước OCR: decode -> crop ROI -> downscale -> chuẩn hóa contrast -> encode JPEG
+    Chạy trong thread pool riêng để không chặn event loop
+    """
+    def __init__(self, profiles: Optional[Dict[str, Dict[str, Any]]] = None, workers: int = 2, enabled: bool = True):
+        self.profiles = profiles or DEFAULT_CAMERA_PROFILES
+        self.enabled = enabled
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess")
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[str, float]] = {}
+
+    def camera_for(self, direction: str) -> str:
+        return DIRECTION_CAMERAS.get(direction, "CAM_IN")
+
+    def process(self, image_bytes: bytes, camera: str) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        Tiền xử lý đồng bộ (chạy trong worker thread)
+
+        Returns: (ảnh JPEG đã xử lý, thông tin biến đổi: camera, roi theo pixel ảnh gốc, scale)
+        """
+        profile = self.profiles.get(camera) or DEFAULT_CAMERA_PROFILES["CAM_IN"]
+        started = time.perf_counter()
+
+        img = Image.open(io.BytesIO(image_bytes))
+        original_size = img.size
+        max_width = profile.get("max_width", 800)
+
+        # JPEG: decode ở độ phân giải thấp hơn bằng DCT scaling nếu ảnh lớn hơn nhiều
+        img.draft('RGB', (max_width, max_width))
+        draft_scale = original_size[0] / img.size[0]
+        pixels = np.asarray(img.convert('RGB'))
+        decoded = time.perf_counter()
+
+        # Crop vùng biển số (slicing, không copy)
+        height, width = pixels.shape[:2]
+        x0, y0, x1, y1 = profile.get("roi", (0.0, 0.0, 1.0, 1.0))
+        left, top = int(x0 * width), int(y0 * height)
+        right, bottom = max(left + 1, int(x1 * width)), max(top + 1, int(y1 * height))
+        pixels = pixels[top:bottom, left:right]
+
+        # Downscale
+        img = Image.fromarray(pixels)
+        scale = 1.0
+        if img.width > max_width:
+            scale = max_width / img.width
+            img = img.resize((max_width, max(1, int(img.height * scale))), Image.BILINEAR)
+            pixels = np.asarray(img)
+
+        # Chuẩn hóa contrast: kéo giãn percentile 2-98 của độ sáng về 0-255
+        if profile.get("normalize_contrast", True):
+            luma = pixels[::4, ::4].mean(axis=2)
+            low, high = np.percentile(luma, (2, 98))
+            if high - low > 1:
+                lut = np.clip((np.arange(256, dtype=np.float32) - low) * (255.0 / (high - low)), 0, 255).astype(np.uint8)
+                pixels = lut[pixels]
+                img = Image.fromarray(pixels)
+        transformed = time.perf_counter()
+
+        output = io.BytesIO()
+        img.save(output, format="JPEG", quality=profile.get("jpeg_quality", 85))
+        processed = output.getvalue()
+        encoded = time.perf_counter()
+
+        self._record(camera, len(image_bytes), len(processed), {
+            "decode_ms": (decoded - started) * 1000,
+            "transform_ms": (transformed - decoded) * 1000,
+            "encode_ms": (encoded - transformed) * 1000
+        })
+
+        info = {
+            "camera": camera,
+            "roi": [
+                int(left * draft_scale), int(top * draft_scale),
+                int(right * draft_scale), int(bottom * draft_scale)
+            ],
+            "scale": round(scale / draft_scale, 6),
+            "original_size": list(original_size)
+        }
+        return processed, info
+
+    async def preprocess(self, image_bytes: bytes, direction: str) -> Tuple[bytes, Optional[Dict[str, Any]]]:
+
+        # Trả về ảnh gốc nếu tắt hoặc xử lý lỗi
+        if not self.enabled:
+            return image_bytes, None
+
+        camera = self.camera_for(direction)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, self.process, image_bytes, camera)
+        except Exception as e:
+            print(f"[PREPROCESS] ERROR {camera}: {e}")
+            return image_bytes, None
+
+    def _record(self, camera: str, bytes_in: int, bytes_out: int, timings: Dict[str, float]):
+        with self._lock:
+            counters = self._counters.setdefault(camera, {
+                "frames": 0,
+                "bytes_in": 0,
+                "bytes_out": 0,
+                "decode_ms": 0.0,
+                "transform_ms": 0.0,
+                "encode_ms": 0.0
+            })
+            counters["frames"] += 1
+            counters["bytes_in"] += bytes_in
+            counters["bytes_out"] += bytes_out
+            for key, value in timings.items():
+                counters[key] += value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            cameras = {}
+            for camera, counters in self._counters.items():
+                frames = counters["frames"] or 1
+                total_ms = counters["decode_ms"] + counters["transform_ms"] + counters["encode_ms"]
+                cameras[camera] = {
+                    "frames": counters["frames"],
+                    "bytes_in": counters["bytes_in"],
+                    "bytes_out": counters["bytes_out"],
+                    "size_ratio": round(counters["bytes_out"] / counters["bytes_in"], 3) if counters["bytes_in"] else None,
+                    "avg_decode_ms": round(counters["decode_ms"] / frames, 2),
+                    "avg_transform_ms": round(counters["transform_ms"] / frames, 2),
+                    "avg_encode_ms": round(counters["encode_ms"] / frames, 2),
+                    "avg_total_ms": round(total_ms / frames, 2)
+                }
+            return {
+                "enabled": self.enabled,
+                "cameras": cameras
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+# Singleton instance
+image_preprocessor = ImagePreprocessor(
+    profiles=getattr(settings, "PREPROCESS_CAMERAS", None),
+    workers=getattr(settings, "PREPROCESS_WORKERS", 2),
+    enabled=getattr(settings, "PREPROCESS_ENABLED", True)
+)
@@ -0,0 +1,285 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import deque
+from typing import Optional, Dict, Any, Iterator, List, Tuple
+
+from config import settings
+
+KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+SHARD_PATTERN = re.compile(r"^[0-9a-f]{2}$")
+SEGMENT_PATTERN = re.compile(r"^seg_(\d{6})\.pack$")
+
+class ImageStore:
+    """
+    Kho ảnh content-addressed: mỗi frame lưu một lần dưới root/ab/cd/<sha256>.jpg
+    Ghi atomic (file tạm cùng thư mục + os.replace), frame trùng nội dung chỉ lưu một bản.
+    VehicleLog.image_path chỉ giữ key (sha256); ảnh "archive" là ảnh được VehicleLog tham chiếu.
+
+    Ảnh nhỏ đã cũ có thể được gom vào segment append-only (segments/seg_NNNNNN.pack)
+    kèm file index (seg_NNNNNN.idx, mỗi dòng "key offset length"), vẫn đọc được theo key.
+    """
+    EXTENSION = ".jpg"
+
+    def __init__(self, root: str, segment_max_bytes: int = 64 * 1024 * 1024):
+        self.root = root
+        self.segment_dir = os.path.join(root, "segments")
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(self.segment_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._pack_lock = threading.Lock()
+        self.writes = 0
+        self.dedup_hits = 0
+        self.bytes_written = 0
+
+        # key -> (segment_id, offset, length)
+        self._segment_index: Dict[str, Tuple[int, int, int]] = {}
+        self._load_segment_index()
+
+    @staticmethod
+    def is_key(value: Optional[str]) -> bool:
+        return bool(value) and bool(KEY_PATTERN.match(value))
+
+    @staticmethod
+    def compute_key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], key + self.EXTENSION)
+
+    def put(self, data: bytes) -> str:
+        """
+        Lưu ảnh (blocking I/O, gọi qua asyncio.to_thread trong async handler)
+        Returns: key của ảnh
+        """
+        key = self.compute_key(data)
+        path = self.path_for(key)
+
+        if key in self._segment_index or os.path.exists(path):
+            with self._lock:
+                self.dedup_hits += 1
+            return key
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=self.EXTENSION)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            self.writes += 1
+            self.bytes_written += len(data)
+        return key
+
+    def exists(self, key: str) -> bool:
+        return self.is_key(key) and (key in self._segment_index or os.path.exists(self.path_for(key)))
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.is_key(key):
+            return None
+        try:
+            with open(self.path_for(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+        # Ảnh đã được gom vào segment
+        location = self._segment_index.get(key)
+        if not location:
+            return None
+        segment_id, offset, length = location
+        try:
+            with open(self._segment_path(segment_id), 'rb') as f:
+                f.seek(offset)
+                return f.read(length)
+        except FileNotFoundError:
+            return None
+
+    def read(self, image_path: Optional[str]) -> Optional[bytes]:
+
+        # Đọc ảnh theo key hoặc đường dẫn file cũ
+        if self.is_key(image_path):
+            return self.get(image_path)
+        if image_path and os.path.exists(image_path):
+            with open(image_path, 'rb') as f:
+                return f.read()
+        return None
+
+    def resolve(self, image_path: Optional[str]) -> Optional[str]:
+
+        # Hỗ trợ cả key mới lẫn đường dẫn file cũ (TEMP_DIR/ARCHIVE_DIR) trong VehicleLog
+        if self.is_key(image_path):
+            path = self.path_for(image_path)
+            return path if os.path.exists(path) else None
+        if image_path and os.path.exists(image_path):
+            return image_path
+        return None
+
+    def delete(self, key: str) -> bool:
+        if not self.is_key(key):
+            return False
+        try:
+            os.remove(self.path_for(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def iter_loose(self) -> Iterator[Tuple[str, str, int, float]]:
+
+        # Duyệt các ảnh chưa gom: (key, path, size, mtime)
+        for shard in os.scandir(self.root):
+            if not shard.is_dir() or not SHARD_PATTERN.match(shard.name):
+                continue
+            for sub in os.scandir(shard.path):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    key = entry.name[:-len(self.EXTENSION)]
+                    if entry.name.endswith(self.EXTENSION) and self.is_key(key):
+                        stat = entry.stat()
+                        yield key, entry.path, stat.st_size, stat.st_mtime
+
+    # Segment packing
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.segment_dir, f"seg_{segment_id:06d}.pack")
+
+    def _index_path(self, segment_id: int) -> str:
+        return os.path.join(self.segment_dir, f"seg_{segment_id:06d}.idx")
+
+    def _segment_ids(self) -> List[int]:
+        ids = []
+        for name in os.listdir(self.segment_dir):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                ids.append(int(match.group(1)))
+        return sorted(ids)
+
+    def _load_segment_index(self):
+        for segment_id in self._segment_ids():
+            segment_size = os.path.getsize(self._segment_path(segment_id))
+            try:
+                with open(self._index_path(segment_id), 'r') as f:
+                    for line in f:
+                        parts = line.split()
+                        if len(parts) != 3:
+                            continue  # Dòng ghi dở khi crash
+                        key, offset, length = parts[0], int(parts[1]), int(parts[2])
+                        if offset + length <= segment_size:
+                            self._segment_index[key] = (segment_id, offset, length)
+            except FileNotFoundError:
+                pass
+
+        if self._segment_index:
+            print(f"[STORE] Loaded segment index: {len(self._segment_index)} images")
+
+    def pack(self, keys: List[str]) -> Tuple[int, int]:
+        """
+        Gom các ảnh rời vào segment hiện tại (append-only), rồi xóa file rời
+        Data được fsync trước index, index trước khi xóa file rời nên crash không mất ảnh
+
+        Returns: (số ảnh đã gom, số byte đã gom)
+        """
+        packed, packed_bytes = 0, 0
+
+        with self._pack_lock:
+            segment_ids = self._segment_ids()
+            segment_id = segment_ids[-1] if segment_ids else 1
+            pending = deque(keys)
+
+            while pending:
+                segment_path = self._segment_path(segment_id)
+                if os.path.exists(segment_path) and os.path.getsize(segment_path) >= self.segment_max_bytes:
+                    segment_id += 1
+                    continue
+
+                # Ghi một lô vào segment cho tới khi đầy, fsync một lần cho cả lô
+                entries = []
+                with open(segment_path, 'ab') as pack_file:
+                    offset = pack_file.tell()
+                    while pending and offset < self.segment_max_bytes:
+                        key = pending.popleft()
+                        try:
+                            with open(self.path_for(key), 'rb') as f:
+                                data = f.read()
+                        except FileNotFoundError:
+                            continue
+                        pack_file.write(data)
+                        entries.append((key, offset, len(data)))
+                        offset += len(data)
+                    pack_file.flush()
+                    os.fsync(pack_file.fileno())
+
+                with open(self._index_path(segment_id), 'a') as index_file:
+                    index_file.writelines(f"{key} {offset} {length}\n" for key, offset, length in entries)
+                    index_file.flush()
+                    os.fsync(index_file.fileno())
+
+                for key, offset, length in entries:
+                    self._segment_index[key] = (segment_id, offset, length)
+                    self.delete(key)
+                    packed += 1
+                    packed_bytes += length
+
+        return packed, packed_bytes
+
+    def segments(self) -> List[Dict[str, Any]]:
+
+        # Thông tin các segment: id, kích thước, thời điểm ghi cuối
+        result = []
+        for segment_id in self._segment_ids():
+            stat = os.stat(self._segment_path(segment_id))
+            result.append({
+                "segment_id": segment_id,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime
+            })
+        return result
+
+    def drop_segment(self, segment_id: int) -> int:
+        """
+        Xóa cả segment (dùng khi vượt ngân sách dung lượng/tuổi)
+        Returns: số byte giải phóng
+        """
+        with self._pack_lock:
+            segment_path = self._segment_path(segment_id)
+            freed = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+
+            for key in [k for k, location in self._segment_index.items() if location[0] == segment_id]:
+                del self._segment_index[key]
+            for path in (segment_path, self._index_path(segment_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            return freed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "root": self.root,
+                "writes": self.writes,
+                "dedup_hits": self.dedup_hits,
+                "bytes_written": self.bytes_written,
+                "packed_images": len(self._segment_index)
+            }
+
+# Singleton instance
+image_store = ImageStore(
+    getattr(settings, "IMAGE_STORE_DIR", os.path.join(settings.UPLOAD_DIR, "store")),
+    segment_max_bytes=getattr(settings, "IMAGE_SEGMENT_MAX_BYTES", 64 * 1024 * 1024)
+)
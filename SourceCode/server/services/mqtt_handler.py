@@ -1,18 +1,245 @@
 import paho.mqtt.client as mqtt
+import asyncio
 import json
+import os
+import socket
+import threading
+import time
+from collections import deque, OrderedDict
+from typing import Callable, Dict, Any, List, Optional, Tuple
 from config import settings
 from datetime import datetime
 
+class PublishTracker:
+    """
+    Publish không chặn event loop: trả về future được hoàn thành từ callback on_publish của paho
+    (chạy trên network thread) qua loop.call_soon_threadsafe
+
+    paho có thể gọi on_publish trước khi client.publish() trả về mid, và gọi nó khi đang giữ lock nội bộ,
+    nên không giữ lock của tracker quanh client.publish(): mid đến sớm được ghi vào _early rồi xử lý khi đăng ký.
+    mid sớm không được đăng ký trong EARLY_TTL giây (publish lỗi, reconnect) bị bỏ; reset() xóa hết khi mất kết nối.
+    """
+    EARLY_TTL = 5.0
+
+    def __init__(self, client: mqtt.Client, name: str = "MQTT", default_timeout: float = 2.0, default_retries: int = 1):
+        self.client = client
+        self.name = name
+        self.default_timeout = default_timeout
+        self.default_retries = default_retries
+        client.on_publish = self._on_publish
+
+        self._lock = threading.Lock()
+        self._pending: Dict[int, Tuple[asyncio.Future, float]] = {}
+        # mid đã được xác nhận nhưng chưa đăng ký -> thời điểm nhận (mid của paho quay vòng ở 65535)
+        self._early: "OrderedDict[int, float]" = OrderedDict()
+
+        self.published = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.retries = 0
+        self._latencies_ms = deque(maxlen=500)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future):
+        if not future.done():
+            future.set_result(True)
+
+    def _on_publish(self, client, userdata, mid):
+
+        # Network thread của paho: chỉ chuyển kết quả sang event loop
+        with self._lock:
+            entry = self._pending.pop(mid, None)
+            if entry is None:
+                self._early.pop(mid, None)
+                self._early[mid] = time.monotonic()
+                self._expire_early()
+                return
+        future, _ = entry
+        future.get_loop().call_soon_threadsafe(self._resolve, future)
+
+    def _expire_early(self):
+
+        # Gọi khi đang giữ _lock; _early sắp theo thời điểm nhận nên chỉ cần bỏ từ đầu
+        cutoff = time.monotonic() - self.EARLY_TTL
+        while self._early and (next(iter(self._early.values())) < cutoff or len(self._early) > 1024):
+            self._early.popitem(last=False)
+
+    def reset(self):
+
+        # Mất kết nối: mid sớm của phiên cũ không còn waiter nào khớp (mid mới có thể trùng số)
+        with self._lock:
+            self._early.clear()
+
+    async def _publish_once(self, topic: str, payload: str, qos: int, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        started = time.perf_counter()
+
+        info = self.client.publish(topic, payload, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            print(f"[{self.name}] Publish failed - rc: {info.rc}")
+            return False
+
+        with self._lock:
+            self._expire_early()
+            if info.mid in self._early:
+                del self._early[info.mid]
+                future.set_result(True)
+            else:
+                self._pending[info.mid] = (future, started)
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._pending.pop(info.mid, None)
+            self.timeouts += 1
+            print(f"[{self.name}] Publish to {topic} not acknowledged after {timeout}s")
+            return False
+
+        self._latencies_ms.append((time.perf_counter() - started) * 1000)
+        return True
+
+    async def publish(self, topic: str, message: Any, qos: int = 1, timeout: Optional[float] = None, retries: Optional[int] = None) -> bool:
+        """
+        Publish và chờ broker xác nhận (PUBACK với QoS 1) mà không chặn event loop
+
+        Args:
+            message: dict (được encode JSON) hoặc str
+            retries: Số lần thử lại khi lỗi/timeout (backoff 0.2s, 0.4s, ...)
+
+        Returns: True nếu đã được xác nhận
+        """
+        timeout = self.default_timeout if timeout is None else timeout
+        retries = self.default_retries if retries is None else retries
+        payload = message if isinstance(message, str) else json.dumps(message)
+
+        for attempt in range(retries + 1):
+            if attempt:
+                self.retries += 1
+                await asyncio.sleep(0.2 * 2 ** (attempt - 1))
+            if not self.client.is_connected():
+                print(f"[{self.name}] ERROR Client not connected")
+                continue
+            try:
+                if await self._publish_once(topic, payload, qos, timeout):
+                    self.published += 1
+                    return True
+            except Exception as e:
+                print(f"[{self.name}] Error publishing: {e}")
+
+        self.failed += 1
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies_ms)
+        with self._lock:
+            pending = len(self._pending)
+            early = len(self._early)
+        return {
+            "published": self.published,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "pending": pending,
+            "early": early,
+            "latency_ms": {
+                "avg": round(sum(latencies) / len(latencies), 2),
+                "p50": round(latencies[len(latencies) // 2], 2),
+                "p95": round(latencies[int(len(latencies) * 0.95)], 2),
+                "max": round(latencies[-1], 2)
+            } if latencies else None
+        }
+
+class TopicTrie:
+    """
+    Trie các topic filter MQTT (hỗ trợ wildcard "+" một cấp và "#" nhiều cấp) -> danh sách callback
+    Tra một topic chỉ đi theo các nhánh khớp, không duyệt toàn bộ filter đã đăng ký.
+    """
+    def __init__(self):
+        self._root: Dict[str, Any] = {"children": {}, "handlers": []}
+        self._lock = threading.Lock()
+
+    def add(self, topic_filter: str, callback: Callable):
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split("/"):
+                node = node["children"].setdefault(level, {"children": {}, "handlers": []})
+            if callback not in node["handlers"]:
+                node["handlers"].append(callback)
+
+    def remove(self, topic_filter: str, callback: Optional[Callable] = None) -> bool:
+
+        # Gỡ một callback (hoặc mọi callback nếu None); trả về True nếu filter không còn callback nào
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split("/"):
+                node = node["children"].get(level)
+                if node is None:
+                    return True
+            if callback is None:
+                node["handlers"].clear()
+            elif callback in node["handlers"]:
+                node["handlers"].remove(callback)
+            return not node["handlers"]
+
+    def match(self, topic: str) -> List[Callable]:
+        levels = topic.split("/")
+        matched: List[Callable] = []
+        with self._lock:
+            self._match(self._root, levels, 0, matched)
+        return matched
+
+    def _match(self, node: Dict[str, Any], levels: List[str], index: int, matched: List[Callable]):
+        children = node["children"]
+        # Topic hệ thống ($SYS/...) không khớp wildcard ở cấp đầu
+        wildcard = index > 0 or not levels[0].startswith("$")
+
+        if wildcard and "#" in children:
+            # "a/#" khớp cả "a" lẫn mọi topic con
+            matched.extend(children["#"]["handlers"])
+        if index == len(levels):
+            matched.extend(node["handlers"])
+            return
+
+        child = children.get(levels[index])
+        if child is not None:
+            self._match(child, levels, index + 1, matched)
+        if wildcard and "+" in children:
+            self._match(children["+"], levels, index + 1, matched)
+
 class MQTTHandler:
-    def __init__(self, on_slot_update=None):
-        self.client = mqtt.Client()
-        self.on_slot_update = on_slot_update
-        self.camera_frame_callback = None  # Callback cho camera frames
+    """
+    Kết nối MQTT dùng chung cho toàn server (một kết nối mỗi process)
+    - client_id duy nhất theo host/pid: nhiều worker không đá nhau khỏi broker
+    - paho tự reconnect với backoff (reconnect_delay_set), mọi subscription được đăng ký lại khi kết nối lại
+    - Message đến được parse JSON một lần rồi dispatch qua TopicTrie tới các handler đã đăng ký
+    """
+    def __init__(self, client_id: Optional[str] = None, reconnect_min_delay: int = 1, reconnect_max_delay: int = 60):
+        self.client_id = client_id or f"{getattr(settings, 'MQTT_CLIENT_ID', 'parking_server')}-{socket.gethostname()}-{os.getpid()}"
+        self.client = mqtt.Client(client_id=self.client_id)
+        self.client.reconnect_delay_set(min_delay=reconnect_min_delay, max_delay=reconnect_max_delay)
+        self.handlers = TopicTrie()
+        self.subscriptions: Dict[str, int] = {}  # topic filter -> qos
+        self._started = False
         
         # Callbacks
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
         self.client.on_disconnect = self._on_disconnect
+        self.publisher = PublishTracker(
+            self.client,
+            default_timeout=getattr(settings, "MQTT_PUBLISH_TIMEOUT", 2.0),
+            default_retries=getattr(settings, "MQTT_PUBLISH_RETRIES", 1)
+        )
+        
+        self.connects = 0
+        self.disconnects = 0
+        self.last_connected: Optional[str] = None
+        self.last_disconnected: Optional[str] = None
+        self.received = 0
+        self.unmatched = 0
+        self.handler_errors = 0
         
         # Credentials (chỉ set nếu username không rỗng)
         if settings.MQTT_USERNAME and settings.MQTT_USERNAME.strip():
@@ -23,10 +250,13 @@ class MQTTHandler:
     
     def _on_connect(self, client, userdata, flags, rc):
         if rc == 0:
-            print(f"[MQTT] SUCCESS Connected to MQTT broker: {settings.MQTT_BROKER}")
-            # Subscribe vào topic slots
-            client.subscribe(settings.MQTT_TOPIC_SLOTS)
-            print(f"[MQTT] Subscribed to topic: {settings.MQTT_TOPIC_SLOTS}")
+            self.connects += 1
+            self.last_connected = datetime.now().isoformat()
+            print(f"[MQTT] SUCCESS Connected to MQTT broker: {settings.MQTT_BROKER} (client_id: {self.client_id})")
+            # Đăng ký lại mọi topic trong một lần subscribe
+            if self.subscriptions:
+                client.subscribe(list(self.subscriptions.items()))
+                print(f"[MQTT] Subscribed to topics: {', '.join(self.subscriptions)}")
         else:
             print(f"[MQTT] Failed to connect to MQTT broker, code: {rc}")
     
@@ -34,71 +264,124 @@ class MQTTHandler:
         try:
             topic = msg.topic
             payload = msg.payload.decode()
+            self.received += 1
             
             print(f"[MQTT] Topic: {topic}")
             print(f"[MQTT] Message: {payload}")
             
+            handlers = self.handlers.match(topic)
+            if not handlers:
+                self.unmatched += 1
+                return
+            
             # Parse JSON
             try:
                 data = json.loads(payload)
-                
-                # Gọi callback để cập nhật database
-                if self.on_slot_update:
-                    self.on_slot_update(data)
-            
             except json.JSONDecodeError:
                 print(f"[MQTT] Invalid JSON: {payload}")
+                return
+            
+            # Lỗi của một handler không chặn các handler khác
+            for handler, with_topic in handlers:
+                try:
+                    if with_topic:
+                        handler(data, topic)
+                    else:
+                        handler(data)
+                except Exception as e:
+                    self.handler_errors += 1
+                    print(f"[MQTT] Handler error on {topic}: {e}")
         
         except Exception as e:
             print(f"[MQTT] Error processing message: {e}")
     
+    def add_handler(self, topic, callback, qos=0, with_topic=False):
+        
+        # Đăng ký callback cho một topic filter (hỗ trợ + và #), subscribe lại mỗi khi kết nối
+        # with_topic=True: callback(data, topic) - cần khi filter có wildcard
+        self.handlers.add(topic, (callback, with_topic))
+        if topic not in self.subscriptions:
+            self.subscriptions[topic] = qos
+            if self.client.is_connected():
+                self.client.subscribe(topic, qos)
+    
+    def remove_handler(self, topic, callback=None):
+        
+        # Gỡ callback; unsubscribe khi topic không còn handler
+        if callback is not None:
+            self.handlers.remove(topic, (callback, True))
+        if self.handlers.remove(topic, (callback, False) if callback else None) and self.subscriptions.pop(topic, None) is not None:
+            if self.client.is_connected():
+                self.client.unsubscribe(topic)
+    
     def _on_disconnect(self, client, userdata, rc):
         
-        # Callback khi mất kết nối
+        # Callback khi mất kết nối (paho tự reconnect với backoff trong network thread)
+        self.disconnects += 1
+        self.last_disconnected = datetime.now().isoformat()
+        self.publisher.reset()
         if rc != 0:
-            print(f"[MQTT] ERROR Unexpected disconnection. Reconnecting...")
+            print(f"[MQTT] ERROR Unexpected disconnection (rc: {rc}). Reconnecting...")
+    
+    def is_connected(self) -> bool:
+        return self.client.is_connected()
     
     def connect(self):
         
         # Kết nối đến MQTT broker
         try:
             self.client.connect(settings.MQTT_BROKER, settings.MQTT_PORT, 60)
-            self.client.loop_start()
+            if not self._started:
+                self.client.loop_start()
+                self._started = True
             return True
         except Exception as e:
             print(f"[MQTT] Error connecting to MQTT broker: {e}")
             return False
     
+    def connect_async(self):
+        
+        # Broker chưa sẵn sàng: để network thread tự thử lại với backoff thay vì bỏ MQTT
+        self.client.connect_async(settings.MQTT_BROKER, settings.MQTT_PORT, 60)
+        if not self._started:
+            self.client.loop_start()
+            self._started = True
+        print(f"[MQTT] Retrying connection in background")
+    
     def disconnect(self):
         
         # Ngắt kết nối
-        self.client.loop_stop()
         self.client.disconnect()
+        if self._started:
+            self.client.loop_stop()
+            self._started = False
         print("✓ Disconnected from MQTT broker")
     
-    def publish(self, topic, message):
+    async def publish_async(self, topic, message, qos=1, timeout=None, retries=None) -> bool:
         
-        # Publish message
-        try:
-            # Check if client is connected
-            if not self.client.is_connected():
-                print(f"[MQTT] ERROR Client not connected")
-                return False
-            
-            result = self.client.publish(topic, json.dumps(message), qos=1)
-            
-            # Wait for publish to complete (timeout 2 seconds)
-            result.wait_for_publish(2.0)
-            
-            if result.rc == mqtt.MQTT_ERR_SUCCESS and result.is_published():
-                print(f"[MQTT] Published to {topic}: {message}")
-                return True
-            else:
-                print(f"[MQTT] Publish failed - rc: {result.rc}, published: {result.is_published()}")
-                return False
-        except Exception as e:
-            print(f"[MQTT] Error publishing: {e}")
-        return False
+        # Publish không chặn event loop, chờ xác nhận qua on_publish
+        success = await self.publisher.publish(topic, message, qos=qos, timeout=timeout, retries=retries)
+        if success:
+            print(f"[MQTT] Published to {topic}: {message}")
+        return success
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "client_id": self.client_id,
+            "connected": self.client.is_connected(),
+            "connects": self.connects,
+            "disconnects": self.disconnects,
+            "last_connected": self.last_connected,
+            "last_disconnected": self.last_disconnected,
+            "subscriptions": list(self.subscriptions),
+            "received": self.received,
+            "unmatched": self.unmatched,
+            "handler_errors": self.handler_errors,
+            "publish": self.publisher.stats()
+        }
 
-# Global MQTT client instance
-mqtt_client = MQTTHandler()
+# Singleton instance (chỉ kết nối khi main gọi connect lúc startup)
+mqtt_manager = MQTTHandler(
+    reconnect_min_delay=getattr(settings, "MQTT_RECONNECT_MIN_DELAY", 1),
+    reconnect_max_delay=getattr(settings, "MQTT_RECONNECT_MAX_DELAY", 60)
+)
@@ -0,0 +1,166 @@
+import asyncio
+import itertools
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+
+from config import settings
+from models import SessionLocal
+from .plate_pipeline import process_plate_image
+from .gate_service import gate_service
+
+# Xe vào được xử lý trước xe ra
+JOB_PRIORITIES = {"in": 0, "out": 1}
+
+class OCRJobService:
+    """
+    Hàng đợi OCR bất đồng bộ: upload trả về job id ngay, worker pool xử lý OCR
+    và gửi quyết định mở cổng qua MQTT
+    """
+    def __init__(self, max_depth: int = 32, workers: int = 2, max_history: int = 500):
+        self.max_depth = max_depth
+        self.workers = workers
+        self.max_history = max_history
+
+        self.jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._payloads: Dict[str, List[bytes]] = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._sequence = itertools.count()
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected_full = 0
+
+    def submit(self, frames: List[bytes], direction: str) -> Optional[Dict[str, Any]]:
+        """
+        Đưa burst ảnh của một lượt xe vào hàng đợi OCR
+        Returns: job dict, hoặc None nếu hàng đợi đầy / worker chưa chạy
+        """
+        if self._queue is None:
+            print("[OCR JOB] ERROR Worker pool not started")
+            return None
+
+        job_id = uuid.uuid4().hex[:12]
+        priority = JOB_PRIORITIES.get(direction, len(JOB_PRIORITIES))
+
+        try:
+            self._queue.put_nowait((priority, next(self._sequence), job_id))
+        except asyncio.QueueFull:
+            self.rejected_full += 1
+            print(f"[OCR JOB] Queue full ({self.max_depth}), job rejected")
+            return None
+
+        job = {
+            "job_id": job_id,
+            "direction": direction,
+            "status": "queued",
+            "created_at": datetime.now().isoformat(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "_enqueued": time.monotonic()
+        }
+        self.jobs[job_id] = job
+        self._payloads[job_id] = frames
+        self.submitted += 1
+        self._trim_history()
+
+        print(f"[OCR JOB] Queued {job_id} (direction: {direction}, depth: {self._queue.qsize()})")
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id)
+        if not job:
+            return None
+        return {key: value for key, value in job.items() if not key.startswith("_")}
+
+    def _trim_history(self):
+
+        # Chỉ giữ lịch sử các job đã xong trong giới hạn max_history
+        while len(self.jobs) > self.max_history:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if oldest["status"] in ("queued", "processing"):
+                break
+            del self.jobs[oldest_id]
+
+    async def _worker(self, worker_id: int):
+        while True:
+            _, _, job_id = await self._queue.get()
+            try:
+                await self._run_job(job_id)
+            except Exception as e:
+                print(f"[OCR JOB] Worker {worker_id} error: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run_job(self, job_id: str):
+        job = self.jobs.get(job_id)
+        payload = self._payloads.pop(job_id, None)
+        if not job or not payload:
+            return
+
+        job["status"] = "processing"
+        job["started_at"] = datetime.now().isoformat()
+        wait_ms = (time.monotonic() - job["_enqueued"]) * 1000
+        print(f"[OCR JOB] Processing {job_id} (waited {wait_ms:.0f} ms)")
+
+        db = SessionLocal()
+        try:
+            _, content = await process_plate_image(payload, job["direction"], db)
+            job["status"] = "done"
+            job["result"] = content
+            self.completed += 1
+        except Exception as e:
+            print(f"[OCR JOB] ERROR {job_id}: {e}")
+            job["status"] = "failed"
+            job["result"] = {"success": False, "error": str(e), "action": "reject"}
+            self.failed += 1
+
+            # Gửi lệnh reject cho GATE
+            if gate_service:
+                await gate_service.send_reject_command(f"Error: {str(e)}", job["direction"])
+        finally:
+            db.close()
+            job["finished_at"] = datetime.now().isoformat()
+
+    def start(self):
+
+        # Khởi động worker pool (gọi trong event loop)
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue(maxsize=self.max_depth)
+        for worker_id in range(self.workers):
+            self._worker_tasks.append(asyncio.create_task(self._worker(worker_id)))
+        print(f"[OCR JOB] SUCCESS {self.workers} workers started (max depth: {self.max_depth})")
+
+    async def stop(self):
+
+        # Dừng worker pool
+        for task in self._worker_tasks:
+            task.cancel()
+        for task in self._worker_tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._worker_tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self._queue.qsize() if self._queue else 0,
+            "max_depth": self.max_depth,
+            "workers": self.workers,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected_full": self.rejected_full
+        }
+
+# Singleton instance
+ocr_job_service = OCRJobService(
+    max_depth=getattr(settings, "OCR_JOB_MAX_DEPTH", 32),
+    workers=getattr(settings, "OCR_JOB_WORKERS", 2)
+)
@@ -1,47 +1,262 @@
+import asyncio
+import io
+from abc import ABC, abstractmethod
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 import requests
+from PIL import Image
+from typing import Optional, Dict, Any, Callable, List, Tuple
 from config import settings
 
-class OCRService:
-    def __init__(self):
-        self.api_url = settings.OCR_API_URL
-        self.api_key = settings.OCR_API_KEY
-        self.regions = ["vn"]  
-    
-    def recognize_plate(self, image_bytes):
+# Local OCR backend (optional dependencies)
+try:
+    import numpy as np
+    import onnxruntime as ort
+except ImportError:
+    np = None
+    ort = None
+
+class PlateResultCache:
+    """
+    Cache kết quả OCR cho các frame lặp lại của cùng một xe
+
+    Khóa cache là dHash 128-bit của vùng biển số (box trong kết quả OCR đã cache), không phải của cả frame:
+    hai xe giống nhau nhưng khác biển có hash cả frame rất gần nhau, còn hash vùng biển thì khác hẳn.
+    Khi tra, frame mới được cắt đúng box của từng entry rồi so Hamming distance <= tolerance (mặc định 2).
+    Kết quả không có box (backend remote không trả box) thì không cache; backend local đọc cả ảnh nên box = cả ảnh.
+    """
+    HASH_WIDTH = 16
+    HASH_HEIGHT = 8
+
+    def __init__(self, max_size: int = 256, ttl: float = 30.0, tolerance: int = 2):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tolerance = tolerance
+        # (box, hash vùng biển) -> (expires_at, result); box = None nghĩa là cả ảnh
+        self._entries: "OrderedDict[Tuple[Optional[Tuple[int, int, int, int]], int], tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def load(image_bytes) -> Optional[Image.Image]:
 
+        # Decode ảnh xám một lần cho cả get và put (chạy trong thread pool)
         try:
-            files = {'upload': ('image.jpg', image_bytes, 'image/jpeg')}
-            headers = {'Authorization': f'{self.api_key}'}
-            data = {'regions': self.regions}  # Optional: specify regions
-            
-            print(f"[OCR] Sending request to {self.api_url}...")
-            print(f"[OCR] Regions: {self.regions}")
-            
-            response = requests.post(
-                self.api_url,
-                data=data,
-                files=files,
-                headers=headers,
-                timeout=30
-            )
-            
-            if response.status_code == 200 or response.status_code == 201:
-                result = response.json()
-                print(f"[OCR] SUCCESS: {result}")
-                return self._parse_result(result)
-            else:
-                print(f"[OCR] ERROR {response.status_code}: {response.text}")
-                return None
-        
+            return Image.open(io.BytesIO(image_bytes)).convert('L')
         except Exception as e:
-            print(f"[OCR] Exception: {e}")
+            print(f"[OCR CACHE] Cannot decode image: {e}")
+            return None
+
+    @staticmethod
+    def plate_box(result: Dict[str, Any]) -> Tuple[bool, Optional[Tuple[int, int, int, int]]]:
+        """
+        Returns: (có thể cache, box vùng biển trên ảnh gửi OCR hoặc None = cả ảnh)
+        """
+        raw = result.get('raw_result')
+        if raw is None:
+            return True, None
+        results = (raw.get('results') or []) if isinstance(raw, dict) else []
+        box = results[0].get('box') if results else None
+        if not box:
+            return False, None
+        return True, (int(box['xmin']), int(box['ymin']), int(box['xmax']), int(box['ymax']))
+
+    @classmethod
+    def crop_hash(cls, image: Image.Image, box: Optional[Tuple[int, int, int, int]]) -> Optional[int]:
+
+        # dHash: so sánh độ sáng các pixel kề nhau trên vùng biển số thu về 17x8
+        if box is not None:
+            left, top, right, bottom = box
+            right, bottom = min(right, image.width), min(bottom, image.height)
+            if right - left < 4 or bottom - top < 4:
+                return None
+            image = image.crop((left, top, right, bottom))
+        pixels = image.resize((cls.HASH_WIDTH + 1, cls.HASH_HEIGHT), Image.BILINEAR).tobytes()
+
+        value = 0
+        width = cls.HASH_WIDTH + 1
+        for row in range(cls.HASH_HEIGHT):
+            offset = row * width
+            for col in range(cls.HASH_WIDTH):
+                value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+        return value
+
+    def get(self, image: Optional[Image.Image]) -> Optional[Dict[str, Any]]:
+        if image is None:
             return None
-    
-    def _parse_result(self, result):
+
+        now = time.monotonic()
+        with self._lock:
+            candidates = list(self._entries.items())
+
+        # Hash vùng biển của frame mới theo box của từng entry (mỗi box chỉ tính một lần)
+        hashes: Dict[Any, Optional[int]] = {}
+        match, best_distance, expired = None, self.tolerance + 1, []
+        for key, (expires_at, _) in candidates:
+            if expires_at <= now:
+                expired.append(key)
+                continue
+            box, plate_hash = key
+            if box not in hashes:
+                hashes[box] = self.crop_hash(image, box)
+            if hashes[box] is None:
+                continue
+            distance = bin(plate_hash ^ hashes[box]).count('1')
+            if distance < best_distance:
+                best_distance, match = distance, key
+
+        with self._lock:
+            for key in expired:
+                entry = self._entries.get(key)
+                if entry and entry[0] <= now:
+                    del self._entries[key]
+
+            entry = self._entries.get(match) if match is not None else None
+            # Entry có thể đã hết hạn/bị thay giữa hai lần lấy lock: kiểm tra lại trên chính entry khớp
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[match]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(match)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, image: Optional[Image.Image], result: Optional[Dict[str, Any]]):
+
+        # Chỉ cache kết quả đọc được biển số và xác định được vùng biển
+        if image is None or not result or result.get('plate', 'UNKNOWN') == 'UNKNOWN':
+            return
+        cacheable, box = self.plate_box(result)
+        if not cacheable:
+            return
+        plate_hash = self.crop_hash(image, box)
+        if plate_hash is None:
+            return
+
+        key = (box, plate_hash)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, dict(result))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "tolerance": self.tolerance
+            }
+
+class OCRBackend(ABC):
+    """
+    Interface cho backend nhận diện biển số
+    recognize/recognize_async trả về dict {'plate','confidence','region','vehicle_type',...} hoặc None
+    Backend thiếu một trong hai method lỗi ngay khi khởi tạo (không đợi request đầu tiên)
+    """
+    name = "base"
+
+    @abstractmethod
+    def recognize(self, image_bytes) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def recognize_async(self, image_bytes) -> Optional[Dict[str, Any]]:
+        ...
+
+    def warmup(self) -> bool:
+        return True
+
+    async def aclose(self):
+        pass
+
+    def close(self):
+        pass
+
+class RemoteOCRBackend(OCRBackend):
+    # Backend gọi OCR API qua HTTP (settings.OCR_API_URL)
+    name = "remote"
+
+    def __init__(self, timeout: float = 30.0, pool_size: int = 8):
+        self.api_url = settings.OCR_API_URL
+        self.api_key = settings.OCR_API_KEY
+        self.regions = ["vn"]
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        # Sync session (keep-alive) cho script, async client tạo lazily trong event loop
+        self._session = requests.Session()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+
+        # Client dùng chung để tái sử dụng kết nối keep-alive
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                headers={'Authorization': f'{self.api_key}'},
+                timeout=httpx.Timeout(self.timeout, connect=5.0),
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size
+                )
+            )
+        return self._client
+
+    def recognize(self, image_bytes):
+        files = {'upload': ('image.jpg', image_bytes, 'image/jpeg')}
+        headers = {'Authorization': f'{self.api_key}'}
+        data = {'regions': self.regions}  # Optional: specify regions
+
+        print(f"[OCR] Sending request to {self.api_url}...")
+        print(f"[OCR] Regions: {self.regions}")
+
+        response = self._session.post(
+            self.api_url,
+            data=data,
+            files=files,
+            headers=headers,
+            timeout=self.timeout
+        )
+        return self._handle_response(response.status_code, response.text, response.json)
+
+    async def recognize_async(self, image_bytes):
+        files = {'upload': ('image.jpg', image_bytes, 'image/jpeg')}
+        data = {'regions': self.regions}
+
+        print(f"[OCR] Sending async request to {self.api_url}...")
+
+        response = await self._get_client().post(self.api_url, data=data, files=files)
+        return self._handle_response(response.status_code, response.text, response.json)
+
+    def _handle_response(self, status_code, text, json_loader):
+        if status_code == 200 or status_code == 201:
+            result = json_loader()
+            print(f"[OCR] SUCCESS: {result}")
+            return self._parse_result(result)
+
+        print(f"[OCR] ERROR {status_code}: {text}")
+        return None
+
+    def _parse_result(self, result) -> Optional[Dict[str, Any]]:
         try:
             if 'results' in result and len(result['results']) > 0:
                 plate_data = result['results'][0]
-                
+
                 return {
                     'plate': plate_data.get('plate', ''),
                     'confidence': plate_data.get('score', 0),
@@ -49,7 +264,7 @@ class OCRService:
                     'vehicle_type': plate_data.get('vehicle', {}).get('type', ''),
                     'raw_result': result
                 }
-            
+
             return {
                 'plate': 'UNKNOWN',
                 'confidence': 0,
@@ -57,10 +272,276 @@ class OCRService:
                 'vehicle_type': '',
                 'raw_result': result
             }
-        
+
         except Exception as e:
             print(f"[OCR] Error parsing result: {e}")
             return None
 
+    async def aclose(self):
+
+        # Đóng connection pool khi server shutdown
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        self._session.close()
+
+    def close(self):
+        self._session.close()
+
+class LocalOCRBackend(OCRBackend):
+    """
+    Backend nhận diện offline trên CPU bằng model ONNX nhỏ
+    Model nhận ảnh xám (1, H, W, 1) uint8 và trả về xác suất (1, slots, alphabet),
+    ký tự pad của alphabet dùng để đánh dấu ô trống
+    """
+    name = "local"
+
+    def __init__(self, model_path: str, alphabet: str, pad_char: str = "_", workers: int = 2):
+        self.model_path = model_path
+        self.alphabet = alphabet
+        self.pad_char = pad_char
+        self.workers = workers
+
+        self._session = None
+        self._input_name = None
+        self._input_size = None  # (height, width)
+        self._load_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr-local")
+
+    def _load(self):
+
+        # Load model một lần duy nhất (thread-safe)
+        if self._session is not None:
+            return self._session
+
+        with self._load_lock:
+            if self._session is None:
+                if ort is None or np is None:
+                    raise RuntimeError("Local OCR requires numpy and onnxruntime")
+
+                options = ort.SessionOptions()
+                options.intra_op_num_threads = 1  # Song song hóa bằng worker pool
+                session = ort.InferenceSession(
+                    self.model_path,
+                    sess_options=options,
+                    providers=["CPUExecutionProvider"]
+                )
+                model_input = session.get_inputs()[0]
+                self._input_name = model_input.name
+                self._input_size = (int(model_input.shape[1]), int(model_input.shape[2]))
+                self._session = session
+                print(f"[OCR LOCAL] Model loaded: {self.model_path} (input {self._input_size})")
+
+        return self._session
+
+    def warmup(self):
+        try:
+            self._load()
+            return True
+        except Exception as e:
+            print(f"[OCR LOCAL] ERROR Cannot load model: {e}")
+            return False
+
+    def recognize(self, image_bytes):
+        session = self._load()
+        height, width = self._input_size
+
+        img = Image.open(io.BytesIO(image_bytes))
+        img.draft('L', (width * 2, height * 2))
+        img = img.convert('L').resize((width, height), Image.BILINEAR)
+        tensor = np.asarray(img, dtype=np.uint8).reshape(1, height, width, 1)
+
+        output = session.run(None, {self._input_name: tensor})[0]
+        probs = np.asarray(output, dtype=np.float32).reshape(-1, len(self.alphabet))
+
+        # Decode: ký tự có xác suất cao nhất ở mỗi slot, bỏ ký tự pad
+        indices = probs.argmax(axis=1)
+        scores = probs.max(axis=1)
+        chars = [self.alphabet[i] for i in indices]
+        kept = [score for char, score in zip(chars, scores) if char != self.pad_char]
+        plate = "".join(char for char in chars if char != self.pad_char)
+
+        if not plate:
+            return {
+                'plate': 'UNKNOWN',
+                'confidence': 0,
+                'region': '',
+                'vehicle_type': ''
+            }
+
+        return {
+            'plate': plate,
+            'confidence': round(float(np.mean(kept)), 4),
+            'region': 'vn',
+            'vehicle_type': ''
+        }
+
+    async def recognize_async(self, image_bytes):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.recognize, image_bytes)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def aclose(self):
+        self.close()
+
+def create_backend(name: Optional[str] = None) -> OCRBackend:
+
+    # Chọn backend theo settings.OCR_BACKEND ("remote" | "local")
+    name = name or getattr(settings, "OCR_BACKEND", "remote")
+    timeout = getattr(settings, "OCR_TIMEOUT", 30.0)
+
+    if name == "local":
+        return LocalOCRBackend(
+            model_path=getattr(settings, "OCR_LOCAL_MODEL_PATH", "models/plate_ocr.onnx"),
+            alphabet=getattr(settings, "OCR_LOCAL_ALPHABET", "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_"),
+            workers=getattr(settings, "OCR_LOCAL_WORKERS", 2)
+        )
+
+    return RemoteOCRBackend(
+        timeout=timeout,
+        pool_size=getattr(settings, "OCR_POOL_SIZE", 8)
+    )
+
+class OCRService:
+    def __init__(self, backend: Optional[OCRBackend] = None):
+        self.backend = backend or create_backend()
+
+        # Giới hạn số request OCR chạy đồng thời và deadline mỗi request
+        self.max_concurrency = getattr(settings, "OCR_MAX_CONCURRENCY", 4)
+        self.timeout = getattr(settings, "OCR_TIMEOUT", 30.0)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        # Thống kê latency và payload gửi tới backend
+        self.calls = 0
+        self.total_ms = 0.0
+        self.total_bytes = 0
+
+        # Cache kết quả cho các frame lặp lại của cùng một xe
+        self.cache = PlateResultCache(
+            max_size=getattr(settings, "OCR_CACHE_SIZE", 256),
+            ttl=getattr(settings, "OCR_CACHE_TTL", 30.0),
+            tolerance=getattr(settings, "OCR_CACHE_TOLERANCE", 2)
+        )
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def recognize_plate(self, image_bytes):
+
+        # Sync entry point (dùng cho script, KHÔNG gọi trong async handler)
+        image = self.cache.load(image_bytes)
+        cached = self.cache.get(image)
+        if cached:
+            print(f"[OCR] Cache hit: {cached.get('plate')}")
+            return cached
+
+        try:
+            result = self.backend.recognize(image_bytes)
+            self.cache.put(image, result)
+            return result
+
+        except Exception as e:
+            print(f"[OCR] Exception: {e}")
+            return None
+
+    async def recognize_plate_async(self, image_bytes, timeout: Optional[float] = None):
+        """
+        Nhận diện biển số không chặn event loop
+
+        Args:
+            image_bytes: Nội dung ảnh JPEG
+            timeout: Deadline cho cả request (kể cả thời gian chờ slot), mặc định OCR_TIMEOUT
+
+        Returns: Dict kết quả như recognize_plate, hoặc None nếu lỗi/quá hạn
+        """
+        deadline = timeout if timeout is not None else self.timeout
+
+        # Decode và hash vùng biển trong thread pool (tốn CPU)
+        image = await asyncio.to_thread(self.cache.load, image_bytes)
+        cached = await asyncio.to_thread(self.cache.get, image)
+        if cached:
+            print(f"[OCR] Cache hit: {cached.get('plate')}")
+            return cached
+
+        try:
+            result = await asyncio.wait_for(self._recognize_limited(image_bytes), timeout=deadline)
+            await asyncio.to_thread(self.cache.put, image, result)
+            return result
+        except asyncio.TimeoutError:
+            print(f"[OCR] Timeout after {deadline:.1f}s")
+            return None
+        except Exception as e:
+            print(f"[OCR] Exception: {e}")
+            return None
+
+    async def recognize_best(
+        self,
+        frames: List[bytes],
+        accept: Optional[Callable[[Dict[str, Any]], bool]] = None
+    ) -> Tuple[Optional[Dict[str, Any]], int]:
+        """
+        OCR song song một burst nhiều frame, dừng sớm khi có frame đạt yêu cầu
+
+        Args:
+            frames: Danh sách ảnh JPEG của cùng một lượt xe
+            accept: Hàm kiểm tra kết quả đủ tốt (vd. ngưỡng của GateService.should_open_gate)
+
+        Returns: (kết quả tốt nhất, index của frame thắng), (None, -1) nếu mọi frame lỗi
+        """
+        tasks = {
+            asyncio.create_task(self.recognize_plate_async(frame)): index
+            for index, frame in enumerate(frames)
+        }
+        pending = set(tasks)
+        best, best_index = None, -1
+
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result and (best is None or result.get('confidence', 0) > best.get('confidence', 0)):
+                        best, best_index = result, tasks[task]
+
+                if best and accept and accept(best):
+                    if pending:
+                        print(f"[OCR] Burst early exit on frame {best_index} ({len(pending)} cancelled)")
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+
+        return best, best_index
+
+    async def _recognize_limited(self, image_bytes):
+        async with self._get_semaphore():
+            started = time.perf_counter()
+            try:
+                return await self.backend.recognize_async(image_bytes)
+            finally:
+                self.calls += 1
+                self.total_ms += (time.perf_counter() - started) * 1000
+                self.total_bytes += len(image_bytes)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend.name,
+            "max_concurrency": self.max_concurrency,
+            "timeout": self.timeout,
+            "calls": self.calls,
+            "avg_latency_ms": round(self.total_ms / self.calls, 2) if self.calls else None,
+            "avg_payload_bytes": int(self.total_bytes / self.calls) if self.calls else None,
+            "cache": self.cache.stats()
+        }
+
+    async def aclose(self):
+
+        # Giải phóng tài nguyên backend khi server shutdown
+        await self.backend.aclose()
+
 # Singleton instance
 ocr_service = OCRService()
@@ -5,7 +5,6 @@ Provides OTA firmware update functionality as a service
 from fastapi import APIRouter, File, UploadFile, Request, Cookie
 from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-import paho.mqtt.client as mqtt
 import os
 import json
 import hashlib
@@ -13,6 +12,8 @@ from datetime import datetime
 from config import settings
 from typing import Optional
 from session_manager import verify_super_admin
+from .mqtt_handler import mqtt_manager
+from .websocket_service import websocket_service
 
 # Ensure firmware directory exists
 os.makedirs(settings.FIRMWARE_DIR, exist_ok=True)
@@ -21,9 +22,6 @@ os.makedirs(settings.FIRMWARE_DIR, exist_ok=True)
 router = APIRouter(prefix="/ota", tags=["OTA"])
 templates = Jinja2Templates(directory="templates")
 
-# MQTT Client
-mqtt_client = None
-
 # Danh sách thiết bị
 DEVICES = {
     "NODE_01": {
@@ -56,42 +54,27 @@ DEVICES = {
     }
 }
 
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        print(f"[OTA MQTT] Connected to broker: {settings.MQTT_BROKER}:{settings.MQTT_PORT}")
-    else:
-        print(f"[OTA MQTT] Connection failed with code {rc}")
-
-def on_publish(client, userdata, mid):
-    print(f"[OTA MQTT] Message published (mid: {mid})")
+# Thiết bị báo tiến trình OTA trên <topic OTA>/status (vd. iot/parking/node/01/ota/status)
+OTA_STATUS_TOPICS = ("iot/parking/+/ota/status", "iot/parking/+/+/ota/status")
 
-def init_mqtt():
-    # Initialize MQTT client for OTA service
-    global mqtt_client
-    mqtt_client = mqtt.Client(client_id="ota_service")
-    mqtt_client.on_connect = on_connect
-    mqtt_client.on_publish = on_publish
-    
-    # Set authentication if available
-    if settings.MQTT_USERNAME and settings.MQTT_USERNAME.strip():
-        mqtt_client.username_pw_set(settings.MQTT_USERNAME, settings.MQTT_PASSWORD)
-        print(f"[OTA MQTT] Using authentication with username: {settings.MQTT_USERNAME}")
-    
-    try:
-        mqtt_client.connect(settings.MQTT_BROKER, settings.MQTT_PORT, 60)
-        mqtt_client.loop_start()
-        print("[OTA MQTT] SUCCESS - MQTT initialized")
-        return True
-    except Exception as e:
-        print(f"[OTA MQTT] ERROR: {e}")
-        return False
+def handle_ota_status(data, topic):
+    # Callback từ MQTT thread: chuyển tiến trình OTA tới dashboard (channel ota)
+    ota_topic = topic[:-len("/status")]
+    device_id = next((device_id for device_id, device in DEVICES.items() if device["topic"] == ota_topic), None)
+    print(f"[OTA] Status from {device_id or topic}: {data}")
+    websocket_service.queue_broadcast({
+        "type": "ota_status",
+        "device_id": device_id,
+        "topic": topic,
+        "status": data.get("status"),
+        "message": data.get("message"),
+        "timestamp": datetime.now().isoformat()
+    })
 
-def shutdown_mqtt():
-    global mqtt_client
-    if mqtt_client:
-        mqtt_client.loop_stop()
-        mqtt_client.disconnect()
-        print("[OTA MQTT] Shutdown complete")
+def attach(mqtt_handler):
+    # Đăng ký nhận status OTA trên kết nối MQTT dùng chung
+    for topic in OTA_STATUS_TOPICS:
+        mqtt_handler.add_handler(topic, handle_ota_status, with_topic=True)
 
 def calculate_md5(file_path):
     md5_hash = hashlib.md5()
@@ -274,15 +257,10 @@ async def trigger_ota_update(request: Request, session_id: Optional[str] = Cooki
         
         print(f"[OTA DEBUG] ota_message = {json.dumps(ota_message, indent=2)}")
         
-        # Send MQTT message
-        if mqtt_client:
-            result = mqtt_client.publish(
-                topic,
-                json.dumps(ota_message),
-                qos=1
-            )
-            
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+        # Send MQTT message qua kết nối dùng chung của server
+        if mqtt_manager.is_connected():
+            # Chờ broker xác nhận mà không chặn event loop
+            if await mqtt_manager.publish_async(topic, ota_message, timeout=5.0, retries=2):
                 print(f"[OTA] Trigger sent to {device_id} ({device['name']})")
                 print(f"[OTA] Topic: {topic}")
                 print(f"[OTA] Firmware: {firmware_file} ({file_size} bytes)")
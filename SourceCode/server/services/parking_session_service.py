@@ -0,0 +1,202 @@
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy.orm import Session
+
+from config import settings
+from models import SessionLocal, ParkingSession
+from .plate_index import match_plate
+from .tariff_service import tariff_service
+
+def session_to_dict(session: ParkingSession, now: Optional[datetime] = None) -> Dict[str, Any]:
+
+    # Lượt đang mở: thời lượng tính tới hiện tại
+    if session.duration_seconds is not None:
+        duration = session.duration_seconds
+    else:
+        duration = int(((now or datetime.utcnow()) - session.entry_time).total_seconds())
+    return {
+        "id": session.id,
+        "license_plate": session.license_plate,
+        "entry_log_id": session.entry_log_id,
+        "exit_log_id": session.exit_log_id,
+        "entry_time": session.entry_time.isoformat() if session.entry_time else None,
+        "exit_time": session.exit_time.isoformat() if session.exit_time else None,
+        "duration_seconds": duration,
+        "status": session.status,
+        "fee": session.fee,
+        "tariff_version": session.tariff_version
+    }
+
+class ParkingSessionService:
+    """
+    Ghép log entry/exit thành lượt gửi xe (bảng parking_sessions)
+    Các lượt đang mở được giữ trong dict biển số -> session nên tra cứu khi xe ra là O(1),
+    dict được dựng lại từ DB lúc startup
+    """
+    def __init__(self, reentry_window: float = 120.0):
+        # Entry lặp lại của cùng biển số trong khoảng này (camera trigger lại) dùng lại lượt đang mở
+        self.reentry_window = reentry_window
+        self._open: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.closed = 0
+        self.fuzzy_matches = 0
+        self.unmatched_exits = 0
+        self.reentries = 0
+
+    def load_from_db(self) -> int:
+
+        # Dựng lại các lượt đang mở (gọi lúc startup)
+        db = SessionLocal()
+        try:
+            sessions = db.query(ParkingSession).filter(
+                ParkingSession.status == "open"
+            ).order_by(ParkingSession.entry_time).all()
+        finally:
+            db.close()
+
+        with self._lock:
+            self._open = {
+                s.license_plate: {"id": s.id, "entry_time": s.entry_time, "entry_log_id": s.entry_log_id}
+                for s in sessions
+            }
+        print(f"[SESSION] Loaded {len(self._open)} open sessions")
+        return len(self._open)
+
+    def _find_open(self, plate: str) -> Optional[str]:
+
+        # Khớp chính xác trước, rồi khớp gần đúng (1 lỗi OCR) nếu chỉ có đúng một ứng viên tốt nhất
+        if plate in self._open:
+            return plate
+        matches = match_plate(plate, self._open)
+        if not matches:
+            return None
+        if len(matches) > 1 and matches[0][1] == matches[1][1]:
+            return None
+        self.fuzzy_matches += 1
+        return matches[0][0]
+
+    def record_entry(self, db: Session, plate: str, log_id: Optional[int], timestamp: datetime) -> ParkingSession:
+        """
+        Mở lượt gửi xe mới. Nếu biển số đã có lượt mở:
+        - vào lại trong reentry_window: dùng lại lượt đó (entry trùng)
+        - ngược lại (mất log exit): lượt cũ được đánh dấu "orphaned"
+        Bảng trong bộ nhớ chỉ đổi sau khi commit thành công
+        """
+        with self._lock:
+            previous = self._open.get(plate)
+
+        if previous and (timestamp - previous["entry_time"]).total_seconds() < self.reentry_window:
+            session = db.query(ParkingSession).filter(ParkingSession.id == previous["id"]).first()
+            if session:
+                with self._lock:
+                    self.reentries += 1
+                print(f"[SESSION] Re-entry of {plate} within {self.reentry_window:.0f}s, reusing session {session.id}")
+                return session
+
+        try:
+            if previous:
+                db.query(ParkingSession).filter(ParkingSession.id == previous["id"]).update(
+                    {"status": "orphaned"}, synchronize_session=False
+                )
+
+            session = ParkingSession(
+                license_plate=plate,
+                entry_log_id=log_id,
+                entry_time=timestamp,
+                status="open"
+            )
+            db.add(session)
+            db.commit()
+            db.refresh(session)
+        except Exception:
+            db.rollback()
+            raise
+
+        if previous:
+            print(f"[SESSION] Orphaned session {previous['id']} ({plate}) - no exit recorded")
+        with self._lock:
+            self._open[plate] = {"id": session.id, "entry_time": timestamp, "entry_log_id": log_id}
+            self.opened += 1
+        print(f"[SESSION] Opened session {session.id} ({plate})")
+        return session
+
+    def record_exit(self, db: Session, plate: str, log_id: Optional[int], timestamp: datetime) -> Optional[ParkingSession]:
+        """
+        Đóng lượt gửi xe đang mở của biển số (bỏ khỏi bảng trong bộ nhớ sau khi commit thành công)
+        Returns: session đã đóng, None nếu không tìm thấy lượt vào tương ứng
+        """
+        with self._lock:
+            matched_plate = self._find_open(plate)
+            entry = self._open.get(matched_plate) if matched_plate else None
+            if not entry:
+                self.unmatched_exits += 1
+
+        if not entry:
+            print(f"[SESSION] WARNING No open session for {plate}")
+            return None
+
+        try:
+            session = db.query(ParkingSession).filter(ParkingSession.id == entry["id"]).first()
+            if session:
+                session.exit_log_id = log_id
+                session.exit_time = timestamp
+                session.duration_seconds = max(0, int((timestamp - session.entry_time).total_seconds()))
+                session.status = "closed"
+                session.fee = tariff_service.price(session.entry_time, timestamp)
+                session.tariff_version = tariff_service.tariff.version
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        # Bỏ lượt khỏi bảng (cả khi dòng DB không còn), trừ khi đã được thay bằng lượt mới
+        with self._lock:
+            if self._open.get(matched_plate) is entry:
+                del self._open[matched_plate]
+            if session:
+                self.closed += 1
+
+        if not session:
+            return None
+        print(f"[SESSION] Closed session {session.id} ({matched_plate}), {session.duration_seconds}s, fee {session.fee}")
+        return session
+
+    def current(self) -> List[Dict[str, Any]]:
+
+        # Xe đang trong bãi, lâu nhất trước (không truy vấn DB)
+        now = datetime.utcnow()
+        with self._lock:
+            items = list(self._open.items())
+        return sorted(
+            (
+                {
+                    "id": entry["id"],
+                    "license_plate": plate,
+                    "entry_log_id": entry["entry_log_id"],
+                    "entry_time": entry["entry_time"].isoformat(),
+                    "duration_seconds": int((now - entry["entry_time"]).total_seconds()),
+                    "fee_so_far": tariff_service.price(entry["entry_time"], now)
+                }
+                for plate, entry in items
+            ),
+            key=lambda item: item["entry_time"]
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "open": len(self._open),
+                "opened": self.opened,
+                "closed": self.closed,
+                "fuzzy_matches": self.fuzzy_matches,
+                "unmatched_exits": self.unmatched_exits,
+                "reentries": self.reentries
+            }
+
+# Singleton instance
+parking_session_service = ParkingSessionService(
+    reentry_window=getattr(settings, "SESSION_REENTRY_WINDOW", 120.0)
+)
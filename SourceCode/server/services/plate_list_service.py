@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import math
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional, Set
+
+from config import settings
+from models import SessionLocal, PlateListEntry
+from .plate_index import normalize_plate
+
+LIST_TYPES = ("allow", "deny")
+
+class BloomFilter:
+    """
+    Bloom filter đơn giản trên bytearray (double hashing từ một lần blake2b)
+    Không có false negative; false positive phải xác nhận lại với DB
+    """
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        # m = -n ln(p) / (ln 2)^2, k = m/n ln 2
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+class PlateListService:
+    """
+    Danh sách biển số cho phép/cấm, biên dịch sẵn trong bộ nhớ để quyết định mở cổng không cần truy vấn DB
+
+    - allow/deny: set biển số canonical, tra cứu O(1)
+    - Deny list rất lớn (vượt bloom_threshold): chỉ giữ Bloom filter trong bộ nhớ,
+      kết quả dương tính (hiếm) mới xác nhận lại với DB
+    - reload() chỉ đọc các dòng có updated_at mới hơn lần nạp trước
+    """
+    def __init__(self, bloom_threshold: int = 100000, bloom_error_rate: float = 0.001):
+        self.bloom_threshold = bloom_threshold
+        self.bloom_error_rate = bloom_error_rate
+
+        self._lock = threading.Lock()
+        self._allow: Set[str] = set()
+        self._deny: Set[str] = set()
+        self._deny_bloom: Optional[BloomFilter] = None
+        self._watermark: Optional[datetime] = None
+
+        self.checks = 0
+        self.matches: Dict[str, int] = {"allow": 0, "deny": 0}
+        self.bloom_false_positives = 0
+        self.reloads = 0
+
+    def load_from_db(self) -> int:
+
+        # Nạp toàn bộ danh sách (gọi lúc startup)
+        with self._lock:
+            self._allow, self._deny, self._deny_bloom, self._watermark = set(), set(), None, None
+        return self.reload()
+
+    def reload(self) -> int:
+        """
+        Nạp tăng dần các thay đổi kể từ lần nạp trước (gọi sau khi admin sửa danh sách)
+        Returns: số dòng đã áp dụng
+        """
+        db = SessionLocal()
+        try:
+            query = db.query(PlateListEntry)
+            if self._watermark:
+                query = query.filter(PlateListEntry.updated_at >= self._watermark)
+            rows = query.order_by(PlateListEntry.updated_at).all()
+        finally:
+            db.close()
+
+        with self._lock:
+            for row in rows:
+                target = self._allow if row.list_type == "allow" else self._deny
+                if row.is_active:
+                    target.add(row.license_plate)
+                    if row.list_type == "deny" and self._deny_bloom is not None:
+                        self._deny_bloom.add(row.license_plate)
+                else:
+                    target.discard(row.license_plate)
+                if row.updated_at and (self._watermark is None or row.updated_at > self._watermark):
+                    self._watermark = row.updated_at
+
+            # Deny list quá lớn: chuyển sang Bloom filter để giảm bộ nhớ
+            if self._deny_bloom is None and len(self._deny) > self.bloom_threshold:
+                self._deny_bloom = BloomFilter(len(self._deny) * 2, self.bloom_error_rate)
+                for plate in self._deny:
+                    self._deny_bloom.add(plate)
+                self._deny = set()
+                print(f"[PLATE LIST] Deny list compiled to Bloom filter ({self._deny_bloom.nbytes / 1024:.0f} KB)")
+
+            self.reloads += 1
+
+        if rows:
+            print(f"[PLATE LIST] Applied {len(rows)} change(s) - allow: {len(self._allow)}, deny: {self.deny_count}")
+        return len(rows)
+
+    @property
+    def deny_count(self) -> int:
+        return self._deny_bloom.count if self._deny_bloom is not None else len(self._deny)
+
+    def _is_denied(self, plate: str, confirm: bool = True) -> bool:
+        if self._deny_bloom is None:
+            return plate in self._deny
+        if plate not in self._deny_bloom:
+            return False
+        if not confirm:
+            return True
+
+        # Bloom dương tính: xác nhận với DB (bỏ qua false positive và dòng đã bị gỡ)
+        db = SessionLocal()
+        try:
+            denied = db.query(PlateListEntry.id).filter(
+                PlateListEntry.license_plate == plate,
+                PlateListEntry.list_type == "deny",
+                PlateListEntry.is_active == True
+            ).first() is not None
+        finally:
+            db.close()
+        if not denied:
+            self.bloom_false_positives += 1
+        return denied
+
+    def check(self, plate: Optional[str], confirm: bool = True) -> Optional[str]:
+        """
+        Args:
+            confirm: False - Bloom dương tính coi như "deny", không truy vấn DB (chỉ dùng khi không cần chắc chắn)
+
+        Returns: "deny", "allow" hoặc None nếu biển số không nằm trong danh sách nào
+        """
+        canonical = normalize_plate(plate)
+        self.checks += 1
+        if not canonical:
+            return None
+
+        if self._is_denied(canonical, confirm):
+            self.matches["deny"] += 1
+            return "deny"
+        if canonical in self._allow:
+            self.matches["allow"] += 1
+            return "allow"
+        return None
+
+    async def check_async(self, plate: Optional[str]) -> Optional[str]:
+
+        # Bloom dương tính cần xác nhận với DB: chạy trong thread pool, không chặn event loop
+        canonical = normalize_plate(plate)
+        bloom = self._deny_bloom
+        if canonical and bloom is not None and canonical in bloom:
+            return await asyncio.to_thread(self.check, plate)
+        return self.check(plate)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "allow": len(self._allow),
+            "deny": self.deny_count,
+            "deny_bloom_bytes": self._deny_bloom.nbytes if self._deny_bloom is not None else None,
+            "checks": self.checks,
+            "matches": dict(self.matches),
+            "bloom_false_positives": self.bloom_false_positives,
+            "reloads": self.reloads,
+            "watermark": self._watermark.isoformat() if self._watermark else None
+        }
+
+# Singleton instance
+plate_list_service = PlateListService(
+    bloom_threshold=getattr(settings, "PLATE_LIST_BLOOM_THRESHOLD", 100000),
+    bloom_error_rate=getattr(settings, "PLATE_LIST_BLOOM_ERROR_RATE", 0.001)
+)
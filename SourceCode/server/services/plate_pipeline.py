@@ -0,0 +1,155 @@
+from datetime import datetime
+from typing import Dict, Any, List, Tuple
+from sqlalchemy.orm import Session
+import asyncio
+import json
+
+from models import VehicleLog
+from .ocr_service import ocr_service
+from .image_preprocess import image_preprocessor
+from .image_store import image_store
+from .websocket_service import websocket_service
+from .gate_service import gate_service
+from .plate_index import plate_index, normalize_plate
+from .parking_session_service import parking_session_service
+
+async def process_plate_image(
+    frames: List[bytes],
+    direction: str,
+    db: Session
+) -> Tuple[int, Dict[str, Any]]:
+    """
+    Xử lý một lượt xe: OCR -> lưu ảnh -> VehicleLog -> broadcast -> điều khiển GATE
+    Dùng chung cho upload đồng bộ và OCR job worker
+
+    Args:
+        frames: Burst ảnh của cùng một lượt xe
+
+    Returns: (status_code, response content cho ESP32-CAM)
+    """
+    # Tiền xử lý (crop ROI, downscale, contrast) để giảm payload OCR
+    prepared = await asyncio.gather(*(image_preprocessor.preprocess(frame, direction) for frame in frames))
+    ocr_frames = [image for image, _ in prepared]
+
+    # Gọi OCR API (async, không chặn event loop)
+    print(f"[OCR] Processing {len(frames)} frame(s)...")
+    if len(frames) == 1:
+        result, frame_index = await ocr_service.recognize_plate_async(ocr_frames[0]), 0
+    else:
+        result, frame_index = await ocr_service.recognize_best(
+            ocr_frames,
+            # Đọc được biển số đủ tin cậy là đủ, kể cả xe bị cấm (không cần thử thêm frame)
+            accept=lambda r: gate_service.accepted(gate_service.evaluate(r.get('plate'), r.get('confidence', 0), confirm=False)[1])
+        )
+
+    # Ghi lại biến đổi ROI để map tọa độ OCR về ảnh gốc
+    if result and prepared[frame_index][1]:
+        result = dict(result, preprocess=prepared[frame_index][1])
+
+    if result:
+        # Chuẩn hóa biển số (bỏ dấu, sửa O/0, B/8...), chuỗi OCR gốc vẫn nằm trong ocr_result
+        plate = normalize_plate(result.get('plate')) or 'UNKNOWN'
+        confidence = result.get('confidence', 0)
+
+        print(f"[OCR] Success Plate: {plate} (confidence: {confidence:.2f})")
+        if len(frames) > 1:
+            print(f"[UPLOAD] Best frame: {frame_index + 1}/{len(frames)}")
+
+        # Chỉ lưu frame thắng vào image store (một lần, content-addressed)
+        image_key = await asyncio.to_thread(image_store.put, frames[frame_index])
+        print(f"[STORE] Saved frame: {image_key}")
+
+        # Cùng ngưỡng với quyết định mở cổng (xe trong allow list có ngưỡng thấp hơn)
+        decision = await gate_service.evaluate_async(plate, confidence)
+
+        # Ảnh đạt ngưỡng được "archive" bằng cách VehicleLog tham chiếu key, không di chuyển file
+        if gate_service.accepted(decision[1]):
+            final_path = image_key
+        else:
+            print("[ARCHIVE] Low confidence")
+            final_path = None
+
+        # Lưu vào database khi thành công
+        log_id = None
+        session_id = None
+        if final_path:
+            try:
+                # Xác định action dựa vào direction
+                action = "entry" if direction == "in" else "exit"
+
+                log = VehicleLog(
+                    license_plate=plate,
+                    raw_plate=result.get('plate'),
+                    image_path=final_path,
+                    ocr_result=json.dumps(result),
+                    confidence=str(confidence),
+                    action=action
+                )
+                db.add(log)
+                db.commit()
+                db.refresh(log)
+                log_id = log.id
+                plate_index.add(plate)
+                print(f"[DATABASE] SUCCESS Saved (ID: {log.id}, Action: {action})")
+            except Exception as db_error:
+                print(f"[DATABASE] Error: {db_error}")
+            
+            # Ghép entry/exit thành lượt gửi xe
+            if log_id:
+                try:
+                    if action == "entry":
+                        session = parking_session_service.record_entry(db, plate, log_id, log.timestamp)
+                    else:
+                        session = parking_session_service.record_exit(db, plate, log_id, log.timestamp)
+                    session_id = session.id if session else None
+                except Exception as session_error:
+                    db.rollback()
+                    print(f"[SESSION] Error: {session_error}")
+        else:
+            print("[DATABASE] Skipped - low confidence")
+
+        # Broadcast WebSocket (chỉ enqueue vào queue của từng client)
+        websocket_service.broadcast({
+            'type': 'new_vehicle',
+            'log_id': log_id,
+            'plate': plate,
+            'confidence': confidence,
+            'timestamp': datetime.now().isoformat()
+        })
+
+        # Điều khiển GATE qua MQTT
+        if gate_service:
+            gate_result = await gate_service.process_ocr_result(plate, confidence, direction, decision)
+            gate_action = gate_result.get('action', 'none')
+            gate_rule = gate_result.get('rule')
+        else:
+            gate_action = "none"
+            gate_rule = None
+            print("[GATE] ERROR Gate service not available")
+
+        return 200, {
+            "success": True,
+            "plate": plate,
+            "confidence": confidence,
+            "message": f"Biển số: {plate}",
+            "action": gate_action,
+            "rule": gate_rule,
+            "image_key": final_path,
+            "session_id": session_id,
+            # Giá trị lưu trong VehicleLog.image_path (như trước): key của image store, đọc qua image_store.read
+            # (ảnh có thể đã được đóng gói vào segment, không còn file riêng)
+            "saved_path": final_path
+        }
+    else:
+        print("[OCR] Failed")
+
+        # Gửi lệnh reject cho GATE
+        if gate_service:
+            await gate_service.send_reject_command("OCR failed", direction)
+
+        return 200, {
+            "success": False,
+            "error": "OCR_FAILED",
+            "message": "Không đọc được biển số",
+            "action": "reject"
+        }
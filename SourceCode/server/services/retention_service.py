@@ -0,0 +1,223 @@
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any, Optional, Set
+
+from config import settings
+from models import SessionLocal, VehicleLog
+from .image_store import image_store
+
+DAY = 24 * 3600
+
+class RetentionService:
+    """
+    Janitor chạy nền dọn ảnh theo tuổi và ngân sách dung lượng từng thư mục:
+    - TEMP_DIR / ARCHIVE_DIR (file phẳng kiểu cũ): xóa file quá hạn, rồi xóa file cũ nhất khi vượt ngân sách
+    - Image store: xóa frame không được VehicleLog tham chiếu khi quá hạn, gom ảnh nhỏ đã cũ vào segment,
+      bỏ segment cũ nhất khi vượt ngân sách
+    """
+    def __init__(self, interval: float = 3600, targets: Optional[Dict[str, Dict[str, Any]]] = None, store_policy: Optional[Dict[str, Any]] = None):
+        self.interval = interval
+        self.targets = targets or {
+            "temp": {"path": settings.TEMP_DIR, "max_age_days": 7, "max_bytes": 1 * 1024 ** 3},
+            "archive": {"path": settings.ARCHIVE_DIR, "max_age_days": 90, "max_bytes": 10 * 1024 ** 3}
+        }
+        self.store_policy = store_policy or {
+            "unreferenced_max_age_days": 7,
+            "max_age_days": 180,
+            "max_bytes": 20 * 1024 ** 3,
+            "pack_after_days": 1,
+            "pack_max_file_bytes": 256 * 1024
+        }
+
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self._progress: Dict[str, Any] = {
+            "running": False,
+            "phase": None,
+            "runs": 0,
+            "last_started": None,
+            "last_finished": None,
+            "last_duration_s": None,
+            "last_error": None,
+            "scanned_files": 0,
+            "deleted_files": 0,
+            "reclaimed_bytes": 0,
+            "packed_files": 0,
+            "packed_bytes": 0,
+            "usage": {}
+        }
+
+    def _update(self, **values):
+        with self._lock:
+            self._progress.update(values)
+
+    def _add(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self._progress[key] += value
+
+    def _remove(self, path: str, size: int) -> bool:
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        self._add(deleted_files=1, reclaimed_bytes=size)
+        return True
+
+    def sweep(self):
+        """Một lượt dọn dẹp đầy đủ (blocking, chạy trong worker thread)"""
+        started = time.monotonic()
+        self._update(running=True, last_started=datetime.now().isoformat(), last_error=None)
+        try:
+            for name, target in self.targets.items():
+                self._update(phase=name)
+                self._sweep_directory(name, target)
+
+            self._update(phase="store")
+            self._sweep_store()
+        except Exception as e:
+            print(f"[RETENTION] ERROR {e}")
+            self._update(last_error=str(e))
+        finally:
+            self._update(
+                running=False,
+                phase=None,
+                last_finished=datetime.now().isoformat(),
+                last_duration_s=round(time.monotonic() - started, 2)
+            )
+            self._add(runs=1)
+
+    def _sweep_directory(self, name: str, target: Dict[str, Any]):
+        path = target["path"]
+        if not os.path.isdir(path):
+            return
+
+        cutoff = time.time() - target["max_age_days"] * DAY
+        files = []
+        for entry in os.scandir(path):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            self._add(scanned_files=1)
+            if stat.st_mtime < cutoff:
+                self._remove(entry.path, stat.st_size)
+            else:
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        # Vượt ngân sách: xóa file cũ nhất trước
+        total = sum(size for _, size, _ in files)
+        files.sort()
+        while files and total > target["max_bytes"]:
+            _, size, file_path = files.pop(0)
+            if self._remove(file_path, size):
+                total -= size
+
+        self._set_usage(name, total, len(files))
+        print(f"[RETENTION] {name}: {len(files)} files, {total / 1024 ** 2:.1f} MB")
+
+    def _referenced_keys(self) -> Set[str]:
+        db = SessionLocal()
+        try:
+            rows = db.query(VehicleLog.image_path).filter(VehicleLog.image_path.isnot(None)).all()
+            return {row[0] for row in rows if image_store.is_key(row[0])}
+        finally:
+            db.close()
+
+    def _sweep_store(self):
+        policy = self.store_policy
+        now = time.time()
+        referenced = self._referenced_keys()
+
+        unreferenced_cutoff = now - policy["unreferenced_max_age_days"] * DAY
+        age_cutoff = now - policy["max_age_days"] * DAY
+        pack_cutoff = now - policy["pack_after_days"] * DAY
+
+        loose = []
+        to_pack = []
+        for key, path, size, mtime in image_store.iter_loose():
+            self._add(scanned_files=1)
+            is_referenced = key in referenced
+            if mtime < age_cutoff or (not is_referenced and mtime < unreferenced_cutoff):
+                self._remove(path, size)
+                continue
+            if is_referenced and mtime < pack_cutoff and size <= policy["pack_max_file_bytes"]:
+                to_pack.append(key)
+                continue
+            loose.append((not is_referenced, mtime, size, path))
+
+        # Gom ảnh nhỏ đã cũ vào segment
+        if to_pack:
+            packed, packed_bytes = image_store.pack(to_pack)
+            self._add(packed_files=packed, packed_bytes=packed_bytes)
+            print(f"[RETENTION] Packed {packed} images ({packed_bytes / 1024 ** 2:.1f} MB)")
+
+        segments = []
+        for segment in image_store.segments():
+            if segment["mtime"] < age_cutoff:
+                self._add(deleted_files=1, reclaimed_bytes=image_store.drop_segment(segment["segment_id"]))
+            else:
+                segments.append(segment)
+
+        # Vượt ngân sách: ảnh không tham chiếu trước, rồi segment cũ nhất, rồi ảnh rời cũ nhất
+        total = sum(item[2] for item in loose) + sum(segment["size"] for segment in segments)
+        loose.sort(key=lambda item: (not item[0], item[1]))
+        while total > policy["max_bytes"] and loose and loose[0][0]:
+            _, _, size, path = loose.pop(0)
+            if self._remove(path, size):
+                total -= size
+        while total > policy["max_bytes"] and segments:
+            segment = segments.pop(0)
+            freed = image_store.drop_segment(segment["segment_id"])
+            self._add(deleted_files=1, reclaimed_bytes=freed)
+            total -= segment["size"]
+        while total > policy["max_bytes"] and loose:
+            _, _, size, path = loose.pop(0)
+            if self._remove(path, size):
+                total -= size
+
+        self._set_usage("store", total, len(loose) + len(segments))
+        print(f"[RETENTION] store: {len(loose)} loose files, {len(segments)} segments, {total / 1024 ** 2:.1f} MB")
+
+    def _set_usage(self, name: str, total_bytes: int, files: int):
+        with self._lock:
+            self._progress["usage"][name] = {"bytes": total_bytes, "files": files}
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                print(f"[RETENTION] Worker error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+
+        # Khởi động janitor (gọi trong event loop)
+        self._task = asyncio.create_task(self._run())
+        print(f"[RETENTION] SUCCESS Janitor started (interval: {self.interval}s)")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            progress = dict(self._progress)
+            progress["usage"] = dict(self._progress["usage"])
+        progress["store"] = image_store.stats()
+        return progress
+
+# Singleton instance
+retention_service = RetentionService(
+    interval=getattr(settings, "RETENTION_INTERVAL_SECONDS", 3600),
+    targets=getattr(settings, "RETENTION_TARGETS", None),
+    store_policy=getattr(settings, "RETENTION_STORE_POLICY", None)
+)
@@ -1,66 +1,485 @@
+import threading
+import time
+import uuid
+from collections import deque
+from itertools import islice
 from datetime import datetime
-from typing import Callable, Optional, Dict, Any
-from sqlalchemy.orm import Session
+from typing import Callable, Optional, Dict, Any, Tuple, List
 
-from models import ParkingSlot, get_db
+from sqlalchemy import select, update, insert, bindparam
+from sqlalchemy.exc import IntegrityError
+
+from config import settings
+from models import ParkingSlot, SessionLocal
+
+class SlotStateFilter:
+    """
+    Lọc trạng thái slot từ cảm biến siêu âm hay nhấp nháy (xe đỗ lệch, người đi ngang)
+
+    NODE chỉ publish khi trạng thái đổi, nên filter được đánh giá theo tick (evaluate) thay vì theo message:
+    - Dwell bất đối xứng: trạng thái mới phải giữ ít nhất dwell_occupied (xe vào) / dwell_free (xe rời) giây
+      (NODE chỉ gửi occupied true/false nên không có ngưỡng khoảng cách vào/ra riêng để làm hysteresis thật)
+    - N-of-M: ít nhất required trong window tick gần nhất phải thấy trạng thái mới
+    - Slot đổi trạng thái >= flap_max_flips lần trong flap_window giây bị đánh dấu anomaly, giữ nguyên trạng thái
+      đã commit cho tới khi cảm biến ổn định lại flap_clear giây
+    """
+    def __init__(
+        self,
+        dwell_occupied: float = 2.0,
+        dwell_free: float = 4.0,
+        window: int = 6,
+        required: int = 4,
+        flap_window: float = 60.0,
+        flap_max_flips: int = 6,
+        flap_clear: float = 30.0
+    ):
+        self.dwell_occupied = dwell_occupied
+        self.dwell_free = dwell_free
+        self.window = window
+        self.required = required
+        self.flap_window = flap_window
+        self.flap_max_flips = flap_max_flips
+        self.flap_clear = flap_clear
+
+        self._slots: Dict[str, Dict[str, Any]] = {}
+        self._active: set = set()  # slot có raw khác committed hoặc đang flapping
+
+    def _slot(self, slot: str) -> Dict[str, Any]:
+        state = self._slots.get(slot)
+        if state is None:
+            state = self._slots[slot] = {
+                "committed": None,
+                "raw": None,
+                "since": 0.0,
+                "samples": deque(maxlen=self.window),
+                "flips": deque(),
+                "flapping": False
+            }
+        return state
+
+    def seed(self, slot: str, occupied: bool):
+
+        # Trạng thái đã lưu trong DB là trạng thái committed ban đầu
+        state = self._slot(slot)
+        state["committed"] = state["raw"] = occupied
+
+    def override(self, slot: str, occupied: bool):
+
+        # Admin đặt trạng thái thủ công: commit ngay, bỏ các mẫu cảm biến đang chờ
+        state = self._slot(slot)
+        state["committed"] = state["raw"] = occupied
+        state["samples"].clear()
+        self._active.discard(slot)
+
+    def observe(self, slot: str, occupied: bool, now: float):
+        state = self._slot(slot)
+        if state["raw"] == occupied:
+            return
+        if state["raw"] is not None:
+            state["flips"].append(now)
+        state["raw"] = occupied
+        state["since"] = now
+        if slot not in self._active:
+            state["samples"].clear()
+            self._active.add(slot)
+
+    def evaluate(self, now: float) -> Tuple[List[Tuple[str, bool]], List[Dict[str, Any]]]:
+        """
+        Returns: (các slot được commit [(slot, occupied)], các anomaly mới phát hiện)
+        """
+        commits, anomalies = [], []
+        for slot in list(self._active):
+            state = self._slots[slot]
+            raw = state["raw"]
+            state["samples"].append(raw)
+
+            flips = state["flips"]
+            while flips and now - flips[0] > self.flap_window:
+                flips.popleft()
+
+            if state["flapping"]:
+                if now - state["since"] < self.flap_clear:
+                    continue
+                state["flapping"] = False
+                flips.clear()
+                print(f"[SLOTS] Slot {slot} stable again")
+            elif len(flips) >= self.flap_max_flips:
+                state["flapping"] = True
+                anomalies.append({"slot": slot, "flips": len(flips), "window_s": self.flap_window, "committed": state["committed"]})
+                continue
+
+            if state["committed"] is None:
+                # Slot mới chưa có trạng thái: commit ngay
+                state["committed"] = raw
+                commits.append((slot, raw))
+            elif raw != state["committed"]:
+                dwell = self.dwell_occupied if raw else self.dwell_free
+                if now - state["since"] >= dwell and state["samples"].count(raw) >= self.required:
+                    state["committed"] = raw
+                    commits.append((slot, raw))
+
+            if state["committed"] == raw:
+                self._active.discard(slot)
+        return commits, anomalies
+
+    def flapping(self) -> List[str]:
+        return sorted(slot for slot, state in self._slots.items() if state["flapping"])
 
 class SlotUpdateService:
-    def __init__(self, websocket_callback: Optional[Callable] = None):
+    """
+    Write-behind cho trạng thái slot từ MQTT:
+    - handle_slot_update (paho network thread) chỉ cập nhật bảng slot trong bộ nhớ và broadcast, không chạm DB
+    - Thread flush ghi xuống parking_slots theo chu kỳ flush_interval hoặc khi đủ max_batch slot thay đổi,
+      mỗi slot chỉ ghi trạng thái mới nhất trong lô (bulk UPDATE executemany)
+    Crash chỉ mất tối đa một chu kỳ flush.
+
+    Nếu có state_filter, message thô chỉ được ghi nhận; trạng thái được commit (lưu + broadcast)
+    khi filter xác nhận ở tick đánh giá.
+
+    Mỗi commit tăng seq (trong một epoch = một lần chạy server) và được giữ trong ring buffer delta_buffer delta gần nhất:
+    dashboard reconnect gửi seq cuối cùng đã nhận và nhận lại các delta còn thiếu, hoặc snapshot nếu đã quá xa (sync).
+    """
+    def __init__(
+        self,
+        websocket_callback: Optional[Callable] = None,
+        flush_interval: float = 1.0,
+        max_batch: int = 500,
+        state_filter: Optional[SlotStateFilter] = None,
+        tick_interval: float = 0.5,
+        delta_buffer: int = 512
+    ):
         """
         Args:
             websocket_callback: Function để queue broadcast message
+            flush_interval: Chu kỳ ghi xuống DB (giây)
+            max_batch: Số slot thay đổi tối đa trước khi flush sớm
+            state_filter: Bộ lọc dwell/N-of-M/flapping, None = commit ngay mỗi message
+            tick_interval: Chu kỳ đánh giá filter (giây)
+            delta_buffer: Số delta gần nhất giữ lại cho client resume
         """
         self.websocket_callback = websocket_callback
-    
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.state_filter = state_filter
+        self.tick_interval = tick_interval if state_filter else flush_interval
+
+        self._lock = threading.Lock()
+        self._state: Dict[str, Dict[str, Any]] = {}             # slot -> {"occupied", "updated"}
+        self._dirty: Dict[str, Tuple[bool, datetime]] = {}      # slot -> trạng thái mới nhất chưa ghi
+        self._known: set = set()                                # slot đã có dòng trong parking_slots
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self._deltas = deque(maxlen=delta_buffer)               # {"seq", "slot", "occupied", "timestamp"}
+
+        self.received = 0
+        self.committed = 0
+        self._raw_times = deque(maxlen=10000)
+        self._commit_times = deque(maxlen=10000)
+        self._anomalies = deque(maxlen=100)
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_errors = 0
+        self.last_flush_ms: Optional[float] = None
+
+    def load(self):
+
+        # Nạp trạng thái hiện tại từ DB vào bảng trong bộ nhớ
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(ParkingSlot.slot_number, ParkingSlot.is_occupied, ParkingSlot.last_updated)
+            ).all()
+        finally:
+            db.close()
+
+        with self._lock:
+            for slot_number, is_occupied, last_updated in rows:
+                self._known.add(slot_number)
+                self._state.setdefault(slot_number, {"occupied": bool(is_occupied), "updated": last_updated})
+                if self.state_filter:
+                    self.state_filter.seed(slot_number, self._state[slot_number]["occupied"])
+        print(f"[SLOTS] Loaded {len(rows)} slots")
+
     def handle_slot_update(self, data: Dict[str, Any]):
         """
         Callback khi nhận message slot update từ MQTT
         Message format: {"slot": "A1", "occupied": true}
         """
         print(f"[MQTT] Slot update: {data}")
-        
+
         try:
             slot_number = data.get('slot')
-            is_occupied = data.get('occupied', False)
-            
+            is_occupied = bool(data.get('occupied', False))
+
             if not slot_number:
                 print("[MQTT] ERROR Missing slot number")
                 return
-            
-            # Cập nhật database
-            db = next(get_db())
-            try:
-                slot = db.query(ParkingSlot).filter(ParkingSlot.slot_number == slot_number).first()
-                
-                if slot:
-                    slot.is_occupied = is_occupied
-                    slot.last_updated = datetime.utcnow()
-                else:
-                    # Tạo mới nếu chưa có
-                    slot = ParkingSlot(
-                        slot_number=slot_number,
-                        is_occupied=is_occupied
-                    )
-                    db.add(slot)
-                
-                db.commit()
-                print(f"[DATABASE] SUCCESS Slot {slot_number} -> {'OCCUPIED' if is_occupied else 'FREE'}")
-                
-                # Queue broadcast nếu có callback
-                if self.websocket_callback:
-                    message = {
-                        'type': 'slot_update',
-                        'slot': slot_number,
-                        'occupied': is_occupied,
-                        'timestamp': datetime.utcnow().isoformat()
-                    }
-                    self.websocket_callback(message)
-            
-            finally:
-                db.close()
-        
+
+            with self._lock:
+                self.received += 1
+                self._raw_times.append(time.monotonic())
+                if self.state_filter:
+                    # Chỉ ghi nhận, commit ở tick đánh giá của filter
+                    self.state_filter.observe(slot_number, is_occupied, time.monotonic())
+                    return
+
+            self._commit(slot_number, is_occupied)
+
         except Exception as e:
             print(f"[MQTT] Error handling slot update: {e}")
 
+    def set_manual(self, slot_number: str, is_occupied: bool):
+
+        # Admin cập nhật thủ công: không qua filter (không chờ dwell/N-of-M), commit ngay
+        with self._lock:
+            self.received += 1
+            if self.state_filter:
+                self.state_filter.override(slot_number, is_occupied)
+        self._commit(slot_number, is_occupied)
+
+    def _commit(self, slot_number: str, is_occupied: bool):
+
+        # Trạng thái đã xác nhận: cập nhật bảng trong bộ nhớ, đánh dấu dirty và broadcast (không chờ DB)
+        now = datetime.utcnow()
+        with self._lock:
+            self._state[slot_number] = {"occupied": is_occupied, "updated": now}
+            self._dirty[slot_number] = (is_occupied, now)
+            self.committed += 1
+            self._commit_times.append(time.monotonic())
+            batch_full = len(self._dirty) >= self.max_batch
+
+            self.seq += 1
+            delta = {
+                'seq': self.seq,
+                'slot': slot_number,
+                'occupied': is_occupied,
+                'timestamp': now.isoformat()
+            }
+            self._deltas.append(delta)
+
+            # Queue broadcast nếu có callback (trong lock để message vào queue đúng thứ tự seq; chỉ là enqueue)
+            if self.websocket_callback:
+                self.websocket_callback(dict(delta, type='slot_update'))
+
+        if batch_full:
+            self._wake.set()
+
+    def evaluate(self):
+
+        # Tick của filter: commit các slot đã ổn định, ghi nhận slot flapping
+        with self._lock:
+            commits, anomalies = self.state_filter.evaluate(time.monotonic())
+
+        for slot_number, is_occupied in commits:
+            self._commit(slot_number, is_occupied)
+
+        for anomaly in anomalies:
+            anomaly["time"] = datetime.utcnow().isoformat()
+            with self._lock:
+                self._anomalies.append(anomaly)
+            print(f"[SLOTS] ANOMALY Slot {anomaly['slot']} flapping ({anomaly['flips']} flips / {anomaly['window_s']:.0f}s), state held")
+            if self.websocket_callback:
+                self.websocket_callback(dict(anomaly, type='slot_anomaly'))
+
+    def _execute(self, statement, rows: List[Dict[str, Any]]):
+
+        # Mỗi loại câu lệnh một transaction riêng: INSERT lỗi không kéo UPDATE rollback theo
+        db = SessionLocal()
+        try:
+            db.execute(statement, rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _write_updates(self, batch: Dict[str, Tuple[bool, datetime]]):
+        if batch:
+            self._execute(
+                update(ParkingSlot.__table__)
+                .where(ParkingSlot.__table__.c.slot_number == bindparam("b_slot"))
+                .values(is_occupied=bindparam("b_occupied"), last_updated=bindparam("b_updated")),
+                [{"b_slot": slot, "b_occupied": occupied, "b_updated": updated} for slot, (occupied, updated) in batch.items()]
+            )
+
+    def _write_inserts(self, batch: Dict[str, Tuple[bool, datetime]]):
+        if batch:
+            self._execute(
+                insert(ParkingSlot.__table__),
+                [{"slot_number": slot, "is_occupied": occupied, "last_updated": updated} for slot, (occupied, updated) in batch.items()]
+            )
+
+    def _reload_known(self, slots: List[str]) -> set:
+
+        # Slot đã có trong DB mà _known chưa biết (load() lỗi hoặc dòng được tạo nơi khác)
+        db = SessionLocal()
+        try:
+            existing = set(db.execute(
+                select(ParkingSlot.slot_number).where(ParkingSlot.slot_number.in_(slots))
+            ).scalars())
+        finally:
+            db.close()
+        with self._lock:
+            self._known.update(existing)
+        return existing
+
+    def flush(self) -> int:
+        """
+        Ghi các slot thay đổi xuống DB (blocking, chạy trên thread flush)
+        Returns: số dòng đã ghi
+        """
+        with self._lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            known = set(self._known)
+
+        started = time.perf_counter()
+        updates = {slot: value for slot, value in batch.items() if slot in known}
+        inserts = {slot: value for slot, value in batch.items() if slot not in known}
+        failed: Dict[str, Tuple[bool, datetime]] = {}
+        errors = []
+
+        try:
+            self._write_updates(updates)
+        except Exception as e:
+            failed.update(updates)
+            errors.append(e)
+
+        try:
+            try:
+                self._write_inserts(inserts)
+            except IntegrityError:
+                # Trùng slot_number: nạp lại các slot đã tồn tại rồi ghi chúng bằng UPDATE
+                existing = self._reload_known(list(inserts))
+                print(f"[DATABASE] Slot insert conflict, retrying {len(existing)} slot(s) as update")
+                self._write_updates({slot: value for slot, value in inserts.items() if slot in existing})
+                self._write_inserts({slot: value for slot, value in inserts.items() if slot not in existing})
+        except Exception as e:
+            failed.update(inserts)
+            errors.append(e)
+
+        written = len(batch) - len(failed)
+        with self._lock:
+            self._known.update(slot for slot in inserts if slot not in failed)
+            if failed:
+                # Trả phần lỗi về hàng đợi (giữ bản mới hơn nếu slot đã thay đổi tiếp) để thử lại ở lần flush sau
+                for slot, value in failed.items():
+                    self._dirty.setdefault(slot, value)
+                self.flush_errors += 1
+            if written:
+                self.flushes += 1
+                self.rows_written += written
+                self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+
+        if failed:
+            print(f"[DATABASE] ERROR Slot flush failed ({len(failed)} slots): {errors[-1]}")
+        if written:
+            print(f"[DATABASE] SUCCESS Flushed {written} slot(s)")
+        return written
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while not self._stopping.is_set():
+            woken = self._wake.wait(self.tick_interval)
+            self._wake.clear()
+            try:
+                if self.state_filter:
+                    self.evaluate()
+                if woken or time.monotonic() - last_flush >= self.flush_interval:
+                    self.flush()
+                    last_flush = time.monotonic()
+            except Exception as e:
+                print(f"[SLOTS] Flush worker error: {e}")
+
+    def start(self):
+
+        # Nạp trạng thái và khởi động thread flush
+        try:
+            self.load()
+        except Exception as e:
+            print(f"[SLOTS] ERROR Could not load slots: {e}")
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="slot-flush", daemon=True)
+        self._thread.start()
+        print(f"[SLOTS] SUCCESS Write-behind started (interval: {self.flush_interval}s, batch: {self.max_batch})")
+
+    def stop(self):
+
+        # Dừng thread và flush phần còn lại (gọi sau khi ngắt MQTT)
+        self._stopping.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {slot: dict(state) for slot, state in self._state.items()}
+
+    def sync(self, epoch: Optional[str] = None, seq: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Trả lời resume của dashboard từ bộ nhớ (không truy vấn DB)
+        - Cùng epoch và các delta sau seq còn trong ring buffer: mode "delta"
+        - Ngược lại (lần đầu, server đã restart, client mất kết nối quá lâu): mode "snapshot"
+        """
+        with self._lock:
+            message = {"type": "slot_sync", "epoch": self.epoch, "seq": self.seq}
+            oldest = self._deltas[0]["seq"] if self._deltas else self.seq + 1
+            if epoch == self.epoch and isinstance(seq, int) and oldest - 1 <= seq <= self.seq:
+                message["mode"] = "delta"
+                message["deltas"] = list(islice(self._deltas, seq - oldest + 1, None))
+            else:
+                message["mode"] = "snapshot"
+                message["slots"] = {slot: state["occupied"] for slot, state in self._state.items()}
+            return message
+
+    def _rate(self, times: deque, window: float) -> float:
+        cutoff = time.monotonic() - window
+        return round(sum(1 for t in times if t >= cutoff) * 60.0 / window, 2)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "slots": len(self._state),
+                "received": self.received,
+                "committed": self.committed,
+                "epoch": self.epoch,
+                "seq": self.seq,
+                "buffered_deltas": len(self._deltas),
+                "raw_per_min": self._rate(self._raw_times, 300),
+                "committed_per_min": self._rate(self._commit_times, 300),
+                "filter": {
+                    "enabled": self.state_filter is not None,
+                    "flapping": self.state_filter.flapping() if self.state_filter else [],
+                    "anomalies": list(self._anomalies)[-20:]
+                },
+                "pending": len(self._dirty),
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "coalesced": self.committed - self.rows_written - len(self._dirty),
+                "flush_errors": self.flush_errors,
+                "last_flush_ms": self.last_flush_ms
+            }
+
 # Singleton instance
-slot_update_service: Optional[SlotUpdateService] = None
+slot_update_service = SlotUpdateService(
+    flush_interval=getattr(settings, "SLOT_FLUSH_INTERVAL", 1.0),
+    max_batch=getattr(settings, "SLOT_FLUSH_MAX_BATCH", 500),
+    state_filter=SlotStateFilter(
+        dwell_occupied=getattr(settings, "SLOT_FILTER_DWELL_OCCUPIED", 2.0),
+        dwell_free=getattr(settings, "SLOT_FILTER_DWELL_FREE", 4.0),
+        window=getattr(settings, "SLOT_FILTER_WINDOW", 6),
+        required=getattr(settings, "SLOT_FILTER_REQUIRED", 4),
+        flap_window=getattr(settings, "SLOT_FILTER_FLAP_WINDOW", 60.0),
+        flap_max_flips=getattr(settings, "SLOT_FILTER_FLAP_MAX_FLIPS", 6),
+        flap_clear=getattr(settings, "SLOT_FILTER_FLAP_CLEAR", 30.0)
+    ) if getattr(settings, "SLOT_FILTER_ENABLED", True) else None,
+    tick_interval=getattr(settings, "SLOT_FILTER_TICK", 0.5),
+    delta_buffer=getattr(settings, "SLOT_DELTA_BUFFER", 512)
+)
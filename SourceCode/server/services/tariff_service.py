@@ -0,0 +1,261 @@
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select, update, bindparam
+
+from config import settings
+from models import SessionLocal, ParkingSession
+
+MINUTES_PER_DAY = 24 * 60
+EPOCH = datetime(1970, 1, 1)
+
+DEFAULT_TARIFF = {
+    "version": "default",
+    "grace_minutes": 15,           # Gửi không quá thời gian này -> miễn phí
+    "daily_cap": 50000,            # Trần phí mỗi ngày (VND, theo ngày giờ địa phương)
+    "round_to": 1000,              # Làm tròn lên (VND)
+    "utc_offset_hours": 7,         # Timestamp trong DB là UTC
+    "bands": [
+        {"start": "06:00", "end": "18:00", "rate_per_hour": 5000},
+        {"start": "18:00", "end": "06:00", "rate_per_hour": 10000}
+    ]
+}
+
+def _parse_minute(value: str) -> int:
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+class Tariff:
+    """
+    Biểu phí đã biên dịch: đơn giá từng phút trong ngày + prefix sum
+    Phí của một khoảng thời gian trong ngày = prefix[b] - prefix[a] (O(1)),
+    cùng một công thức dùng cho tính phí online (scalar) và batch (NumPy)
+    """
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.version = str(config.get("version", "default"))
+        self.grace_minutes = int(config.get("grace_minutes", 0))
+        self.daily_cap = config.get("daily_cap")
+        self.round_to = int(config.get("round_to", 1)) or 1
+        self.offset_minutes = int(round(float(config.get("utc_offset_hours", 0)) * 60))
+
+        rates = np.zeros(MINUTES_PER_DAY, dtype=np.float64)
+        for band in config.get("bands", []):
+            start, end = _parse_minute(band["start"]), _parse_minute(band["end"])
+            per_minute = band["rate_per_hour"] / 60.0
+            if start < end:
+                rates[start:end] = per_minute
+            else:
+                # Khung giờ qua nửa đêm (vd. 18:00 -> 06:00)
+                rates[start:] = per_minute
+                rates[:end] = per_minute
+
+        self.prefix = np.concatenate(([0.0], np.cumsum(rates)))
+        self._prefix_list: List[float] = self.prefix.tolist()
+        day_total = self._prefix_list[-1]
+        self.day_fee = min(day_total, self.daily_cap) if self.daily_cap is not None else day_total
+
+    def _minutes(self, value: datetime, ceil: bool) -> int:
+        seconds = (value - EPOCH).total_seconds()
+        minutes = math.ceil(seconds / 60) if ceil else math.floor(seconds / 60)
+        return minutes + self.offset_minutes
+
+    def _cap(self, fee: float) -> float:
+        return min(fee, self.daily_cap) if self.daily_cap is not None else fee
+
+    def _round(self, fee: float) -> int:
+        return int(math.ceil(round(fee, 6) / self.round_to) * self.round_to)
+
+    def price(self, entry_time: datetime, exit_time: datetime) -> int:
+        """
+        Tính phí một lượt gửi xe (online, khi xe ra)
+        Returns: phí (VND)
+        """
+        start = self._minutes(entry_time, ceil=False)
+        end = self._minutes(exit_time, ceil=True)
+        if end - start <= self.grace_minutes:
+            return 0
+
+        prefix = self._prefix_list
+        day_start, offset_start = divmod(start, MINUTES_PER_DAY)
+        day_end, offset_end = divmod(end, MINUTES_PER_DAY)
+        if day_start == day_end:
+            fee = self._cap(prefix[offset_end] - prefix[offset_start])
+        else:
+            fee = (
+                self._cap(prefix[MINUTES_PER_DAY] - prefix[offset_start])
+                + (day_end - day_start - 1) * self.day_fee
+                + self._cap(prefix[offset_end])
+            )
+        return self._round(fee)
+
+    def price_batch(self, entry_seconds: np.ndarray, exit_seconds: np.ndarray) -> np.ndarray:
+        """
+        Tính phí hàng loạt bằng NumPy (quyết toán cuối ngày, tính lại khi đổi biểu phí)
+
+        Args:
+            entry_seconds, exit_seconds: Epoch seconds (UTC) dạng mảng
+
+        Returns: mảng phí int64 (VND)
+        """
+        start = np.floor(np.asarray(entry_seconds, dtype=np.float64) / 60).astype(np.int64) + self.offset_minutes
+        end = np.ceil(np.asarray(exit_seconds, dtype=np.float64) / 60).astype(np.int64) + self.offset_minutes
+
+        day_start, offset_start = np.divmod(start, MINUTES_PER_DAY)
+        day_end, offset_end = np.divmod(end, MINUTES_PER_DAY)
+        cap = np.inf if self.daily_cap is None else self.daily_cap
+
+        same_day = np.minimum(self.prefix[offset_end] - self.prefix[offset_start], cap)
+        multi_day = (
+            np.minimum(self.prefix[MINUTES_PER_DAY] - self.prefix[offset_start], cap)
+            + (day_end - day_start - 1) * self.day_fee
+            + np.minimum(self.prefix[offset_end], cap)
+        )
+        fee = np.where(day_start == day_end, same_day, multi_day)
+        fee = np.ceil(np.round(fee, 6) / self.round_to) * self.round_to
+        fee[end - start <= self.grace_minutes] = 0
+        return fee.astype(np.int64)
+
+    def local_day_bounds(self, day: str) -> Tuple[datetime, datetime]:
+
+        # Ngày địa phương "YYYY-MM-DD" -> khoảng UTC [start, end)
+        start = datetime.strptime(day, "%Y-%m-%d") - timedelta(minutes=self.offset_minutes)
+        return start, start + timedelta(days=1)
+
+class TariffService:
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        self._lock = threading.Lock()
+        self.tariff = Tariff(config or DEFAULT_TARIFF)
+        self.priced = 0
+        self.total_price_us = 0.0
+
+    def set_tariff(self, config: Dict[str, Any]) -> Tariff:
+
+        # Đổi biểu phí (biên dịch lại prefix sum)
+        tariff = Tariff(config)
+        with self._lock:
+            self.tariff = tariff
+        print(f"[TARIFF] Tariff set: version {tariff.version}")
+        return tariff
+
+    def price(self, entry_time: datetime, exit_time: datetime) -> int:
+        started = time.perf_counter()
+        fee = self.tariff.price(entry_time, exit_time)
+        self.priced += 1
+        self.total_price_us += (time.perf_counter() - started) * 1e6
+        return fee
+
+    def price_batch(self, entry_seconds, exit_seconds) -> np.ndarray:
+        return self.tariff.price_batch(entry_seconds, exit_seconds)
+
+    def _load_closed(self, start: datetime, end: datetime) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+
+        # Đọc các lượt đã đóng có exit_time trong [start, end) bằng core select (không tạo ORM object)
+        table = ParkingSession.__table__
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(table.c.id, table.c.entry_time, table.c.exit_time, table.c.fee).where(
+                    table.c.status == "closed",
+                    table.c.exit_time >= start,
+                    table.c.exit_time < end
+                )
+            ).all()
+        finally:
+            db.close()
+
+        if not rows:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty.astype(np.float64), empty.astype(np.float64), empty
+        ids, entries, exits, fees = zip(*rows)
+        to_seconds = lambda values: np.fromiter(((value - EPOCH).total_seconds() for value in values), np.float64, len(values))
+        return (
+            np.array(ids, dtype=np.int64),
+            to_seconds(entries),
+            to_seconds(exits),
+            np.array([fee if fee is not None else -1 for fee in fees], dtype=np.int64)
+        )
+
+    def settle(self, day: str) -> Dict[str, Any]:
+        """
+        Quyết toán một ngày (giờ địa phương): tổng doanh thu, số lượt, phân bố theo giờ ra
+        Phí đã lưu khi xe ra được dùng lại; lượt chưa có phí được tính batch
+        """
+        tariff = self.tariff
+        start, end = tariff.local_day_bounds(day)
+        ids, entry_seconds, exit_seconds, fees = self._load_closed(start, end)
+
+        missing = fees < 0
+        if missing.any():
+            fees[missing] = tariff.price_batch(entry_seconds[missing], exit_seconds[missing])
+
+        local_hours = ((exit_seconds // 60 + tariff.offset_minutes) % MINUTES_PER_DAY // 60).astype(np.int64)
+        durations = exit_seconds - entry_seconds
+        return {
+            "date": day,
+            "tariff_version": tariff.version,
+            "sessions": int(len(ids)),
+            "paid_sessions": int((fees > 0).sum()),
+            "revenue": int(fees.sum()),
+            "avg_fee": round(float(fees.mean()), 1) if len(ids) else 0,
+            "avg_duration_minutes": round(float(durations.mean()) / 60, 1) if len(ids) else 0,
+            "revenue_by_hour": np.bincount(local_hours, weights=fees, minlength=24).astype(np.int64).tolist(),
+            "sessions_by_hour": np.bincount(local_hours, minlength=24).tolist()
+        }
+
+    def reprice(self, date_from: str, date_to: str, batch_size: int = 50000) -> Dict[str, Any]:
+        """
+        Tính lại phí các lượt đã đóng trong [date_from, date_to] theo biểu phí hiện tại
+        (vd. sau khi đổi biểu phí), ghi bằng executemany theo lô
+        """
+        started = time.perf_counter()
+        tariff = self.tariff
+        start, _ = tariff.local_day_bounds(date_from)
+        _, end = tariff.local_day_bounds(date_to)
+        ids, entry_seconds, exit_seconds, old_fees = self._load_closed(start, end)
+        new_fees = tariff.price_batch(entry_seconds, exit_seconds)
+        changed = np.nonzero(new_fees != old_fees)[0]
+
+        table = ParkingSession.__table__
+        statement = update(table).where(table.c.id == bindparam("b_id")).values(
+            fee=bindparam("b_fee"), tariff_version=tariff.version
+        )
+        db = SessionLocal()
+        try:
+            for offset in range(0, len(changed), batch_size):
+                chunk = changed[offset:offset + batch_size]
+                db.execute(statement, [
+                    {"b_id": session_id, "b_fee": fee}
+                    for session_id, fee in zip(ids[chunk].tolist(), new_fees[chunk].tolist())
+                ])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        elapsed = time.perf_counter() - started
+        print(f"[TARIFF] Repriced {len(ids)} sessions ({len(changed)} changed) in {elapsed:.2f}s")
+        return {
+            "tariff_version": tariff.version,
+            "sessions": int(len(ids)),
+            "changed": int(len(changed)),
+            "revenue_before": int(old_fees[old_fees > 0].sum()),
+            "revenue_after": int(new_fees.sum()),
+            "elapsed_s": round(elapsed, 2)
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.tariff.version,
+            "priced": self.priced,
+            "avg_price_us": round(self.total_price_us / self.priced, 1) if self.priced else None
+        }
+
+# Singleton instance
+tariff_service = TariffService(getattr(settings, "TARIFF", None))
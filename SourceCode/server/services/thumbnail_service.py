@@ -0,0 +1,188 @@
+import asyncio
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Tuple, List
+
+from PIL import Image
+
+from config import settings
+from .image_store import image_store
+
+# Các kích thước thumbnail cố định (chiều rộng tối đa, px)
+THUMBNAIL_SIZES = {"small": 160, "medium": 320, "large": 640}
+THUMBNAIL_KINDS = ("plate", "vehicle")
+
+class ThumbnailService:
+    """
+    Tạo thumbnail lazily trong worker pool và giữ trong LRU disk cache có giới hạn dung lượng
+    Thumbnail được đặt tên theo (log_id, kind, size) nên bất biến -> cache lâu dài bằng ETag
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 256 * 1024 * 1024, workers: int = 2, jpeg_quality: int = 80):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.jpeg_quality = jpeg_quality
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # filename -> size, LRU order
+        self._total_bytes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load_index()
+
+    def _load_index(self):
+
+        # Khôi phục thứ tự LRU từ mtime các file đã có trong cache
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".jpg"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def etag(log_id: int, kind: str, size: str) -> str:
+        return f'"thumb-{log_id}-{kind}-{size}"'
+
+    @staticmethod
+    def _filename(log_id: int, kind: str, size: str) -> str:
+        return f"{log_id}_{kind}_{size}.jpg"
+
+    def _touch(self, filename: str) -> Optional[str]:
+        path = os.path.join(self.cache_dir, filename)
+        with self._lock:
+            if filename not in self._entries:
+                return None
+            if not os.path.exists(path):
+                self._total_bytes -= self._entries.pop(filename)
+                return None
+            self._entries.move_to_end(filename)
+            self.hits += 1
+        return path
+
+    def _add(self, filename: str, size: int):
+        with self._lock:
+            if filename in self._entries:
+                self._total_bytes -= self._entries.pop(filename)
+            self._entries[filename] = size
+            self._total_bytes += size
+
+            # Vượt ngân sách: xóa thumbnail ít dùng nhất
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_name, old_size = self._entries.popitem(last=False)
+                self._total_bytes -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(os.path.join(self.cache_dir, old_name))
+                except OSError:
+                    pass
+
+    def _render(self, image_path: str, width: int, crop_box: Optional[Tuple[int, int, int, int]], filename: str) -> Optional[str]:
+        data = image_store.read(image_path)
+        if data is None:
+            return None
+
+        img = Image.open(io.BytesIO(data))
+        if crop_box is None:
+            img.draft('RGB', (width, width))  # JPEG decode ở độ phân giải thấp
+        img = img.convert('RGB')
+        if crop_box is not None:
+            left, top, right, bottom = crop_box
+            img = img.crop((left, top, min(right, img.width), min(bottom, img.height)))
+        img.thumbnail((width, width), Image.BILINEAR)
+
+        output = io.BytesIO()
+        img.save(output, format="JPEG", quality=self.jpeg_quality, optimize=True)
+
+        path = os.path.join(self.cache_dir, filename)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(output.getvalue())
+        os.replace(tmp_path, path)
+
+        self._add(filename, len(output.getvalue()))
+        return path
+
+    async def get_thumbnail(self, log_id: int, image_path: str, kind: str, size: str, crop_box=None) -> Optional[str]:
+        """
+        Returns: đường dẫn file thumbnail trong cache, None nếu không có ảnh gốc
+        """
+        filename = self._filename(log_id, kind, size)
+        path = self._touch(filename)
+        if path:
+            return path
+
+        # Gộp các request đồng thời cho cùng một thumbnail
+        inflight = self._inflight.get(filename)
+        if inflight:
+            return await inflight
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._executor, self._render, image_path, THUMBNAIL_SIZES[size], crop_box, filename
+        )
+        self._inflight[filename] = future
+        with self._lock:
+            self.misses += 1
+        try:
+            return await future
+        finally:
+            self._inflight.pop(filename, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+def plate_crop_box(ocr_result: Dict[str, Any], padding: float = 0.2) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Tính vùng crop biển số trên ảnh gốc từ kết quả OCR đã lưu
+    Tọa độ box của OCR nằm trên ảnh đã tiền xử lý -> map ngược qua roi/scale
+    """
+    preprocess = ocr_result.get('preprocess') or {}
+    roi: List[int] = preprocess.get('roi') or [0, 0, 0, 0]
+    scale = preprocess.get('scale') or 1.0
+
+    results = (ocr_result.get('raw_result') or {}).get('results') or []
+    box = results[0].get('box') if results else None
+    if not box:
+        # Không có box: dùng ROI biển số của camera nếu có
+        return tuple(roi) if preprocess.get('roi') else None
+
+    xmin = roi[0] + box['xmin'] / scale
+    ymin = roi[1] + box['ymin'] / scale
+    xmax = roi[0] + box['xmax'] / scale
+    ymax = roi[1] + box['ymax'] / scale
+    pad_x = (xmax - xmin) * padding
+    pad_y = (ymax - ymin) * padding
+    return (
+        max(0, int(xmin - pad_x)),
+        max(0, int(ymin - pad_y)),
+        int(xmax + pad_x),
+        int(ymax + pad_y)
+    )
+
+# Singleton instance
+thumbnail_service = ThumbnailService(
+    cache_dir=getattr(settings, "THUMBNAIL_CACHE_DIR", os.path.join(settings.UPLOAD_DIR, "thumbnails")),
+    max_bytes=getattr(settings, "THUMBNAIL_CACHE_MAX_BYTES", 256 * 1024 * 1024),
+    workers=getattr(settings, "THUMBNAIL_WORKERS", 2)
+)
@@ -1,72 +1,488 @@
 import asyncio
+import json
+import threading
+import time
+import zlib
+from collections import deque
 from fastapi import WebSocket
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any, Optional, Tuple, Set
+from config import settings
+from session_manager import verify_session, verify_super_admin
+
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Channel -> quyền cần có để subscribe
+CHANNELS = {
+    "slots": "public",
+    "vehicles": "admin",
+    "gate": "admin",
+    "ota": "super_admin"
+}
+# Loại message -> channel
+CHANNEL_BY_TYPE = {
+    "slot_update": "slots",
+    "slot_anomaly": "slots",
+    "new_vehicle": "vehicles",
+    "gate_status": "gate",
+    "ota_status": "ota"
+}
+DEFAULT_CHANNELS = ("slots",)
+
+def authorize(session_id: Optional[str], channel: str) -> bool:
+    role = CHANNELS.get(channel)
+    if role == "public":
+        return True
+    if role == "admin":
+        return verify_session(session_id)
+    if role == "super_admin":
+        return verify_super_admin(session_id)
+    return False
+
+class BroadcastFrame:
+    """
+    Message đã được encode một lần cho mọi client
+    Bản nén zlib (cho client kết nối với ?compress=1) chỉ được tính khi cần, một lần cho mọi client.
+    """
+    __slots__ = ("type", "text", "compress_level", "_compressed")
+
+    def __init__(self, message: Dict[str, Any], compress_level: int = 6):
+        self.type = message.get('type')
+        # Cùng định dạng với WebSocket.send_json của Starlette
+        self.text = json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+        self.compress_level = compress_level
+        self._compressed: Optional[bytes] = None
+
+    @property
+    def compressed(self) -> bytes:
+        if self._compressed is None:
+            self._compressed = zlib.compress(self.text.encode("utf-8"), self.compress_level)
+        return self._compressed
+
+class ClientConnection:
+    """
+    Một dashboard đang kết nối: queue gửi có giới hạn + writer task riêng
+    Client chậm chỉ làm đầy queue của chính nó, không làm chậm các client khác hay thread broadcast.
+
+    Khi queue đầy:
+    - drop_oldest: bỏ message cũ nhất
+    - coalesce: bỏ mọi slot_update đang chờ (client nạp bù một lần bằng resume), rồi mới bỏ message cũ nhất
+    - disconnect: đóng kết nối, client tự reconnect và nạp lại trạng thái
+
+    Contract với dashboard: slot_update được gửi đủ và đúng thứ tự seq, không bao giờ bị gộp riêng lẻ.
+    Seq chỉ có thể nhảy sau khi client nhận "resync" (slot_update đã bị bỏ do queue đầy) hoặc sau reconnect;
+    client gặp khoảng trống thì giữ lại update và gửi resume theo seq liên tục cuối cùng.
+    """
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_queue: int = 100,
+        policy: str = "coalesce",
+        send_timeout: float = 10.0,
+        compress_min_bytes: Optional[int] = None,
+        session_id: Optional[str] = None
+    ):
+        """
+        Args:
+            compress_min_bytes: Client nhận frame nhị phân nén zlib cho message từ kích thước này, None = không nén
+        """
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.compress_min_bytes = compress_min_bytes
+        self.session_id = session_id
+        self.channels: Set[str] = set()
+        self._queue: "deque[BroadcastFrame]" = deque()
+        self._slot_frames = 0               # số slot_update đang chờ trong queue
+        self.resync_needed = False
+        self._ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def enqueue(self, frame: BroadcastFrame) -> bool:
+        """
+        O(1) trừ khi queue đầy, không await network I/O
+        Returns: False nếu client cần bị ngắt (policy disconnect)
+        """
+        if len(self._queue) >= self.max_queue:
+            if self.policy == "disconnect":
+                return False
+            if self.policy == "coalesce" and self._slot_frames:
+                # Một lần resume thay cho cả loạt slot_update client chưa kịp nhận
+                self._queue = deque(queued for queued in self._queue if queued.type != 'slot_update')
+                self.coalesced += self._slot_frames
+                self._slot_frames = 0
+                self.resync_needed = True
+            if len(self._queue) >= self.max_queue:
+                self._pop()
+                self.dropped += 1
+
+        self._queue.append(frame)
+        if frame.type == 'slot_update':
+            self._slot_frames += 1
+        self._ready.set()
+        return True
+
+    def _pop(self) -> BroadcastFrame:
+        frame = self._queue.popleft()
+        if frame.type == 'slot_update':
+            self._slot_frames -= 1
+            self.resync_needed = True
+        return frame
+
+    def depth(self) -> int:
+        return len(self._queue)
+
+    async def writer(self, on_error):
+        try:
+            while True:
+                await self._ready.wait()
+                while self._queue:
+                    frame = self._queue.popleft()
+                    if frame.type == 'slot_update':
+                        self._slot_frames -= 1
+                    if self.resync_needed:
+                        self.resync_needed = False
+                        await asyncio.wait_for(self.websocket.send_text('{"type":"resync","channel":"slots"}'), self.send_timeout)
+                    if self.compress_min_bytes is not None and len(frame.text) >= self.compress_min_bytes:
+                        send = self.websocket.send_bytes(frame.compressed)
+                    else:
+                        send = self.websocket.send_text(frame.text)
+                    await asyncio.wait_for(send, self.send_timeout)
+                    self.sent += 1
+                self._ready.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Gửi lỗi/timeout: client đã mất hoặc quá chậm
+            on_error(self.websocket)
 
 class WebSocketService:
-    def __init__(self):
-        self.clients: List[WebSocket] = []
-        self.pending_broadcasts: List[Dict[str, Any]] = []
+    """
+    Broadcast realtime tới dashboard
+
+    queue_broadcast có thể được gọi từ thread bất kỳ (network thread của paho, thread flush slot):
+    message được chuyển vào asyncio.Queue của event loop qua loop.call_soon_threadsafe,
+    worker thức dậy ngay khi có message và gửi theo lô thay vì poll định kỳ.
+    Fan-out chỉ đẩy message vào queue riêng của từng client (ClientConnection), không chờ network I/O.
+    Mỗi message được serialize một lần thành BroadcastFrame dùng chung cho mọi client.
+
+    Client chỉ nhận message của các channel đã subscribe (slots, vehicles, gate, ota), quyền theo session cookie.
+    Protocol (client -> server): {"action": "subscribe" | "unsubscribe", "channels": [...]}
+    Server trả về {"type": "subscribed", "channels": [...], "denied": [...]}
+    Resume sau reconnect: {"action": "resume", "channel": "slots", "epoch": ..., "seq": ...} -> message của sync provider
+    """
+    def __init__(
+        self,
+        max_queue: int = 1000,
+        max_batch: int = 100,
+        client_queue: int = 100,
+        overflow_policy: str = "coalesce",
+        send_timeout: float = 10.0,
+        compress_min_bytes: int = 512,
+        compress_level: int = 6
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        self.subscribers: Dict[str, Set[WebSocket]] = {channel: set() for channel in CHANNELS}
+        self.sync_providers: Dict[str, Callable[[Optional[str], Optional[int]], Dict[str, Any]]] = {}
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.client_queue = client_queue
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_level = compress_level
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._early: List[Tuple[Dict[str, Any], Optional[str], float]] = []  # message đến trước khi worker start
+        self._lock = threading.Lock()
         self._worker_task = None
+        
+        self.enqueued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.slow_disconnects = 0
+        self.client_dropped = 0
+        self.client_coalesced = 0
+        self.frames = 0
+        self.encode_us_total = 0.0
+        self.unrouted = 0
+        self.denied = 0
+        self.resumes: Dict[str, int] = {}
+        self._dwell_ms = deque(maxlen=500)
     
-    async def connect(self, websocket: WebSocket):
-        # Thêm client mới
+    async def connect(self, websocket: WebSocket, compress: bool = False, channels: Optional[List[str]] = None):
+        # Thêm client mới, khởi động writer task và subscribe các channel ban đầu (mặc định: slots)
         await websocket.accept()
-        self.clients.append(websocket)
+        client = ClientConnection(
+            websocket, self.client_queue, self.overflow_policy, self.send_timeout,
+            compress_min_bytes=self.compress_min_bytes if compress else None,
+            session_id=websocket.cookies.get("session_id")
+        )
+        client.task = asyncio.create_task(client.writer(self._drop))
+        self.clients[websocket] = client
+        self.subscribe(websocket, channels or list(DEFAULT_CHANNELS))
         print(f"[WS] Client connected (total: {len(self.clients)})")
     
+    def _send(self, client: ClientConnection, message: Dict[str, Any]):
+        
+        # Message riêng cho một client (xác nhận subscribe, lỗi)
+        if not client.enqueue(BroadcastFrame(message, self.compress_level)):
+            self._drop(client.websocket)
+    
+    def subscribe(self, websocket: WebSocket, channels: List[str]):
+        client = self.clients.get(websocket)
+        if client is None:
+            return
+        
+        denied = []
+        for channel in channels:
+            if authorize(client.session_id, channel):
+                client.channels.add(channel)
+                self.subscribers[channel].add(websocket)
+            else:
+                denied.append(channel)
+                self.denied += 1
+        self._send(client, {"type": "subscribed", "channels": sorted(client.channels), "denied": denied})
+    
+    def unsubscribe(self, websocket: WebSocket, channels: List[str]):
+        client = self.clients.get(websocket)
+        if client is None:
+            return
+        
+        for channel in channels:
+            client.channels.discard(channel)
+            if channel in self.subscribers:
+                self.subscribers[channel].discard(websocket)
+        self._send(client, {"type": "subscribed", "channels": sorted(client.channels), "denied": []})
+    
+    def add_sync_provider(self, channel: str, provider: Callable[[Optional[str], Optional[int]], Dict[str, Any]]):
+        
+        # provider(epoch, seq) -> message delta/snapshot cho client resume channel
+        self.sync_providers[channel] = provider
+    
+    def resume(self, websocket: WebSocket, channel: str, epoch: Optional[str], seq: Optional[int]):
+        client = self.clients.get(websocket)
+        if client is None:
+            return
+        provider = self.sync_providers.get(channel)
+        if provider is None or channel not in client.channels:
+            self._send(client, {"type": "error", "error": f"Cannot resume channel: {channel}"})
+            return
+        
+        message = provider(epoch, seq)
+        mode = message.get("mode", "unknown")
+        self.resumes[mode] = self.resumes.get(mode, 0) + 1
+        self._send(client, message)
+    
+    def handle_message(self, websocket: WebSocket, text: str):
+        
+        # Message từ client: thay đổi subscription
+        client = self.clients.get(websocket)
+        if client is None:
+            return
+        try:
+            data = json.loads(text)
+            action = data.get("action")
+            channels = data.get("channels") or []
+            if isinstance(channels, str):
+                channels = [channels]
+        except (ValueError, AttributeError):
+            self._send(client, {"type": "error", "error": "Invalid JSON"})
+            return
+        
+        # Channel phải là chuỗi (list/dict không hash được, làm hỏng vòng nhận của kết nối)
+        if not isinstance(channels, list) or not all(isinstance(channel, str) for channel in channels):
+            self._send(client, {"type": "error", "error": "Channels must be a string or a list of strings"})
+            return
+        if action == "resume" and not isinstance(data.get("channel", "slots"), str):
+            self._send(client, {"type": "error", "error": "Channel must be a string"})
+            return
+        
+        if action == "subscribe":
+            self.subscribe(websocket, channels)
+        elif action == "unsubscribe":
+            self.unsubscribe(websocket, channels)
+        elif action == "resume":
+            self.resume(websocket, data.get("channel", "slots"), data.get("epoch"), data.get("seq"))
+        elif action != "ping":
+            self._send(client, {"type": "error", "error": f"Unknown action: {action}"})
+    
     def disconnect(self, websocket: WebSocket):
         # Xóa client
-        if websocket in self.clients:
-            self.clients.remove(websocket)
-            print(f"[WS] Client disconnected (total: {len(self.clients)})")
-    
-    async def broadcast(self, message: Dict[str, Any]):
-        # Broadcast message đến tất cả clients
-        disconnected = []
-        for client in self.clients:
-            try:
-                await client.send_json(message)
-            except:
-                disconnected.append(client)
+        client = self.clients.pop(websocket, None)
+        if client is None:
+            return
+        client.closed = True
+        for channel in client.channels:
+            self.subscribers[channel].discard(websocket)
+        self.client_dropped += client.dropped
+        self.client_coalesced += client.coalesced
+        if client.task and client.task is not asyncio.current_task():
+            client.task.cancel()
+        print(f"[WS] Client disconnected (total: {len(self.clients)})")
+    
+    async def _close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)  # Try again later
+        except Exception:
+            pass
+    
+    def _drop(self, websocket: WebSocket):
+        # Client quá chậm hoặc gửi lỗi: ngắt và đóng socket, dashboard tự reconnect
+        self.slow_disconnects += 1
+        self.disconnect(websocket)
+        asyncio.create_task(self._close(websocket))
+    
+    def broadcast(self, message: Dict[str, Any], channel: Optional[str] = None):
+        # Broadcast message đến các client đã subscribe channel của nó (chạy trên event loop, chỉ enqueue)
+        channel = channel or CHANNEL_BY_TYPE.get(message.get('type'))
+        if channel not in self.subscribers:
+            # Không gửi message chưa gán channel tới mọi người (tránh lộ dữ liệu)
+            self.unrouted += 1
+            print(f"[WEBSOCKET] WARNING No channel for message type: {message.get('type')}")
+            return
+        if not self.subscribers[channel]:
+            return
         
-        # Remove disconnected clients
-        for client in disconnected:
-            self.disconnect(client)
+        # Serialize một lần, mọi client dùng chung frame
+        started = time.perf_counter()
+        frame = BroadcastFrame(message, self.compress_level)
+        self.frames += 1
+        self.encode_us_total += (time.perf_counter() - started) * 1e6
+        
+        restricted = CHANNELS[channel] != "public"
+        for websocket in list(self.subscribers[channel]):
+            client = self.clients[websocket]
+            if restricted and not authorize(client.session_id, channel):
+                # Session đã hết hạn/đăng xuất: ngừng gửi dữ liệu riêng tư
+                self.unsubscribe(websocket, [channel])
+                continue
+            if not client.enqueue(frame):
+                print(f"[WS] Client too slow ({client.depth()} queued), disconnecting")
+                self._drop(websocket)
     
-    def queue_broadcast(self, message: Dict[str, Any]):
-        # Thêm message vào queue 
-        self.pending_broadcasts.append(message)
-        print(f"[WEBSOCKET] Queued broadcast: {message.get('type')}")
+    def queue_broadcast(self, message: Dict[str, Any], channel: Optional[str] = None):
+        # Thêm message vào queue (thread-safe, không chặn thread gọi)
+        item = (message, channel, time.monotonic())
+        loop = self._loop
+        if loop is None:
+            with self._lock:
+                self._early.append(item)
+            return
+        
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        
+        if running is loop:
+            self._enqueue(item)
+        else:
+            try:
+                loop.call_soon_threadsafe(self._enqueue, item)
+            except RuntimeError:
+                # Event loop đã đóng (đang shutdown)
+                self.dropped += 1
+    
+    def _enqueue(self, item: Tuple[Dict[str, Any], Optional[str], float]):
+        # Chạy trên event loop
+        if self._queue.full():
+            # Queue đầy (không có worker tiêu thụ): bỏ message cũ nhất
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(item)
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
     
     async def broadcast_worker(self):
-        # Background task để xử lý queue broadcast
+        # Background task: chờ message rồi gửi cả lô đang có trong queue
         while True:
             try:
-                if self.pending_broadcasts:
-                    # Lấy message từ queue
-                    message = self.pending_broadcasts.pop(0)
-                    await self.broadcast(message)
-                    print(f"[WEBSOCKET] Broadcasted: {message.get('type')}")
+                batch = [await self._queue.get()]
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                
+                now = time.monotonic()
+                for message, channel, enqueued_at in batch:
+                    self._dwell_ms.append((now - enqueued_at) * 1000)
+                    self.broadcast(message, channel)
                 
-                # Chờ 0.1s trước khi check lại
-                await asyncio.sleep(0.1)
+                self.delivered += len(batch)
+                self.batches += 1
+                print(f"[WEBSOCKET] Broadcasted {len(batch)} message(s): {', '.join(str(item[0].get('type')) for item in batch[:5])}")
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 print(f"[WEBSOCKET] Broadcast worker error: {e}")
                 await asyncio.sleep(1)
     
     def start_worker(self):
-        # Khởi động background worker
+        # Khởi động background worker (gọi trong event loop)
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._loop = asyncio.get_running_loop()
+        with self._lock:
+            early, self._early = self._early, []
+        for item in early:
+            self._enqueue(item)
         self._worker_task = asyncio.create_task(self.broadcast_worker())
         print("[WEBSOCKET] SUCCESS WebSocket broadcast worker started")
     
     async def stop_worker(self):
         # Dừng background worker
+        self._loop = None
         if self._worker_task:
             self._worker_task.cancel()
             try:
                 await self._worker_task
             except asyncio.CancelledError:
                 pass
+    
+    def stats(self) -> Dict[str, Any]:
+        dwell = sorted(self._dwell_ms)
+        return {
+            "clients": len(self.clients),
+            "subscribers": {channel: len(sockets) for channel, sockets in self.subscribers.items()},
+            "denied": self.denied,
+            "unrouted": self.unrouted,
+            "resumes": dict(self.resumes),
+            "overflow_policy": self.overflow_policy,
+            "client_queue_depth": max((client.depth() for client in self.clients.values()), default=0),
+            "client_dropped": self.client_dropped + sum(client.dropped for client in self.clients.values()),
+            "client_coalesced": self.client_coalesced + sum(client.coalesced for client in self.clients.values()),
+            "slow_disconnects": self.slow_disconnects,
+            "frames": self.frames,
+            "avg_encode_us": round(self.encode_us_total / self.frames, 1) if self.frames else None,
+            "depth": self._queue.qsize() if self._queue else len(self._early),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "avg_batch": round(self.delivered / self.batches, 2) if self.batches else None,
+            "dwell_ms": {
+                "avg": round(sum(dwell) / len(dwell), 2),
+                "p50": round(dwell[len(dwell) // 2], 2),
+                "p95": round(dwell[int(len(dwell) * 0.95)], 2),
+                "max": round(dwell[-1], 2)
+            } if dwell else None
+        }
 
 # Singleton instance
-websocket_service = WebSocketService()
+websocket_service = WebSocketService(
+    max_queue=getattr(settings, "WS_QUEUE_MAX", 1000),
+    max_batch=getattr(settings, "WS_BATCH_MAX", 100),
+    client_queue=getattr(settings, "WS_CLIENT_QUEUE", 100),
+    overflow_policy=getattr(settings, "WS_OVERFLOW_POLICY", "coalesce"),
+    send_timeout=getattr(settings, "WS_SEND_TIMEOUT", 10.0),
+    compress_min_bytes=getattr(settings, "WS_COMPRESS_MIN_BYTES", 512),
+    compress_level=getattr(settings, "WS_COMPRESS_LEVEL", 6)
+)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Module của server import theo tên gốc (config, models, services...): chạy pytest từ SourceCode/server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,74 @@
+import os
+
+from services.image_store import ImageStore
+
+def frame(index: int, size: int = 2000) -> bytes:
+    return b"\xff\xd8\xff" + bytes([index % 256]) * size + b"\xff\xd9"
+
+def test_put_is_content_addressed_and_deduplicated(tmp_path):
+    store = ImageStore(str(tmp_path))
+    key = store.put(frame(1))
+
+    assert key == ImageStore.compute_key(frame(1))
+    assert store.put(frame(1)) == key
+    assert store.writes == 1 and store.dedup_hits == 1
+    assert os.path.exists(store.path_for(key))
+    assert store.read(key) == frame(1)
+
+def test_read_legacy_path(tmp_path):
+    store = ImageStore(str(tmp_path / "store"))
+    legacy = tmp_path / "archive.jpg"
+    legacy.write_bytes(frame(2))
+
+    assert store.read(str(legacy)) == frame(2)
+    assert store.read(str(tmp_path / "missing.jpg")) is None
+    assert store.read(None) is None
+
+def test_pack_round_trip_and_reload(tmp_path):
+    store = ImageStore(str(tmp_path))
+    keys = [store.put(frame(i)) for i in range(5)]
+
+    packed, packed_bytes = store.pack(keys)
+    assert packed == 5
+    assert packed_bytes == sum(len(frame(i)) for i in range(5))
+    for i, key in enumerate(keys):
+        assert not os.path.exists(store.path_for(key))
+        assert store.exists(key)
+        assert store.read(key) == frame(i)
+
+    # Dựng lại index từ file .idx khi khởi động lại
+    reloaded = ImageStore(str(tmp_path))
+    assert [reloaded.read(key) for key in keys] == [frame(i) for i in range(5)]
+
+def test_segment_rollover(tmp_path):
+    store = ImageStore(str(tmp_path), segment_max_bytes=5000)
+    keys = [store.put(frame(i)) for i in range(6)]
+    store.pack(keys)
+
+    assert len(store.segments()) > 1
+    assert [store.read(key) for key in keys] == [frame(i) for i in range(6)]
+
+def test_reload_ignores_partial_index_lines(tmp_path):
+    store = ImageStore(str(tmp_path))
+    keys = [store.put(frame(i)) for i in range(2)]
+    store.pack(keys)
+
+    # Crash giữa chừng: dòng index ghi dở và entry trỏ quá cuối segment
+    index_path = store._index_path(1)
+    with open(index_path, "a") as f:
+        f.write(f"{'a' * 64} 999999 10\n")
+        f.write("deadbeef 12")
+
+    reloaded = ImageStore(str(tmp_path))
+    assert [reloaded.read(key) for key in keys] == [frame(0), frame(1)]
+    assert reloaded.read("a" * 64) is None
+    assert reloaded.stats()["packed_images"] == 2
+
+def test_drop_segment(tmp_path):
+    store = ImageStore(str(tmp_path))
+    key = store.put(frame(3))
+    store.pack([key])
+
+    assert store.drop_segment(1) == len(frame(3))
+    assert store.read(key) is None
+    assert store.segments() == []
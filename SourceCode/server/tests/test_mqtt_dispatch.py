@@ -0,0 +1,104 @@
+import asyncio
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+
+from services.mqtt_handler import TopicTrie, PublishTracker
+
+def handler(name):
+    def callback(data):
+        return name
+    callback.__name__ = name
+    return callback
+
+def names(callbacks):
+    return sorted(callback.__name__ for callback in callbacks)
+
+def test_topic_trie_wildcards():
+    trie = TopicTrie()
+    trie.add("iot/parking/slots", handler("exact"))
+    trie.add("iot/parking/+/status", handler("plus"))
+    trie.add("iot/parking/#", handler("hash"))
+    trie.add("#", handler("all"))
+
+    assert names(trie.match("iot/parking/slots")) == ["all", "exact", "hash"]
+    assert names(trie.match("iot/parking/gate/status")) == ["all", "hash", "plus"]
+    assert names(trie.match("iot/parking")) == ["all", "hash"]   # "a/#" khớp cả "a"
+    assert names(trie.match("iot/other")) == ["all"]
+    assert names(trie.match("iot/parking/gate/status/extra")) == ["all", "hash"]
+
+def test_topic_trie_system_topics_skip_leading_wildcards():
+    trie = TopicTrie()
+    trie.add("#", handler("all"))
+    trie.add("+/broker/uptime", handler("plus"))
+    trie.add("$SYS/#", handler("sys"))
+
+    assert names(trie.match("$SYS/broker/uptime")) == ["sys"]
+
+def test_topic_trie_remove():
+    trie = TopicTrie()
+    first, second = handler("first"), handler("second")
+    trie.add("iot/+/status", first)
+    trie.add("iot/+/status", first)
+    trie.add("iot/+/status", second)
+
+    assert names(trie.match("iot/gate/status")) == ["first", "second"]
+    assert trie.remove("iot/+/status", first) is False
+    assert names(trie.match("iot/gate/status")) == ["second"]
+    assert trie.remove("iot/+/status") is True
+    assert trie.match("iot/gate/status") == []
+    assert trie.remove("not/registered") is True
+
+class FakeClient:
+    """
+    Client giả lập paho: on_publish có thể được gọi ngay trong publish() (trước khi mid được trả về)
+    """
+    def __init__(self, ack_before_return=False, ack=True):
+        self.ack_before_return = ack_before_return
+        self.ack = ack
+        self.on_publish = None
+        self.mid = 0
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload, qos=0):
+        self.mid += 1
+        if self.ack and self.ack_before_return:
+            self.on_publish(self, None, self.mid)
+        return SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS, mid=self.mid)
+
+def test_publish_ack_before_mid_registered():
+    client = FakeClient(ack_before_return=True)
+    tracker = PublishTracker(client, default_timeout=0.5, default_retries=0)
+
+    assert asyncio.run(tracker.publish("iot/test", {"a": 1})) is True
+    assert tracker.stats()["early"] == 0
+    assert tracker.stats()["pending"] == 0
+
+def test_publish_ack_after_return():
+    client = FakeClient()
+    tracker = PublishTracker(client, default_timeout=1.0, default_retries=0)
+
+    async def scenario():
+        task = asyncio.create_task(tracker.publish("iot/test", "payload"))
+        await asyncio.sleep(0.01)
+        client.on_publish(client, None, client.mid)
+        return await task
+
+    assert asyncio.run(scenario()) is True
+    assert tracker.published == 1
+
+def test_publish_timeout_and_stale_early_mids():
+    client = FakeClient(ack=False)
+    tracker = PublishTracker(client, default_timeout=0.05, default_retries=0)
+
+    assert asyncio.run(tracker.publish("iot/test", "payload")) is False
+    assert tracker.timeouts == 1 and tracker.failed == 1
+    assert tracker.stats()["pending"] == 0
+
+    # Ack không có waiter (vd. sau reconnect) không được giữ mãi
+    tracker._on_publish(client, None, 99)
+    assert tracker.stats()["early"] == 1
+    tracker.reset()
+    assert tracker.stats()["early"] == 0
@@ -0,0 +1,96 @@
+import importlib
+import io
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image, ImageDraw
+
+ocr_module = importlib.import_module("services.ocr_service")
+PlateResultCache = ocr_module.PlateResultCache
+
+BOX = (250, 300, 390, 340)
+
+def make_frame(text: str) -> bytes:
+
+    # Cùng thân xe, chỉ khác chữ trên biển số
+    image = Image.new("RGB", (640, 480), (90, 90, 120))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((100, 100, 540, 400), fill=(200, 30, 30))
+    draw.rectangle(BOX, fill=(255, 255, 255))
+    draw.text((260, 312), text, fill=(0, 0, 0))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG")
+    return buffer.getvalue()
+
+def make_result(plate: str):
+    box = dict(zip(("xmin", "ymin", "xmax", "ymax"), BOX))
+    return {"plate": plate, "confidence": 0.9, "raw_result": {"results": [{"box": box}]}}
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(ocr_module, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+def test_same_frame_hits():
+    cache = PlateResultCache()
+    cache.put(cache.load(make_frame("51A-12345")), make_result("51A12345"))
+
+    cached = cache.get(cache.load(make_frame("51A-12345")))
+    assert cached["plate"] == "51A12345"
+    assert cache.hits == 1
+
+def test_same_car_body_different_plate_misses():
+    cache = PlateResultCache()
+    cache.put(cache.load(make_frame("51A-12345")), make_result("51A12345"))
+
+    assert cache.get(cache.load(make_frame("30H-98761"))) is None
+
+def test_returns_copy():
+    cache = PlateResultCache()
+    image = cache.load(make_frame("51A-12345"))
+    cache.put(image, make_result("51A12345"))
+
+    cache.get(image)["plate"] = "CHANGED"
+    assert cache.get(image)["plate"] == "51A12345"
+
+def test_unknown_and_boxless_results_not_cached():
+    cache = PlateResultCache()
+    image = cache.load(make_frame("51A-12345"))
+    cache.put(image, {"plate": "UNKNOWN", "confidence": 0.1})
+    cache.put(image, {"plate": "51A12345", "confidence": 0.9, "raw_result": {"results": [{}]}})
+
+    assert cache.get(image) is None
+
+def test_local_result_keys_whole_image():
+    assert PlateResultCache.plate_box({"plate": "51A12345"}) == (True, None)
+
+def test_entry_expires_even_after_reuse(clock):
+    cache = PlateResultCache(ttl=30)
+    frame_a = cache.load(make_frame("51A-12345"))
+    frame_b = cache.load(make_frame("30H-98761"))
+
+    cache.put(frame_a, make_result("A"))
+    clock[0] = 10
+    cache.put(frame_b, make_result("B"))
+    clock[0] = 20
+    assert cache.get(frame_a)["plate"] == "A"   # A được chuyển về cuối LRU
+
+    clock[0] = 35
+    assert cache.get(frame_a) is None
+    assert cache.get(frame_b)["plate"] == "B"
+
+def test_lru_evicts_oldest():
+    cache = PlateResultCache(max_size=1)
+    frame_a = cache.load(make_frame("51A-12345"))
+    frame_b = cache.load(make_frame("30H-98761"))
+    cache.put(frame_a, make_result("A"))
+    cache.put(frame_b, make_result("B"))
+
+    assert cache.get(frame_a) is None
+    assert cache.get(frame_b)["plate"] == "B"
+
+def test_undecodable_image():
+    cache = PlateResultCache()
+    assert cache.load(b"not a jpeg") is None
+    assert cache.get(None) is None
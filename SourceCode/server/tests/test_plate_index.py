@@ -0,0 +1,80 @@
+import pytest
+
+from services.plate_index import PlateIndex, normalize_plate, format_plate, edit_cost, match_plate
+
+@pytest.mark.parametrize("raw, canonical", [
+    ("51a-123.45", "51A12345"),
+    ("59-X1 234.56", "59X123456"),
+    ("5lA-123.45", "51A12345"),
+    ("51A-1234", "51A1234"),
+    ("51A-O1234", "51A01234"),
+    ("51A-I234", "51A1234"),
+    ("5lA-1Z3.4S", "51A12345"),
+    ("", ""),
+    (None, ""),
+    ("UNKNOWN", "UNKNOWN"),
+])
+def test_normalize_plate(raw, canonical):
+    assert normalize_plate(raw) == canonical
+
+@pytest.mark.parametrize("raw, canonical", [
+    ("51LD-1234", "51LD1234"),
+    ("51LD-123.45", "51LD12345"),
+    ("80NG-0123", "80NG0123"),
+])
+def test_normalize_keeps_two_letter_series(raw, canonical):
+    assert normalize_plate(raw) == canonical
+
+def test_format_plate():
+    assert format_plate("51A12345") == "51A-123.45"
+    assert format_plate("51A1234") == "51A-1234"
+    assert format_plate("59X123456") == "59X1-234.56"
+
+@pytest.mark.parametrize("a, b, cost", [
+    ("51A12345", "51A12345", 0),
+    ("51A12345", "51A12845", 2),
+    ("51A12345", "51A1234S", 1),    # S <-> 5 hay nhầm
+    ("51A12345", "51A1234", 2),     # thiếu một ký tự
+    ("51A12345", "51A123456", 2),   # thừa một ký tự
+    ("51A12345", "51A99945", None),
+])
+def test_edit_cost(a, b, cost):
+    assert edit_cost(a, b) == cost
+    assert edit_cost(b, a) == cost
+
+def test_match_plate_agrees_with_edit_cost():
+    plates = {"51A12345", "51A12845", "51A1234", "30H98761", "51A123456"}
+    matches = match_plate("51A12346", plates)
+    expected = sorted(
+        ((plate, edit_cost("51A12346", plate)) for plate in plates if edit_cost("51A12346", plate) is not None),
+        key=lambda item: (item[1], item[0])
+    )
+    assert matches == expected
+
+def test_nearest_prefers_confusable_substitution():
+    index = PlateIndex()
+    for plate in ("51A12345", "51A12385", "30H98761"):
+        index.add(plate)
+
+    # "51A1234S": S <-> 5 (chi phí 1) gần hơn 8 <-> S (chi phí 2)
+    assert index.nearest("51A-123.4S")[0] == ("51A12345", 0)
+    assert index.nearest("51A12395") == [("51A12345", 2), ("51A12385", 2)]
+    assert index.nearest("51A12395", max_cost=1) == []
+    assert index.nearest("") == []
+
+def test_best_match_rejects_ties():
+    index = PlateIndex()
+    for plate in ("51A12345", "51A12385"):
+        index.add(plate)
+
+    assert index.best_match("51A12345") == "51A12345"
+    assert index.best_match("51A12395") is None
+    assert index.best_match("51A12348") == "51A12345"   # 51A12385 cách 2 thao tác
+    assert index.best_match("30H98761") is None
+
+def test_add_ignores_short_plates():
+    index = PlateIndex()
+    index.add("51A")
+    index.add("51a-123.45")
+    assert len(index) == 1
+    assert "51A12345" in index
@@ -0,0 +1,70 @@
+from services.slot_update_service import SlotStateFilter
+
+TICK = 0.5
+
+def run(state_filter: SlotStateFilter, start: float, end: float):
+
+    # Các tick đánh giá trong (start, end]: [(thời điểm, commits, anomalies)]
+    results = []
+    now = start
+    while now + TICK <= end + 1e-9:
+        now = round(now + TICK, 3)
+        commits, anomalies = state_filter.evaluate(now)
+        if commits or anomalies:
+            results.append((now, commits, anomalies))
+    return results
+
+def test_new_slot_commits_on_first_tick():
+    state_filter = SlotStateFilter()
+    state_filter.observe("A1", True, 0.0)
+    assert run(state_filter, 0.0, TICK) == [(TICK, [("A1", True)], [])]
+
+def test_occupied_needs_dwell_and_n_of_m():
+    state_filter = SlotStateFilter(dwell_occupied=2.0, window=6, required=4)
+    state_filter.seed("A1", False)
+    state_filter.observe("A1", True, 0.0)
+
+    assert run(state_filter, 0.0, 3.0) == [(2.0, [("A1", True)], [])]
+
+def test_dwell_is_asymmetric():
+    state_filter = SlotStateFilter(dwell_occupied=2.0, dwell_free=4.0)
+    state_filter.seed("A1", True)
+    state_filter.observe("A1", False, 0.0)
+
+    assert run(state_filter, 0.0, 5.0) == [(4.0, [("A1", False)], [])]
+
+def test_short_blip_is_ignored():
+    state_filter = SlotStateFilter(dwell_occupied=2.0)
+    state_filter.seed("A1", False)
+    state_filter.observe("A1", True, 0.0)
+    assert run(state_filter, 0.0, 1.0) == []
+
+    state_filter.observe("A1", False, 1.2)
+    assert run(state_filter, 1.0, 10.0) == []
+
+def test_flapping_slot_is_held_then_released():
+    state_filter = SlotStateFilter(dwell_occupied=2.0, dwell_free=2.0, flap_window=60.0, flap_max_flips=6, flap_clear=30.0)
+    state_filter.seed("A1", False)
+
+    occupied = False
+    for i in range(7):
+        occupied = not occupied
+        state_filter.observe("A1", occupied, i * 1.0)
+    results = run(state_filter, 6.0, 7.0)
+    assert len(results) == 1 and results[0][1] == []
+    assert results[0][2][0]["slot"] == "A1"
+    assert state_filter.flapping() == ["A1"]
+
+    # Giữ trạng thái đã commit trong lúc flapping, commit lại khi cảm biến ổn định flap_clear giây
+    assert run(state_filter, 7.0, 35.0) == []
+    assert run(state_filter, 35.0, 40.0)[0][1] == [("A1", True)]
+    assert state_filter.flapping() == []
+
+def test_override_discards_pending_samples():
+    state_filter = SlotStateFilter(dwell_occupied=2.0)
+    state_filter.seed("A1", False)
+    state_filter.observe("A1", True, 0.0)
+    run(state_filter, 0.0, 1.0)
+
+    state_filter.override("A1", False)
+    assert run(state_filter, 1.0, 10.0) == []
@@ -0,0 +1,42 @@
+from services.slot_update_service import SlotUpdateService
+
+def make_service(delta_buffer=4):
+    sent = []
+    service = SlotUpdateService(websocket_callback=sent.append, delta_buffer=delta_buffer)
+    return service, sent
+
+def test_commits_are_sequenced_and_broadcast_in_order():
+    service, sent = make_service()
+    service.handle_slot_update({"slot": "A1", "occupied": True})
+    service.handle_slot_update({"slot": "A2", "occupied": True})
+    service.set_manual("A1", False)
+
+    assert [(m["seq"], m["slot"], m["occupied"]) for m in sent] == [(1, "A1", True), (2, "A2", True), (3, "A1", False)]
+    assert all(m["type"] == "slot_update" for m in sent)
+
+def test_sync_returns_missing_deltas():
+    service, _ = make_service()
+    for i in range(3):
+        service.handle_slot_update({"slot": f"A{i}", "occupied": True})
+
+    message = service.sync(service.epoch, 1)
+    assert message["mode"] == "delta"
+    assert [d["seq"] for d in message["deltas"]] == [2, 3]
+    assert message["seq"] == 3
+
+    assert service.sync(service.epoch, 3)["deltas"] == []
+
+def test_sync_falls_back_to_snapshot():
+    service, _ = make_service(delta_buffer=4)
+    for i in range(6):
+        service.handle_slot_update({"slot": f"A{i % 3}", "occupied": i % 2 == 0})
+
+    # Delta đã rơi khỏi ring buffer, khác epoch (server restart), lần đầu, seq từ tương lai
+    for epoch, seq in ((service.epoch, 1), ("other", 5), (None, None), (service.epoch, 99)):
+        message = service.sync(epoch, seq)
+        assert message["mode"] == "snapshot"
+        assert message["slots"] == {"A0": False, "A1": True, "A2": False}
+        assert message["epoch"] == service.epoch and message["seq"] == 6
+
+    # Delta còn đủ trong buffer (seq 3..6)
+    assert [d["seq"] for d in service.sync(service.epoch, 2)["deltas"]] == [3, 4, 5, 6]
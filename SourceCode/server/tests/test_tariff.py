@@ -0,0 +1,69 @@
+import math
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from services.tariff_service import Tariff, TariffService, DEFAULT_TARIFF, EPOCH
+
+def reference_price(tariff: Tariff, entry: datetime, exit: datetime) -> int:
+
+    # Cộng đơn giá từng phút theo ngày địa phương, áp trần mỗi ngày (chậm nhưng hiển nhiên đúng)
+    start = math.floor((entry - EPOCH).total_seconds() / 60) + tariff.offset_minutes
+    end = math.ceil((exit - EPOCH).total_seconds() / 60) + tariff.offset_minutes
+    if end - start <= tariff.grace_minutes:
+        return 0
+    per_day = {}
+    for minute in range(start, end):
+        day, offset = divmod(minute, 24 * 60)
+        per_day[day] = per_day.get(day, 0.0) + tariff.prefix[offset + 1] - tariff.prefix[offset]
+    fee = sum(min(total, tariff.daily_cap) for total in per_day.values())
+    return int(math.ceil(round(fee, 6) / tariff.round_to) * tariff.round_to)
+
+def utc(local: str) -> datetime:
+
+    # Giờ địa phương (UTC+7) -> UTC như trong DB
+    return datetime.strptime(local, "%Y-%m-%d %H:%M") - timedelta(hours=7)
+
+@pytest.fixture
+def tariff():
+    return Tariff(DEFAULT_TARIFF)
+
+def test_grace_period_is_free(tariff):
+    assert tariff.price(utc("2026-01-05 08:00"), utc("2026-01-05 08:15")) == 0
+
+def test_day_band_rounded_up(tariff):
+    # 16 phút * 5000/giờ = 1333 -> làm tròn lên 2000
+    assert tariff.price(utc("2026-01-05 08:00"), utc("2026-01-05 08:16")) == 2000
+
+def test_spans_day_and_night_bands(tariff):
+    # 17:00-19:00: 1 giờ ngày (5000) + 1 giờ đêm (10000)
+    assert tariff.price(utc("2026-01-05 17:00"), utc("2026-01-05 19:00")) == 15000
+
+def test_daily_cap(tariff):
+    assert tariff.price(utc("2026-01-05 00:00"), utc("2026-01-05 23:59")) == 50000
+    # Trần theo ngày lịch địa phương: 05/01 (06-24h), 06/01, 07/01 và 08/01 (00-06h = 60000) đều chạm trần
+    assert tariff.price(utc("2026-01-05 06:00"), utc("2026-01-08 06:00")) == 4 * 50000
+
+def test_matches_reference_and_batch():
+    rng = random.Random(7)
+    tariff = Tariff(dict(DEFAULT_TARIFF, daily_cap=60000))
+    entries, exits = [], []
+    for _ in range(300):
+        entry = datetime(2026, 1, 1) + timedelta(seconds=rng.randint(0, 30 * 86400))
+        exit = entry + timedelta(seconds=rng.choice([rng.randint(0, 3600), rng.randint(0, 4 * 86400)]))
+        entries.append(entry)
+        exits.append(exit)
+        assert tariff.price(entry, exit) == reference_price(tariff, entry, exit)
+
+    batch = TariffService(dict(DEFAULT_TARIFF, daily_cap=60000)).price_batch(
+        np.array([(value - EPOCH).total_seconds() for value in entries]),
+        np.array([(value - EPOCH).total_seconds() for value in exits])
+    )
+    assert batch.tolist() == [tariff.price(entry, exit) for entry, exit in zip(entries, exits)]
+
+def test_no_cap():
+    tariff = Tariff(dict(DEFAULT_TARIFF, daily_cap=None))
+    # Cả ngày: 12 giờ * 5000 + 12 giờ * 10000
+    assert tariff.price(utc("2026-01-05 00:00"), utc("2026-01-06 00:00")) == 180000
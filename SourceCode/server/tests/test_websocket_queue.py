@@ -0,0 +1,39 @@
+import json
+
+from services.websocket_service import ClientConnection, BroadcastFrame
+
+def slot_update(seq):
+    return BroadcastFrame({"type": "slot_update", "seq": seq, "slot": "A1", "occupied": seq % 2 == 0})
+
+def test_slot_updates_are_not_coalesced_below_capacity():
+    client = ClientConnection(None, max_queue=10)
+    for seq in range(1, 6):
+        client.enqueue(slot_update(seq))
+
+    # Cùng slot nhưng không gộp: client nhận đủ seq liên tục
+    assert [json.loads(frame.text)["seq"] for frame in client._queue] == [1, 2, 3, 4, 5]
+    assert client.resync_needed is False and client.coalesced == 0
+
+def test_overflow_drops_pending_slot_updates_and_requests_resync():
+    client = ClientConnection(None, max_queue=4)
+    for seq in range(1, 4):
+        client.enqueue(slot_update(seq))
+    client.enqueue(BroadcastFrame({"type": "new_vehicle", "plate": "51A12345"}))
+    client.enqueue(slot_update(4))
+
+    assert [frame.type for frame in client._queue] == ["new_vehicle", "slot_update"]
+    assert client.resync_needed is True
+    assert client.coalesced == 3 and client.dropped == 0
+
+def test_drop_oldest_policy_requests_resync_for_slot_updates():
+    client = ClientConnection(None, max_queue=2, policy="drop_oldest")
+    for seq in range(1, 4):
+        client.enqueue(slot_update(seq))
+
+    assert client.depth() == 2 and client.dropped == 1
+    assert client.resync_needed is True
+
+def test_disconnect_policy():
+    client = ClientConnection(None, max_queue=1, policy="disconnect")
+    assert client.enqueue(slot_update(1)) is True
+    assert client.enqueue(slot_update(2)) is False